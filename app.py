@@ -1,31 +1,62 @@
-from turtle import color
 import dash
 from dash import dcc, html, dash_table
 from dash.dependencies import Input, Output, State
-import pandas as pd
-import base64
+import numpy as np
 import os
-import psycopg2
-from flask_session import Session
-from flask import Flask, session
+import json
+import uuid
+from flask import Flask, session, jsonify, request, Response, send_file, stream_with_context
+from itsdangerous import BadSignature, URLSafeSerializer
 from config import DB_CONFIG, SECRET_KEY
+from table_view import page_records, page_rows, view_columns
+from pipeline import OperationLog, StepError, OPERATION_TABLES
+from table_store import TableStore, SessionBusy, SESSION_ID_PATTERN
+from parse_cache import ParseCache
+import uploads
+import readers
+import consolidate
+import export
+import db
+import db_save
+import connectors
+import typeahead
+from passwords import verify_password, needs_rehash, hash_password
+from asset_codes import CodeAllocator, parse_code
+from transforms import blank_codes
+import tempfile
+import shutil
+import threading
+import multiprocessing
+import batch
+import metrics
+from jobs import JOB_PROGRESS, JobProgress, job_running, make_background_manager
 
 # Create a Flask application
 server = Flask(__name__)
 server.secret_key = SECRET_KEY  # Set your secret key here
 
-# Create a Dash application
-app = dash.Dash(__name__, server=server, suppress_callback_exceptions=True)
+# Create a Dash application; long-running steps run as background jobs in separate processes
+app = dash.Dash(
+    __name__,
+    server=server,
+    suppress_callback_exceptions=True,
+    background_callback_manager=make_background_manager(),
+)
 app.title = "System Thinking - Excel"
 
+# Time every callback registered below and every request, for /metrics
+metrics.instrument_callbacks(app)
+metrics.instrument_server(server, app)
+
 # Function to create and return a new database connection
 def get_db():
-    conn = psycopg2.connect(**DB_CONFIG)
-    return conn
+    """ Borrow a connection from this worker's pool """
+    return db.get_pool(DB_CONFIG).getconn()
 
 # Function to close the database connection
 def close_db(conn):
-    conn.close()
+    """ Hand a connection back to the pool """
+    db.get_pool(DB_CONFIG).putconn(conn)
 
 # Directory to save uploaded files
 UPLOAD_DIRECTORY = "uploads"
@@ -35,14 +66,39 @@ os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)  # Create the uploads directory if
 def authenticate_user(username, password):
     try:
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE username=%s AND password=%s", (username, password))
-        user = cur.fetchone()
-        close_db(conn)
-        return user is not None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT password FROM users WHERE username=%s", (username,))
+            user = cur.fetchone()
+        finally:
+            close_db(conn)
+        stored = user[0] if user is not None else None
+        if not verify_password(password, stored):
+            return False
     except Exception as e:
         print(f"Error authenticating user: {e}")
         return False
+    # Replace plaintext or outdated hashes the first time the password checks out;
+    # the login succeeds even when that fails, e.g. on a read-only replica
+    if needs_rehash(stored):
+        rehash_password(username, password)
+    return True
+
+def rehash_password(username, password):
+    """ Store password hashed with the current settings """
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute("UPDATE users SET password=%s WHERE username=%s", (hash_password(password), username))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            close_db(conn)
+    except Exception as e:
+        print(f"Error rehashing the password of {username}: {e}")
 
 # Application layout
 app.layout = html.Div(id='app-content',
@@ -79,6 +135,28 @@ app.layout = html.Div(id='app-content',
             style={"position": "relative"}
         ),
         html.Div(id="message"),
+        # Id of this session's tables, set at login; background jobs can't read the Flask session
+        dcc.Store(id="session-key"),
+        # Progress of the running background job
+        html.Div(
+            [
+                html.Progress(id="job-progress", value="0", max="100", style={"display": "none"}),
+                html.Span(id="job-status", style={"marginLeft": "10px", "color": "grey"}),
+                html.Button("Cancel", id="cancel-job-button", n_clicks=0, style={"display": "none"}),
+            ],
+        ),
+        # Steps applied so far, with undo/redo through earlier versions
+        html.Div(
+            [
+                html.Button("Undo", id="undo-button", n_clicks=0),
+                html.Button("Redo", id="redo-button", n_clicks=0),
+                html.Span(id="undo-status", style={"marginLeft": "10px", "color": "grey"}),
+                html.Ol(id="operation-log", style={"color": "grey"}),
+            ],
+        ),
+        # Changed when the pipeline does, so every step's table can be redrawn
+        dcc.Store(id="pipeline-version"),
+        dcc.Store(id="rendered-steps", data={}),
         dcc.Upload(
             id="upload-data",
             children=html.Div(["Drag and Drop or ", html.A("Select Files")]),
@@ -95,8 +173,10 @@ app.layout = html.Div(id='app-content',
                 "textAlign": "center",
                 "margin": "10px",
             },
-            multiple=False,
+            multiple=True,
         ),
+        # References to the stored files, set by assets/chunked_upload.js once the uploads complete
+        dcc.Store(id="uploaded-file-ref"),
         dcc.Dropdown(
             id='file-source-dropdown',
             options=[
@@ -112,15 +192,46 @@ app.layout = html.Div(id='app-content',
                     html.Img(src='/assets/computer.png', style={'height': '20px', 'verticalAlign': 'middle'}),
                     ' Local Computer'
                 ]), 'value': 'local'},
+            ] + [
+                # Only offered when configured, see connectors.connector_from_env
+                {'label': label, 'value': source}
+                for source, label in [('server', 'Server Folder'), ('http', 'Web Server')]
+                if connectors.connector_from_env(source) is not None
             ],
             value='local',
             placeholder="Select file source",
         ),
         html.Div(id='redirect-link'),
-        dcc.Input(id="sheet-name", type="text", placeholder="Sheet Name"),
+        # Files of a connected source, downloaded by the server instead of through the browser
+        html.Div(
+            [
+                dcc.Dropdown(id="remote-folder-dropdown", placeholder="Folder"),
+                dcc.Dropdown(id="remote-file-dropdown", multi=True, placeholder="Files to import"),
+                html.Button("Import Files", id="import-files-button", n_clicks=0),
+                html.Div(id="import-status"),
+            ],
+            id="remote-files",
+            style={"display": "none"},
+        ),
+        # Which sheets of the uploaded files to load into one table
+        dcc.RadioItems(
+            id="sheet-rule",
+            options=[
+                {"label": "Selected sheets", "value": "list"},
+                {"label": "All sheets", "value": "all"},
+                {"label": "Sheets matching", "value": "pattern"},
+            ],
+            value="list",
+            inline=True,
+        ),
+        dcc.Dropdown(id="sheet-name", multi=True, placeholder="Sheet Name"),
+        dcc.Input(id="sheet-pattern", type="text", placeholder="Sheet names like, e.g. Site *"),
         dcc.Input(id="header-row", type="number", placeholder="Header Row Number"),
+        dcc.Dropdown(id="load-column-dropdown", multi=True, placeholder="Columns to load (all when empty)"),
+        html.Div(id="sheet-preview"),
         html.Button("Load Data", id="load-data-button", n_clicks=0),
         html.Div(id="output-data-upload"),
+        html.Div(id="load-report"),
 
         # Container for the DataTable with scrolling
         html.Div(id="data-table-container"),
@@ -166,8 +277,32 @@ app.layout = html.Div(id='app-content',
         ),
         html.Button("Update Asset Codes", id="update-asset-codes-button", n_clicks=0),
         html.Div(id="updated-asset-table-container"),
-        html.Button("Download Data as Excel", id="download-excel-button", n_clicks=0),
-        dcc.Download(id="download-data-link"),
+        dcc.RadioItems(
+            id="export-format",
+            options=[
+                {"label": "Excel", "value": "xlsx"},
+                {"label": "CSV", "value": "csv"},
+                {"label": "Parquet", "value": "parquet"},
+            ],
+            value="xlsx",
+            inline=True,
+        ),
+        html.Button("Download Data", id="download-excel-button", n_clicks=0),
+        html.Div(id="export-status"),
+        dcc.Input(id="save-table-name", type="text",
+                  placeholder=f"Database table in {db_save.SAVE_SCHEMA}, e.g. asset_register"),
+        dcc.RadioItems(
+            id="save-mode",
+            options=[
+                {"label": "Upsert on Asset Code", "value": "upsert"},
+                {"label": "Append", "value": "append"},
+                {"label": "Replace", "value": "replace"},
+            ],
+            value="upsert",
+            inline=True,
+        ),
+        html.Button("Save to Database", id="save-db-button", n_clicks=0),
+        html.Div(id="save-db-status"),
 
         # Copyright Notice
         html.Div(
@@ -185,61 +320,684 @@ app.layout = html.Div(id='app-content',
     ]
 )
 
-# Global variable to store the latest DataFrame
-latest_table_data = None  # Store the latest DataFrame
-latest_uploaded_filename = None  # Store the filename of the uploaded file
-update_list = []  # List to store updates as dictionaries
-
-def save_uploaded_file(contents, filename):
-    """ Save the uploaded file to the server """
-    content_type, content_string = contents.split(",")
-    decoded = base64.b64decode(content_string)
-    file_path = os.path.join(UPLOAD_DIRECTORY, filename)
-    with open(file_path, 'wb') as f:
-        f.write(decoded)
-    return file_path
-
-def parse_file(file_path, sheet_name, header_row):
-    """ Parse the file into a DataFrame """
+# Directory where session tables are kept so that every gunicorn worker can read them
+TABLE_STORE_DIRECTORY = "table_store"
+table_store = TableStore(
+    TABLE_STORE_DIRECTORY,
+    max_bytes=int(os.environ.get("TABLE_STORE_MAX_BYTES", 512 * 1024 * 1024)),
+)
+
+# Parsed workbooks, so that reloading a file with the same sheet and header row skips the Excel parser
+PARSE_CACHE_DIRECTORY = "parse_cache"
+parse_cache = ParseCache(
+    PARSE_CACHE_DIRECTORY,
+    max_bytes=int(os.environ.get("PARSE_CACHE_MAX_BYTES", 1024 * 1024 * 1024)),
+)
+
+# Which version of each remote file was imported, so importing it again only downloads changes
+IMPORT_CACHE_DIRECTORY = "import_cache"
+import_cache = connectors.DownloadCache(IMPORT_CACHE_DIRECTORY)
+
+# Exported files, written by a background job and then downloaded from /export/file
+EXPORT_DIRECTORY = "exports"
+os.makedirs(EXPORT_DIRECTORY, exist_ok=True)
+
+# Bigger tables are only exported by the Download Data job, as writing them
+# inside a request can outlast gunicorn's worker timeout
+EXPORT_INLINE_ROWS = int(os.environ.get("EXPORT_INLINE_ROWS", 50_000))
+
+# Worker processes parsing the sheets of a load (one per CPU when unset)
+LOAD_WORKERS = int(os.environ.get("LOAD_WORKERS", 0)) or None
+
+def session_id():
+    """ Return the id that keys this browser session's tables """
+    if 'sid' not in session:
+        session['sid'] = uuid.uuid4().hex
+    return session['sid']
+
+# The session-key store holds the session id signed with SECRET_KEY, as the browser can change it
+session_keys = URLSafeSerializer(SECRET_KEY, salt="session-key")
+
+def job_session(session_key):
+    """ The session id in a session-key issued at login, or None when it is forged or logged out
+
+    Background jobs can't read the Flask session, so login records the user
+    in the session's state, which logout deletes.
+    """
+    if not session_key:
+        return None
+    try:
+        sid = session_keys.loads(session_key)
+    except BadSignature:
+        return None
+    if not isinstance(sid, str) or not SESSION_ID_PATTERN.match(sid):
+        return None
+    return sid if table_store.get_state(sid).get("logged_in_as") else None
+
+# Asset code numbers are handed out from a counter table, so two users never get the same codes
+code_allocator = CodeAllocator(DB_CONFIG)
+
+def reserve_asset_codes(sid, df, params):
+    """ Number the blank codes of an asset codes step from a range reserved in the database
+
+    A replay with the same parameters, e.g. after a classification
+    changed, reuses the range reserved for them while it is big enough.
+    """
+    count = int(blank_codes(df).sum())
+    if not count:
+        return params
+    key = json.dumps(params, sort_keys=True)
+    reservations = table_store.get_state(sid).get("code_reservations", {})
+    reserved = reservations.get(key)
+    if reserved is None or reserved["count"] < count:
+        reserved = {"first_blank_row": code_allocator.reserve_codes(params["first_blank_row"], count), "count": count}
+        table_store.update_state(sid, code_reservations={**reservations, key: reserved})
+    return {**params, "first_blank_row": reserved["first_blank_row"]}
+
+# The steps applied to each session's table, as snapshots in the table store
+operation_log = OperationLog(table_store, prepare={"asset_codes": reserve_asset_codes})
+
+def get_latest_table(sid):
+    """ Return the DataFrame produced by the most recent step, or None """
+    return operation_log.latest(sid)
+
+def pipeline_changed(shown=None, dropped=None):
+    """ New value for the pipeline-version store; shown is the table the step already displays
+
+    dropped maps the tables of steps a replay removed to the message their container shows.
+    """
+    return {"version": uuid.uuid4().hex, "shown": shown, "dropped": dropped or {}}
+
+def step_error_message(error):
+    """ Why a step can't be applied, from the KeyError or ValueError it raised """
+    if isinstance(error, KeyError):
+        return f"the column {error.args[0]!r} is missing" if error.args else "a column is missing"
+    return str(error)
+
+def database_error_message(sid, operation, error):
+    """ Why running operation failed on the database
+
+    Only asset codes steps use it, to reserve their codes when they are
+    computed, so another operation fails when the asset codes step after it
+    is replayed.
+    """
+    if operation == "asset_codes":
+        return f"Error reserving asset codes in the database: {error}"
+    if any(step["op"] == "asset_codes" for step in operation_log.steps(sid)):
+        return f"Error replaying the asset codes step after this one, which reserves codes in the database: {error}"
+    return f"Database error: {error}"
+
+def run_step(sid, operation, params, progress):
+    """ Run a step of the session's pipeline
+
+    Returns the step's table and, for the later steps that no longer apply to
+    it and were dropped, {table id: message}.  Raises StepError when the step
+    itself can't be applied.
+    """
+    try:
+        return operation_log.run(sid, operation, params, progress=progress.steps()), {}
+    except StepError as e:
+        if e.result is None:
+            raise
+        message = (f"The {e.step['op']} step no longer applies, so it and the steps after it were removed "
+                   f"from the pipeline: {step_error_message(e.error)}.")
+        return e.result, {OPERATION_TABLES[e.step["op"]]: message}
+
+# Tables that are paged, sorted and filtered on the server
+PAGED_TABLES = {
+    "data-table": 10,
+    "copied-data-table": 10,
+    "sorted-data-table": 30,
+    "updated-group-table": 10,
+    "asset-data-table": 10,
+}
+
+# Container each step's table is drawn in
+STEP_CONTAINERS = {
+    "data-table": "data-table-container",
+    "copied-data-table": "copied-data-table-container",
+    "sorted-data-table": "sorted-data-table-container",
+    "updated-group-table": "updated-group-table-container",
+    "asset-data-table": "updated-asset-table-container",
+}
+
+def make_data_table(table_id, df):
+    """ Build a DataTable that only holds the first page of df; the rest is served on demand """
+    page_size = PAGED_TABLES[table_id]
+    data, page_count = page_records(df, 0, page_size)
+    return dash_table.DataTable(
+        data=data,
+        columns=[{"name": i, "id": i} for i in df.columns],
+        id=table_id,
+        page_current=0,
+        page_size=page_size,
+        page_count=page_count,
+        page_action="custom",
+        sort_action="custom",
+        sort_mode="multi",
+        sort_by=[],
+        filter_action="custom",
+        filter_query="",
+        style_cell={
+            'fontFamily': 'Arial, sans-serif',
+            'fontSize': '14px',
+            'textAlign': 'left',
+            'padding': '10px',
+        },
+        style_header={
+            'backgroundColor': '#0074D9',
+            'color': 'white',
+            'fontWeight': 'bold',
+            'fontSize': '16px'
+        },
+        style_table={
+            "overflowY": "auto",  # Enable vertical scrolling
+            "maxHeight": "400px",  # Set a maximum height for the table container
+            "margin": "10px 0"
+        },  # Add some margin
+    )
+
+def shown_view(sid, table_id, shown_table):
+    """ Page, sort and filter of the table on screen, as last requested by the browser """
+    view = table_store.get_state(sid).get(f"view-{table_id}")
+    if not view or view.get("table") != shown_table:
+        # Not paged, sorted or filtered since it was drawn
+        view = {"page_current": 0, "page_size": PAGED_TABLES[table_id], "sort_by": [], "filter_query": ""}
+    return {key: view[key] for key in ("page_current", "page_size", "sort_by", "filter_query")}
+
+def forget_rendered(table_id):
+    """ An update for the rendered-steps store when a step's container stops showing its table """
+    patch = dash.Patch()
+    del patch[table_id]
+    return patch
+
+def step_table_update(sid, table_id, shown_table):
+    """ New children for the container of a step's table
+
+    When the table on screen (the snapshot shown_table) is an earlier result
+    of the same step on the same rows, only the cells of the page on screen
+    that changed are sent, as a Patch; otherwise the table is drawn again.
+    When the step's snapshot is gone, e.g. pruned by a newer step, the
+    container is left as it is.
+    """
+    step = operation_log.step(sid, table_id)
+    df = table_store.get(sid, step["table"]) if step else None
+    if df is None:
+        return dash.no_update
+    changes = operation_log.changes(sid, step["op"], shown_table) if shown_table else None
+    if changes is None:
+        return make_data_table(table_id, df)
+
+    view = shown_view(sid, table_id, shown_table)
+    patch = dash.Patch()
+    if set(changes) & view_columns(view["sort_by"], view["filter_query"]):
+        # The changes can move rows onto or off the page, so send the whole page again
+        patch["props"]["data"], patch["props"]["page_count"] = page_records(df, **view)
+    else:
+        page, _ = page_rows(df, **view)
+        positions = df.index.get_indexer(page.index)
+        for column, rows in changes.items():
+            on_page = np.flatnonzero(np.isin(positions, rows))
+            for i, record in zip(on_page, page.iloc[on_page][[column]].to_dict("records")):
+                patch["props"]["data"][int(i)][column] = record[column]
+    table_store.update_state(sid, **{f"view-{table_id}": {**view, "table": step["table"]}})
+    return patch
+
+def register_table_paging(table_id):
+    """ Serve the requested page of a table from the DataFrame stored for it """
+    @app.callback(
+        [Output(table_id, "data"), Output(table_id, "page_count")],
+        [Input(table_id, "page_current"),
+         Input(table_id, "page_size"),
+         Input(table_id, "sort_by"),
+         Input(table_id, "filter_query")],
+        prevent_initial_call=True,
+    )
+    def update_table_page(page_current, page_size, sort_by, filter_query):
+        if not session.get('logged_in'):
+            return [], 1
+        sid = session_id()
+        step = operation_log.step(sid, table_id)
+        df = table_store.get(sid, step["table"]) if step else None
+        if df is None:
+            return [], 1
+        # Remembered so that later changes can be sent as edits of this page
+        table_store.update_state(sid, **{f"view-{table_id}": {
+            "table": step["table"],
+            "page_current": page_current,
+            "page_size": page_size,
+            "sort_by": sort_by,
+            "filter_query": filter_query,
+        }})
+        return page_records(df, page_current, page_size, sort_by, filter_query)
+
+for _table_id in PAGED_TABLES:
+    register_table_paging(_table_id)
+
+# Dropdowns searched on the server as the user types -> column of the loaded
+# table whose values they offer, or None for the names of its columns
+TYPEAHEAD_DROPDOWNS = {
+    "copy-column-dropdown": None,
+    "column-dropdown": None,
+    "group-dropdown": "Site",
+    "asset-dropdown": None,
+}
+
+# Search indexes of the loaded tables' dropdown values, shared by all workers through their files
+TYPEAHEAD_DIRECTORY = "typeahead_cache"
+value_indexes = typeahead.IndexCache(TYPEAHEAD_DIRECTORY)
+
+def loaded_value_index(sid, column):
+    """ Search index of a column's values (or of the column names) in the loaded table, or None """
+    step = operation_log.step(sid, "data-table")
+    if step is None:
+        return None
+
+    def values():
+        df = table_store.get(sid, step["table"])
+        if df is None:
+            return []
+        if column is None:
+            return df.columns
+        return df[column] if column in df.columns else []
+
+    return value_indexes.get((sid, step["table"], column), values)
+
+def register_typeahead(dropdown_id, column):
+    """ Send the dropdown the best matches of what is typed into it, instead of every option up front """
+    @app.callback(
+        Output(dropdown_id, "options", allow_duplicate=True),
+        Input(dropdown_id, "search_value"),
+        State(dropdown_id, "value"),
+        prevent_initial_call=True,
+    )
+    def search_options(search_value, selected):
+        if not session.get('logged_in'):
+            return dash.no_update
+        index = loaded_value_index(session_id(), column)
+        if index is None:
+            return dash.no_update
+        matches = index.search(search_value)
+        # The chosen values have to stay among the options, or the dropdown drops them
+        if selected is None:
+            selected = []
+        elif not isinstance(selected, list):
+            selected = [selected]
+        return typeahead.options([value for value in selected if value not in matches] + matches)
+
+for _dropdown_id, _column in TYPEAHEAD_DROPDOWNS.items():
+    register_typeahead(_dropdown_id, _column)
+
+@server.route("/metrics")
+def metrics_page():
+    """ Callback and request histograms of all workers and background jobs, for Prometheus """
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+@server.route("/table-store/stats")
+def table_store_stats():
+    """ Hit/miss/eviction counters of this worker's table store """
+    return jsonify(table_store.stats())
+
+@server.route("/db/stats")
+def db_stats():
+    """ Size, checkout and wait-time counters of this worker's connection pool """
+    return jsonify(db.get_pool(DB_CONFIG).stats())
+
+@server.route("/typeahead/stats")
+def typeahead_stats():
+    """ Hit/miss counters of this worker's dropdown search indexes """
+    return jsonify(value_indexes.stats())
+
+@server.route("/parse-cache/stats")
+def parse_cache_stats():
+    """ Hit/miss/eviction counters of the parsed-workbook cache """
+    return jsonify(parse_cache.stats())
+
+@server.route("/upload/<upload_id>", methods=["GET", "PUT"])
+def chunked_upload(upload_id):
+    """ Receive an upload in chunks, streaming each one straight to UPLOAD_DIRECTORY
+
+    GET returns how many bytes have arrived so an interrupted upload can be
+    resumed.  PUT appends the chunk described by the Content-Range header;
+    the response to the last chunk is the reference to the stored file.
+    """
+    if not session.get('logged_in'):
+        return jsonify(error="Please log in to upload files!"), 401
+    if not uploads.valid_upload_id(upload_id):
+        return jsonify(error="Invalid upload id"), 400
+
+    part_path = uploads.partial_path(UPLOAD_DIRECTORY, session_id(), upload_id)
+    if request.method == "GET":
+        return jsonify(offset=uploads.partial_offset(part_path))
+
+    content_range = uploads.parse_content_range(request.headers.get("Content-Range"))
+    if content_range is None:
+        return jsonify(error="Missing or invalid Content-Range header"), 400
+    start, end, total = content_range
+
     try:
-        if file_path.endswith(".csv"):
-            df = pd.read_csv(file_path)
-        elif file_path.endswith(".xls") or file_path.endswith(".xlsx"):
-            df = pd.read_excel(file_path, sheet_name=sheet_name, header=header_row)
+        offset = uploads.write_chunk(part_path, start, request.stream)
+    except uploads.OffsetMismatch as e:
+        return jsonify(offset=e.offset), 409
+    if offset != end + 1:
+        # The chunk was cut short or longer than announced; resume from what is on disk
+        if offset > total:
+            uploads.discard(part_path)
+            return jsonify(error="Upload is larger than announced"), 400
+        return jsonify(offset=offset), 409
+    if offset < total:
+        return jsonify(offset=offset)
+
+    filename = request.args.get("filename", "")
+    stored_path, digest, duplicate = uploads.finish_upload(UPLOAD_DIRECTORY, part_path, filename)
+    parse_cache.remember_digest(stored_path, digest)
+    return jsonify(
+        offset=offset,
+        file=os.path.basename(stored_path),
+        filename=filename,
+        digest=digest,
+        duplicate=duplicate,
+    )
+
+@server.route("/export/<export_format>")
+def export_table(export_format):
+    """ Download the latest table as xlsx, csv or parquet
+
+    CSV is streamed to the client as it is encoded.  Workbooks and Parquet
+    files of up to EXPORT_INLINE_ROWS rows are written batch by batch to a
+    temporary file which is then sent; bigger ones are left to the export job.
+    """
+    if not session.get('logged_in'):
+        return jsonify(error="Please log in to download data!"), 401
+    if export_format not in export.EXPORT_FORMATS:
+        return jsonify(error=f"Unsupported export format: {export_format}"), 400
+    df = get_latest_table(session_id())
+    if df is None:
+        return jsonify(error="There is no data to download yet"), 404
+
+    mimetype, extension = export.EXPORT_FORMATS[export_format]
+    download_name = "updated_data" + extension
+    if export_format == "csv":
+        return Response(
+            stream_with_context(export.iter_csv(df)),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f"attachment; filename={download_name}"},
+        )
+
+    if len(df) > EXPORT_INLINE_ROWS:
+        return jsonify(error=f"The table has {len(df):,} rows, use Download Data to export it"), 413
+
+    fd, temp_path = tempfile.mkstemp(suffix=extension)
+    os.close(fd)
+    try:
+        if export_format == "xlsx":
+            export.write_xlsx(df, temp_path)
         else:
-            return None, f"Unsupported file format: {file_path}"
-    except Exception as e:
-        return None, f"There was an error processing this file. Error: {str(e)}"
-    return df, None
+            export.write_parquet(df, temp_path)
+        # The open handle keeps the data readable after the name is gone
+        exported = open(temp_path, "rb")
+    finally:
+        os.unlink(temp_path)
+    return send_file(exported, mimetype=mimetype, as_attachment=True, download_name=download_name)
+
+def export_directory(sid):
+    """ Directory of a session's exported files """
+    return os.path.join(EXPORT_DIRECTORY, sid)
+
+@server.route("/export/file/<file_name>")
+def exported_file(file_name):
+    """ Download a file written by the export job of this session """
+    if not session.get('logged_in'):
+        return jsonify(error="Please log in to download data!"), 401
+    export_id, _, export_format = file_name.partition(".")
+    if not uploads.valid_upload_id(export_id) or export_format not in export.EXPORT_FORMATS:
+        return jsonify(error="Invalid export"), 400
+    path = os.path.join(export_directory(session_id()), file_name)
+    if not os.path.isfile(path):
+        return jsonify(error="This export is gone, please download the data again"), 404
+    mimetype, extension = export.EXPORT_FORMATS[export_format]
+    return send_file(os.path.abspath(path), mimetype=mimetype, as_attachment=True,
+                     download_name="updated_data" + extension)
+
+# Batch runs only read and write below this directory
+BATCH_DIRECTORY = os.environ.get("BATCH_DIRECTORY", "batch")
+BATCH_REPORT_DIRECTORY = os.path.join(BATCH_DIRECTORY, "reports")
+
+@server.route("/api/batch", methods=["POST"])
+def start_batch():
+    """ Run a pipeline spec over a directory of workbooks in the background
+
+    Takes {"spec": {...}, "input_dir": "...", "output_dir": "...", "workers": n}
+    with directories relative to BATCH_DIRECTORY (see batch.py for the spec)
+    and n capped at the number of CPUs,
+    and returns the id to poll /api/batch/<batch_id> with.
+    """
+    if not session.get('logged_in'):
+        return jsonify(error="Please log in to run batches!"), 401
+    body = request.get_json(silent=True) or {}
+    try:
+        spec = batch.load_spec(body.get("spec"))
+        input_dir = batch.resolve_dir(BATCH_DIRECTORY, body.get("input_dir", ""))
+        output_dir = batch.resolve_dir(BATCH_DIRECTORY, body.get("output_dir", "output"))
+        workers = batch.worker_count(body.get("workers"))
+    except (ValueError, TypeError) as e:
+        return jsonify(error=str(e)), 400
+    if not os.path.isdir(input_dir):
+        return jsonify(error=f"No such directory: {body.get('input_dir')}"), 400
+
+    batch_id = uuid.uuid4().hex
+    os.makedirs(BATCH_REPORT_DIRECTORY, exist_ok=True)
+    report_path = os.path.join(BATCH_REPORT_DIRECTORY, f"{batch_id}.json")
+    batch.write_report(report_path, {"status": "running", "reports": []})
+    threading.Thread(
+        target=batch.run_batch_to_file,
+        args=(input_dir, spec, output_dir, report_path, workers, DB_CONFIG),
+        daemon=True,
+    ).start()
+    return jsonify(batch_id=batch_id, files=len(batch.list_workbooks(input_dir))), 202
+
+@server.route("/api/batch/<batch_id>")
+def batch_report(batch_id):
+    """ Status of a batch run and the timings of the files done so far """
+    if not session.get('logged_in'):
+        return jsonify(error="Please log in to run batches!"), 401
+    if not uploads.valid_upload_id(batch_id):
+        return jsonify(error="Invalid batch id"), 400
+    report_path = os.path.join(BATCH_REPORT_DIRECTORY, f"{batch_id}.json")
+    if not os.path.exists(report_path):
+        return jsonify(error="No such batch"), 404
+    return send_file(os.path.abspath(report_path), mimetype="application/json", max_age=0)
+
+def sheet_selection(uploaded_files, sheet_rule, sheet_names, sheet_pattern):
+    """ Arguments for consolidate.plan_sheets picking sheets from the session's uploaded files """
+    return {
+        "files": [f["path"] for f in uploaded_files],
+        "rule": sheet_rule or "list",
+        "selection": sheet_pattern if sheet_rule == "pattern" else sheet_names,
+        "sheet_names": {f["path"]: f["sheets"] for f in uploaded_files},
+    }
+
+def load_report_view(report):
+    """ How long every sheet took to load, or why it was not loaded """
+    summary = (f"Loaded {report['loaded']} of {report['sheets']} sheets from {report['files']} files: "
+               f"{report['rows']} rows in {report['seconds']:.1f}s")
+    if report["failed"]:
+        summary += f", {report['failed']} failed"
+    rows = [html.Tr([html.Th(name) for name in ("File", "Sheet", "Status", "Rows", "Seconds", "Notes")])]
+    for entry in report["reports"]:
+        notes = entry.get("error") or ""
+        if entry.get("missing_columns"):
+            notes = "missing columns: " + ", ".join(map(str, entry["missing_columns"]))
+        if entry.get("cached"):
+            notes = (notes + " (cached)").strip()
+        rows.append(html.Tr([
+            html.Td(entry["file"]),
+            html.Td(entry["sheet"] or ""),
+            html.Td(entry["status"]),
+            html.Td(entry.get("rows", "")),
+            html.Td(f"{entry['seconds']:.2f}" if "seconds" in entry else ""),
+            html.Td(notes),
+        ]))
+    return html.Details(
+        [html.Summary(summary), html.Table(rows, style={"fontSize": "12px"})],
+        open=bool(report["failed"]),
+    )
 
 @app.callback(
-    Output('redirect-link', 'children'),
-    Input('file-source-dropdown', 'value')
+    [Output('redirect-link', 'children'),
+     Output('remote-files', 'style'),
+     Output('remote-folder-dropdown', 'options'),
+     Output('remote-file-dropdown', 'options'),
+     Output('remote-file-dropdown', 'value')],
+    [Input('file-source-dropdown', 'value'),
+     Input('remote-folder-dropdown', 'value')]
 )
-def redirect_user(file_source):
-    if file_source == 'google':
-        return dcc.Location(href='https://drive.google.com', id='go-to-google', refresh=True)
-    elif file_source == 'dropbox':
-        return dcc.Location(href='https://www.dropbox.com', id='go-to-dropbox', refresh=True)
-    return ""
+def redirect_user(file_source, folder):
+    """ List the files of a connected source; sources without a connector open in the browser instead """
+    hidden = {"display": "none"}
+    connector = connectors.connector_from_env(file_source)
+    if connector is None:
+        if file_source == 'google':
+            return dcc.Location(href='https://drive.google.com', id='go-to-google', refresh=True), hidden, [], [], []
+        elif file_source == 'dropbox':
+            return dcc.Location(href='https://www.dropbox.com', id='go-to-dropbox', refresh=True), hidden, [], [], []
+        return "", hidden, [], [], []
+    if not session.get('logged_in'):
+        return "", hidden, [], [], []
+
+    # A new source starts at its top folder
+    if dash.callback_context.triggered_id == 'file-source-dropdown':
+        folder = None
+    try:
+        entries = connector.list(folder) if folder else connector.list()
+    except connectors.ConnectorError as e:
+        return html.Div(f"Could not list the files: {e}"), {}, [], [], []
+    folder_options = [{"label": "Top folder", "value": ""}] + [
+        {"label": entry["name"] + "/", "value": entry["path"]} for entry in entries if entry["folder"]]
+    file_options = [
+        {"label": entry["name"], "value": entry["path"]}
+        for entry in entries
+        if not entry["folder"] and (readers.is_excel(entry["name"]) or readers.is_csv(entry["name"]))
+    ]
+    return "", {}, folder_options, file_options, []
+
+# Download the chosen files of a connected source into the upload directory, as if they were uploaded
+@app.callback(
+    [Output("uploaded-file-ref", "data", allow_duplicate=True),
+     Output("import-status", "children")],
+    Input("import-files-button", "n_clicks"),
+    [State("file-source-dropdown", "value"),
+     State("remote-file-dropdown", "value"),
+     State("session-key", "data")],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("import-files-button"),
+    prevent_initial_call=True,
+)
+def import_remote_files(set_progress, n_clicks, file_source, paths, session_key):
+    sid = job_session(session_key)
+    if not sid or not n_clicks:
+        return dash.no_update, dash.no_update
+    connector = connectors.connector_from_env(file_source)
+    if connector is None or not paths:
+        return dash.no_update, html.Div("Choose the files to import first.")
+    progress = JobProgress(set_progress, "Import Files")
+    file_refs = []
+    reported = [None]
+    for number, path in enumerate(paths):
+        def fetched(done, size, number=number, path=path):
+            # Called for every piece that arrives, so only report whole percents
+            percent = int(5 + 90 * (number + (done / size if size else 0)) / len(paths))
+            if percent != reported[0]:
+                reported[0] = percent
+                progress(percent, f"downloading {os.path.basename(path)}")
+        try:
+            file_refs.append(connectors.fetch(connector, file_source, path, UPLOAD_DIRECTORY, import_cache,
+                                              progress=fetched))
+        except (connectors.ConnectorError, OSError) as e:
+            progress(100, "failed")
+            return dash.no_update, html.Div(f"Error importing {os.path.basename(path)}: {e}")
+    progress(100, "done")
+    downloaded = sum(not ref["cached"] for ref in file_refs)
+    return file_refs, html.Div(f"Imported {len(file_refs)} files, {len(file_refs) - downloaded} unchanged since the last import.")
 
 @app.callback(
-    Output("output-data-upload", "children"),
-    Input("upload-data", "contents"),
-    State("upload-data", "filename"),
+    [Output("output-data-upload", "children"),
+     Output("sheet-name", "options"),
+     Output("sheet-name", "value")],
+    Input("uploaded-file-ref", "data"),
     State("username", "value"),
     State("password", "value")
 )
-def upload_file(contents, filename, username, password):
-    """ Handle file upload and save it on the server """
+def upload_file(file_refs, username, password):
+    """ Remember the files that were streamed to the server for this session and list their sheets """
     if session.get('logged_in'):
-        if contents is not None:
-            global latest_uploaded_filename
-            latest_uploaded_filename = save_uploaded_file(contents, filename)  # Save the file to the server
-            return f"Uploaded: {filename}"
+        if file_refs:
+            if isinstance(file_refs, dict):
+                file_refs = [file_refs]
+            uploaded_files = []
+            sheet_names = []
+            messages = []
+            for file_ref in file_refs:
+                # Only accept references to files inside the upload directory
+                file_path = os.path.join(UPLOAD_DIRECTORY, os.path.basename(file_ref.get("file", "")))
+                if not os.path.isfile(file_path):
+                    return f"Uploaded file {file_ref.get('filename')} not found, please upload it again.", [], None
+                try:
+                    sheets = readers.list_sheets(file_path)
+                except Exception as e:
+                    return f"There was an error reading {file_ref.get('filename')}. Error: {str(e)}", [], None
+                uploaded_files.append({"path": file_path, "filename": file_ref.get("filename"), "sheets": sheets})
+                sheet_names.extend(sheet for sheet in sheets if sheet not in sheet_names)
+                if file_ref.get("duplicate"):
+                    messages.append(f"{file_ref.get('filename')} (using the stored copy)")
+                else:
+                    messages.append(file_ref.get("filename"))
+            table_store.update_state(session_id(), uploaded_files=uploaded_files)
+            sheet_options = [{"label": sheet, "value": sheet} for sheet in sheet_names]
+            return "Uploaded: " + ", ".join(messages), sheet_options, sheet_names[:1]
     else: 
-        return ""
-    return ""
+        return "", [], None
+    return "", [], None
+
+@app.callback(
+    [Output("load-column-dropdown", "options"),
+     Output("sheet-preview", "children")],
+    [Input("sheet-name", "value"),
+     Input("sheet-rule", "value"),
+     Input("sheet-pattern", "value"),
+     Input("header-row", "value"),
+     Input("output-data-upload", "children")]
+)
+def inspect_sheet(sheet_names, sheet_rule, sheet_pattern, header_row, upload_message):
+    """ Show the first rows of the first sheet to load and the columns that can be loaded, without parsing it """
+    uploaded_files = table_store.get_state(session_id()).get('uploaded_files') if session.get('logged_in') else None
+    if not uploaded_files:
+        return [], ""
+    try:
+        tasks, _ = consolidate.plan_sheets(**sheet_selection(uploaded_files, sheet_rule, sheet_names, sheet_pattern))
+    except ValueError as e:
+        return [], html.Div(str(e))
+    if not tasks:
+        return [], html.Div("No sheet of the uploaded files matches the selection.")
+    file_path, sheet_name = tasks[0]
+    if not os.path.isfile(file_path):
+        return [], ""
+    try:
+        rows = readers.header_candidates(file_path, sheet_name, n_rows=6)
+        columns = readers.read_columns(file_path, sheet_name, header_row)
+    except Exception as e:
+        return [], html.Div(f"There was an error reading this sheet. Error: {str(e)}")
+
+    preview = html.Table(
+        [html.Tr([html.Td(f"Row {i}:")] + [html.Td(str(value)) for value in row[:8]])
+         for i, row in enumerate(rows)],
+        style={"fontSize": "12px", "color": "grey"},
+    )
+    filename = next(f["filename"] for f in uploaded_files if f["path"] == file_path)
+    title = html.Div(f"{len(tasks)} sheets selected, showing {filename}" + (f" / {sheet_name}" if sheet_name else ""))
+    return [{"label": col, "value": col} for col in columns], html.Div([title, preview])
 
 @app.callback(
     [
@@ -248,165 +1006,157 @@ def upload_file(contents, filename, username, password):
         Output("column-dropdown", "options"),
         Output("group-dropdown", "options"),
         Output("asset-dropdown", "options"),
+        Output("load-report", "children"),
+        Output("pipeline-version", "data", allow_duplicate=True),
     ],
     [Input("load-data-button", "n_clicks")],
     [State("sheet-name", "value"),
-     State("header-row", "value")]
+     State("sheet-rule", "value"),
+     State("sheet-pattern", "value"),
+     State("header-row", "value"),
+     State("load-column-dropdown", "value"),
+     State("session-key", "data")],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("load-data-button", pipeline_step=True),
+    prevent_initial_call=True,
 )
-def load_data(n_clicks, sheet_name, header_row):
-    """ Load data from the saved file on the server """
-    if session.get('logged_in'):
-        if n_clicks > 0 and latest_uploaded_filename:
-            df, error = parse_file(latest_uploaded_filename, sheet_name, header_row)
-            if error:
-                return html.Div(error), [], [], [], []  # Show error message
-
-            global latest_table_data  # Access global variable to store the DataFrame
-            latest_table_data = df  # Store the DataFrame for later use
-            copied_columns = [{"label": col, "value": col} for col in df.columns]
-            column_options = [{"label": col, "value": col} for col in df.columns]
-            group_options = [{"label": grp, "value": grp} for grp in df["Site"].unique()]
-            asset_options = [{"label": col, "value": col} for col in df.columns]
-            
+def load_data(set_progress, n_clicks, sheet_names, sheet_rule, sheet_pattern, header_row, load_columns, session_key):
+    """ Load the selected sheets of every uploaded file into one table """
+    sid = job_session(session_key)
+    if sid:
+        uploaded_files = table_store.get_state(sid).get('uploaded_files')
+        if n_clicks > 0 and uploaded_files:
+            progress = JobProgress(set_progress, "Load Data")
+            progress(10, "reading files")
+            selection = sheet_selection(uploaded_files, sheet_rule, sheet_names, sheet_pattern)
+            try:
+                df, report = consolidate.consolidate(
+                    **selection,
+                    header_row=header_row,
+                    columns=load_columns or None,
+                    display_names={f["path"]: f["filename"] for f in uploaded_files},
+                    workers=LOAD_WORKERS,
+                    # The job process runs no other threads, so the parsers can be forked from it
+                    mp_context=multiprocessing.get_context("fork"),
+                    cache=parse_cache,
+                    progress=lambda done, total: progress(10 + 60 * done // total, f"read {done} of {total} sheets"),
+                )
+            except Exception as e:
+                progress(100, "failed")
+                error = f"There was an error processing these files. Error: {str(e)}"
+                return html.Div(error), [], [], [], [], "", dash.no_update
+            if df is None:
+                progress(100, "failed")
+                return html.Div("No sheet could be loaded."), [], [], [], [], load_report_view(report), dash.no_update
+            metrics.note_frame(df)
+
+            progress(80, "storing table")
+            operation_log.load(sid, df, {
+                "files": [os.path.basename(f["path"]) for f in uploaded_files],
+                "sheet_rule": selection["rule"],
+                "sheets": selection["selection"],
+                "header": header_row,
+                "columns": load_columns or None,
+            })
+
+            # Only the first options are sent; the rest are searched for as the user types
+            progress(85, "indexing dropdown values")
+            first_options = {
+                dropdown_id: typeahead.options(loaded_value_index(sid, column).search(""))
+                for dropdown_id, column in TYPEAHEAD_DROPDOWNS.items()
+            }
+            copied_columns = first_options["copy-column-dropdown"]
+            column_options = first_options["column-dropdown"]
+            group_options = first_options["group-dropdown"]
+            asset_options = first_options["asset-dropdown"]
+            table = make_data_table("data-table", df)
+            progress(100, f"loaded {len(df)} rows from {report['loaded']} sheets")
             return (
-                dash_table.DataTable(
-                    data=df.to_dict("records"),
-                    columns=[{"name": i, "id": i} for i in df.columns],
-                    id="data-table",
-                    page_current=0,
-                    page_size=10,
-                    page_action="native",
-                    style_cell={
-                        'fontFamily': 'Arial, sans-serif',
-                        'fontSize': '14px',
-                        'textAlign': 'left',
-                        'padding': '10px',
-                    },
-                    style_header={
-                        'backgroundColor': '#0074D9',
-                        'color': 'white',
-                        'fontWeight': 'bold',
-                        'fontSize': '16px'
-                    },
-                    style_table={
-                        "overflowY": "auto",  # Enable vertical scrolling
-                        "maxHeight": "400px",  # Set a maximum height for the table container
-                        "margin": "10px 0"
-                    },  # Add some margin
-                ),
+                table,
                 copied_columns,
                 column_options,
                 group_options,
                 asset_options,
+                load_report_view(report),
+                pipeline_changed("data-table"),
             )
-        return html.Div(), [], [], [], []
-    return html.Div(), [], [], [], []
+        return html.Div(), [], [], [], [], "", dash.no_update
+    return html.Div(), [], [], [], [], "", dash.no_update
 
 @app.callback(
-    Output("copied-data-table-container", "children"),
+    [Output("copied-data-table-container", "children"),
+     Output("pipeline-version", "data", allow_duplicate=True)],
     [Input("copy-button", "n_clicks")],
-    [State("copy-column-dropdown", "value")]
+    [State("copy-column-dropdown", "value"),
+     State("session-key", "data")],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("copy-button", pipeline_step=True),
+    prevent_initial_call=True,
 )
-def copy_columns(n_clicks, columns_selected):
+def copy_columns(set_progress, n_clicks, columns_selected, session_key):
     """ Copy selected columns to a new DataFrame and display them in a DataTable """
-    global latest_table_data  # Access global variable to store the DataFrame
-    if n_clicks > 0 and latest_table_data is not None and columns_selected is not None:
-        df = latest_table_data 
-        df = df[columns_selected]
-        latest_table_data = df
-        return dash_table.DataTable(
-            data=df.to_dict("records"),
-            columns=[{"name": i, "id": i} for i in df.columns],
-            id="copied-data-table",
-            page_current=0,
-            page_size=10,
-            page_action="native",
-            style_cell={
-                'fontFamily': 'Arial, sans-serif',
-                'fontSize': '14px',
-                'textAlign': 'left',
-                'padding': '10px',
-            },
-            style_header={
-                'backgroundColor': '#0074D9',
-                'color': 'white',
-                'fontWeight': 'bold',
-                'fontSize': '16px'
-            },
-            style_table={
-                "overflowY": "auto",  # Enable vertical scrolling
-                "maxHeight": "400px",  # Set a maximum height for the table container
-                "margin": "10px 0"
-            },  # Add some margin
-        )
-    return html.Div()
+    sid = job_session(session_key)
+    if sid and n_clicks > 0 and operation_log.steps(sid) and columns_selected is not None:
+        progress = JobProgress(set_progress, "Extract Columns")
+        progress(10, "extracting columns")
+        # Changing the columns replays the sort, classification and asset codes after it
+        try:
+            df, dropped = run_step(sid, "extract", {"columns": columns_selected}, progress)
+        except StepError as e:
+            progress(100, "failed")
+            return html.Div(f"Error extracting the columns: {step_error_message(e.error)}"), dash.no_update
+        except db.database_errors() as e:
+            progress(100, "failed")
+            return html.Div(database_error_message(sid, "extract", e)), dash.no_update
+
+        progress(90, "drawing table")
+        table = make_data_table("copied-data-table", df)
+        progress(100, "done")
+        return table, pipeline_changed("copied-data-table", dropped)
+    return html.Div(), dash.no_update
 
 @app.callback(
-    Output("sorted-data-table-container", "children"),
+    [Output("sorted-data-table-container", "children"),
+     Output("pipeline-version", "data", allow_duplicate=True)],
     [Input("sort-button", "n_clicks")],
     [
         State("column-dropdown", "value"),
         State("sort-order", "value"),
+        State("session-key", "data"),
     ],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("sort-button", pipeline_step=True),
+    prevent_initial_call=True,
 )
-def sort_data(n_clicks, selected_columns, order):
-    global latest_table_data  # Access global variable to store the DataFrame
-    if session.get('logged_in'):
-        if n_clicks > 0 and latest_table_data is not None:
-            df = latest_table_data.copy()  # Make a copy of the DataFrame to avoid modifying the original
-
-            if selected_columns and order != "none":
-                # Convert selected columns to numeric if possible
-                df[selected_columns] = df[selected_columns].apply(pd.to_numeric, errors="ignore")
-
-                # Sort the DataFrame based on the selected columns and order
-                df = df.sort_values(by=selected_columns, ascending=(order == "asc"))
-
-            # Group the data by the selected columns and add summary rows
-            grouped = df.groupby(selected_columns)
-            new_rows = []
-            for group_key, group in grouped:
-                new_rows.append(group)
-                if any(group.duplicated(subset=selected_columns)):
-                    empty_row = {col: "" for col in df.columns}
-                    # Convert "Quantity" column to numeric
-                    group["Quantity"] = pd.to_numeric(group["Quantity"], errors="coerce")
-                    empty_row["Quantity"] = group["Quantity"].sum()
-                    new_row = pd.DataFrame([empty_row])
-                    for col in group.columns:
-                        if col not in ["Asset Code", "Quantity"]:
-                            new_row[col] = group.iloc[0][col]
-                    new_rows.append(new_row)
-            df = pd.concat(new_rows).reset_index(drop=True)
-            latest_table_data = df
-
-            return dash_table.DataTable(
-                data=df.to_dict("records"),
-                columns=[{"name": i, "id": i} for i in df.columns],
-                id="sorted-data-table",
-                page_current=0,
-                page_size=30,
-                page_action="native",
-                style_cell={
-                    'fontFamily': 'Arial, sans-serif',
-                    'fontSize': '14px',
-                    'textAlign': 'left',
-                    'padding': '10px',
-                },
-                style_header={
-                    'backgroundColor': '#0074D9',
-                    'color': 'white',
-                    'fontWeight': 'bold',
-                    'fontSize': '16px'
-                },
-                style_table={ 
-                    "overflowY": "auto",  # Enable vertical scrolling
-                    "maxHeight": "400px",  # Set a maximum height for the table container
-                    "margin": "10px 0"
-                },  # Add some margin
-            )
-        return dash_table.DataTable()
-    return html.Div()
+def sort_data(set_progress, n_clicks, selected_columns, order, session_key):
+    sid = job_session(session_key)
+    if sid:
+        if n_clicks > 0 and operation_log.steps(sid):
+            progress = JobProgress(set_progress, "Sort Data")
+            progress(10, "sorting")
+            # Sort and add a summary row after each group of the selected columns
+            try:
+                df, dropped = run_step(sid, "sort", {"selected_columns": selected_columns, "order": order},
+                                       progress)
+            except StepError as e:
+                progress(100, "failed")
+                return html.Div(f"Error sorting the data: {step_error_message(e.error)}"), dash.no_update
+            except db.database_errors() as e:
+                progress(100, "failed")
+                return html.Div(database_error_message(sid, "sort", e)), dash.no_update
+
+            progress(90, "drawing table")
+            table = make_data_table("sorted-data-table", df)
+            progress(100, "done")
+            return table, pipeline_changed("sorted-data-table", dropped)
+        return dash_table.DataTable(), dash.no_update
+    return html.Div(), dash.no_update
 
 @app.callback(
     Output("update-list-container", "children"),
@@ -416,23 +1166,32 @@ def sort_data(n_clicks, selected_columns, order):
 )
 def add_to_update_list(n_clicks, group, classification_value):
     """ Add selected group and classification value to the update list """
-    global update_list
     if session.get('logged_in'):
         if n_clicks > 0 and group and classification_value:
-            update_list.append({"Group": group, "Classification": classification_value})
+            sid = session_id()
+            table_store.update_state(sid, update_list=table_store.get_state(sid).get('update_list', []) + [
+                {"Group": group, "Classification": classification_value}
+            ])
             return f"Added: {group} - {classification_value} to the update list."
         return ""
     return html.Div()
 
 @app.callback(
-    [Output("login-button", "style"), Output("logout-button", "style"), Output("message", "children")],
+    [Output("login-button", "style"), Output("logout-button", "style"), Output("message", "children"),
+     Output("session-key", "data")],
     [Input("login-button", "n_clicks"), Input("logout-button", "n_clicks")],
     [State("username", "value"), State("password", "value")]
 )
 def handle_login_logout(login_n_clicks, logout_n_clicks, username, password):
     ctx = dash.callback_context
     if not ctx.triggered:
-        return {}, {}, "Please log in to upload files!"
+        if session.get('logged_in'):
+            # The page was reloaded: the session-key store starts out empty, so hand it out again
+            username = session.get('username')
+            table_store.update_state(session_id(), logged_in_as=username)
+            return ({"display": "none"}, {"display": "inline"}, f"Welcome back {username}!",
+                    session_keys.dumps(session_id()))
+        return {}, {}, "Please log in to upload files!", None
 
     button_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
@@ -440,148 +1199,243 @@ def handle_login_logout(login_n_clicks, logout_n_clicks, username, password):
         if authenticate_user(username, password):
             session['logged_in'] = True
             session['username'] = username
-            return {"display": "none"}, {"display": "inline"}, f"Welcome {username}! 😎"
+            table_store.update_state(session_id(), logged_in_as=username)
+            return ({"display": "none"}, {"display": "inline"}, f"Welcome {username}! 😎",
+                    session_keys.dumps(session_id()))
         else:
-            return {"display": "flex"}, {"display": "none"}, "Invalid username or password"
+            return {"display": "flex"}, {"display": "none"}, "Invalid username or password", None
     elif button_id == "logout-button" and logout_n_clicks > 0:
         session.pop('logged_in', None)
         session.pop('username', None)
+        table_store.clear_session(session_id())
+        value_indexes.clear_session(session_id())
+        shutil.rmtree(export_directory(session_id()), ignore_errors=True)
         # Clear tasks and delete uploaded files
         if os.path.exists(UPLOAD_DIRECTORY):
             for file in os.listdir(UPLOAD_DIRECTORY):
                 os.remove(os.path.join(UPLOAD_DIRECTORY, file))
+        parse_cache.clear()
         # Refresh the page
-        return {"display": "flex"}, {"display": "none"}, dcc.Location(href="/", id="refresh-page", refresh=True)
-    return {}, {}, ""
+        return {"display": "flex"}, {"display": "none"}, dcc.Location(href="/", id="refresh-page", refresh=True), None
+    return {}, {}, "", dash.no_update
 
 @app.callback(
-    Output("updated-group-table-container", "children"),
-    Input("update-group-button", "n_clicks")
+    [Output("updated-group-table-container", "children"),
+     Output("update-list-container", "children", allow_duplicate=True),
+     Output("pipeline-version", "data", allow_duplicate=True),
+     Output("rendered-steps", "data", allow_duplicate=True)],
+    Input("update-group-button", "n_clicks"),
+    [State("rendered-steps", "data"), State("session-key", "data")],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("update-group-button", pipeline_step=True),
+    prevent_initial_call=True,
 )
-def update_group(n_clicks):
+def update_group(set_progress, n_clicks, rendered, session_key):
     """ Update all entries in the update list at once """
-    global latest_table_data
-    if session.get('logged_in'):
-        if latest_table_data is not None and n_clicks > 0 and update_list:
-            df = latest_table_data  # Make a copy of the latest data
-            for update in update_list:
-                group = update["Group"]
-                classification = update["Classification"]
-                df.loc[df["Site"] == group, "Group.1"] = classification
-                df["Group.1"] = df["Group.1"].fillna("")  # Fill NaNs with empty strings
-
-                # Save the latest table ID and data for use in subsequent updates
-                latest_table_data = df  # Update latest_table_data with the modified DataFrame
+    # Anything but the updated table replaces the one on screen, so the next update can't patch it
+    not_shown = forget_rendered("updated-group-table")
+    sid = job_session(session_key)
+    if sid:
+        update_list = table_store.get_state(sid).get('update_list', [])
+        if operation_log.steps(sid) and n_clicks > 0 and update_list:
+            progress = JobProgress(set_progress, "Update Group")
+            progress(10, f"classifying {len(update_list)} sites")
+            # Apply the whole queue as one Site -> classification mapping
+            try:
+                _, dropped = run_step(sid, "classify", {"updates": update_list}, progress)
+            except StepError as e:
+                progress(100, "failed")
+                return (html.Div(f"Error updating the groups: {step_error_message(e.error)}"), dash.no_update,
+                        dash.no_update, not_shown)
+            except db.database_errors() as e:
+                progress(100, "failed")
+                return (html.Div(database_error_message(sid, "classify", e)), dash.no_update, dash.no_update,
+                        not_shown)
 
             # Clear the update list after processing
-            update_list.clear()
-
-            return [
-                dash_table.DataTable(
-                    data=df.to_dict("records"),
-                    columns=[{"name": i, "id": i} for i in df.columns],
-                    id="updated-group-table",
-                    page_current=0,
-                    page_size=10,
-                    page_action="native",
-                    style_cell={
-                        'fontFamily': 'Arial, sans-serif',
-                        'fontSize': '14px',
-                        'textAlign': 'left',
-                        'padding': '10px',
-                    },
-                    style_header={
-                        'backgroundColor': '#0074D9',
-                        'color': 'white',
-                        'fontWeight': 'bold',
-                        'fontSize': '16px'
-                    },
-                    style_table={
-                        "overflowY": "auto",  # Enable vertical scrolling
-                        "maxHeight": "400px",  # Set a maximum height for the table container
-                        "margin": "10px 0"
-                    },  # Add some margin
-                ),
-                html.Div(f"Updated {len(update_list)} entries.")
-            ]
-        return html.Div()
-    return html.Div() 
+            table_store.update_state(sid, update_list=[])
+
+            progress(90, "updating table")
+            # Only the changed cells are sent when the earlier classification is on screen
+            table = step_table_update(sid, "updated-group-table", (rendered or {}).get("updated-group-table"))
+            progress(100, "done")
+            return (table, f"Updated {len(update_list)} entries.", pipeline_changed("updated-group-table", dropped),
+                    dash.no_update)
+        return html.Div(), dash.no_update, dash.no_update, not_shown
+    return html.Div(), dash.no_update, dash.no_update, not_shown
 
 @app.callback(
-    Output("updated-asset-table-container", "children"),
+    [Output("updated-asset-table-container", "children"),
+     Output("pipeline-version", "data", allow_duplicate=True),
+     Output("rendered-steps", "data", allow_duplicate=True)],
     [Input("update-asset-codes-button", "n_clicks")],
     [State("first-blank-row-input", "value"),
-     State("asset-dropdown", "value")]
+     State("asset-dropdown", "value"),
+     State("rendered-steps", "data"),
+     State("session-key", "data")],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("update-asset-codes-button", pipeline_step=True),
+    prevent_initial_call=True,
 )
-def update_asset_codes(n_clicks, first_blank_row, asset_columns):
-    global latest_table_data
-    if session.get('logged_in'):
-        if n_clicks > 0 and latest_table_data is not None:
-            df = latest_table_data.copy()  # Make a copy of the latest table data to avoid modifying the original
-            base_code = first_blank_row[:-3]  # Extract the base part of the code
-            start_number = int(first_blank_row[-3:])  # Extract the starting number
-            blank_rows = df[df["Asset Code"] == ""].index
-
-            if not blank_rows.empty:
-                for i, idx in enumerate(blank_rows):
-                    df.loc[idx, "Asset Code"] = f"{base_code}{str(start_number + i).zfill(3)}"
-
-            # Group the data by the selected columns
-            grouped = df.groupby(asset_columns)
-            for group_key, group in grouped:
-                if group['Asset Code'].str.startswith(base_code).any():
-                    asset_code_value = group.loc[group['Asset Code'].str.startswith(base_code), 'Asset Code'].iloc[0]
-                    # Create a condition to match the group_key tuple
-                    condition = df.apply(lambda row: all(row[col] == key for col, key in zip(asset_columns, group_key)), axis=1)
-                    df.loc[condition, 'Group Lead?'] = asset_code_value
-            
-            # Save the latest table ID and data for use in subsequent updates
-            latest_table_data = df  # Update latest_table_data with the modified DataFrame
-            return dash_table.DataTable(
-                data=df.to_dict("records"),
-                columns=[{"name": i, "id": i} for i in df.columns],
-                id="asset-data-table",
-                page_current=0,
-                page_size=10,
-                page_action="native",
-                style_cell={
-                    'fontFamily': 'Arial, sans-serif',
-                    'fontSize': '14px',
-                    'textAlign': 'left',
-                    'padding': '10px',
-                },
-                style_header={
-                    'backgroundColor': '#0074D9',
-                    'color': 'white',
-                    'fontWeight': 'bold',
-                    'fontSize': '16px'
-                },
-                style_table={
-                    "overflowY": "auto",  # Enable vertical scrolling
-                    "maxHeight": "400px",  # Set a maximum height for the table container
-                    "margin": "10px 0"
-                },  # Add some margin
-            )
-        return dash_table.DataTable()
-    return html.Div()
+def update_asset_codes(set_progress, n_clicks, first_blank_row, asset_columns, rendered, session_key):
+    # As in update_group, only the updated table can be patched next time
+    not_shown = forget_rendered("asset-data-table")
+    sid = job_session(session_key)
+    if sid:
+        if n_clicks > 0 and operation_log.steps(sid):
+            progress = JobProgress(set_progress, "Update Asset Codes")
+            try:
+                parse_code(first_blank_row)
+            except ValueError as e:
+                progress(100, "failed")
+                return html.Div(str(e)), dash.no_update, not_shown
+            progress(10, "assigning codes")
+            # Number the blank codes from a reserved range and mark the lead code of each asset group
+            try:
+                run_step(sid, "asset_codes", {"first_blank_row": first_blank_row, "asset_columns": asset_columns},
+                         progress)
+            except StepError as e:
+                progress(100, "failed")
+                return (html.Div(f"Error updating the asset codes: {step_error_message(e.error)}"), dash.no_update,
+                        not_shown)
+            except db.database_errors() as e:
+                progress(100, "failed")
+                return html.Div(database_error_message(sid, "asset_codes", e)), dash.no_update, not_shown
+
+            progress(90, "updating table")
+            table = step_table_update(sid, "asset-data-table", (rendered or {}).get("asset-data-table"))
+            progress(100, "done")
+            return table, pipeline_changed("asset-data-table"), dash.no_update
+        return dash_table.DataTable(), dash.no_update, not_shown
+    return html.Div(), dash.no_update, not_shown
+
 @app.callback(
-    Output("download-data-link", "data"),
-    Input("download-excel-button", "n_clicks")
+    [Output("pipeline-version", "data", allow_duplicate=True), Output("undo-status", "children")],
+    [Input("undo-button", "n_clicks"), Input("redo-button", "n_clicks")],
+    State("session-key", "data"),
+    prevent_initial_call=True,
 )
+def undo_redo(undo_n_clicks, redo_n_clicks, session_key):
+    """ Step back or forward through the versions of the pipeline """
+    sid = job_session(session_key)
+    if not sid:
+        return dash.no_update, ""
+    button_id = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
+    try:
+        moved = operation_log.undo(sid) if button_id == "undo-button" else operation_log.redo(sid)
+    except SessionBusy:
+        # Waiting for the step would hold up this web worker until it is done
+        return dash.no_update, "A step is still running, try again when it is done."
+    return (pipeline_changed() if moved else dash.no_update), ""
 
-def download_data(n_clicks):
-    global latest_table_data
-    if session.get('logged_in'):
-        if n_clicks > 0 and latest_table_data is not None:
-            ctx = dash.callback_context
-            if not ctx.triggered:
-                return None
-
-            button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-            if button_id == 'download-excel-button':
-                df = latest_table_data
-                return dcc.send_data_frame(df.to_excel, "updated_data.xlsx", index=False)
-    return None
+@app.callback(
+    [Output("operation-log", "children"), Output("rendered-steps", "data")]
+    + [Output(container, "children", allow_duplicate=True) for container in STEP_CONTAINERS.values()],
+    Input("pipeline-version", "data"),
+    [State("rendered-steps", "data"), State("session-key", "data")],
+    prevent_initial_call=True,
+)
+def render_pipeline(version, rendered, session_key):
+    """ Update the tables of the steps that changed, e.g. after a replay or undo """
+    sid = job_session(session_key)
+    if not sid or not version:
+        return [[], {}] + [dash.no_update] * len(STEP_CONTAINERS)
+    steps = {OPERATION_TABLES[step["op"]]: step["table"] for step in operation_log.steps(sid)}
+    containers = []
+    dropped = version.get("dropped") or {}
+    for table_id in STEP_CONTAINERS:
+        if table_id in dropped and table_id not in steps:
+            # The replay stopped at this step
+            containers.append(html.Div(dropped[table_id]))
+        elif table_id == version.get("shown") or steps.get(table_id) == (rendered or {}).get(table_id):
+            containers.append(dash.no_update)
+        elif table_id in steps:
+            containers.append(step_table_update(sid, table_id, (rendered or {}).get(table_id)))
+        else:
+            containers.append(html.Div())
+    log = [html.Li(line) for line in operation_log.describe(sid)]
+    return [log, steps] + containers
+# Write the latest table to a file in the chosen format and hand back a link to download it
+@app.callback(
+    Output("export-status", "children"),
+    Input("download-excel-button", "n_clicks"),
+    [State("export-format", "value"),
+     State("session-key", "data")],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("download-excel-button"),
+    prevent_initial_call=True,
+)
+def export_data(set_progress, n_clicks, export_format, session_key):
+    sid = job_session(session_key)
+    if not sid or not n_clicks:
+        return dash.no_update
+    df = get_latest_table(sid)
+    if df is None:
+        return html.Div("Load a table first.")
+    export_format = export_format if export_format in export.EXPORT_FORMATS else "xlsx"
+    progress = JobProgress(set_progress, "Download Data")
+    progress(5, "writing file")
+    directory = export_directory(sid)
+    os.makedirs(directory, exist_ok=True)
+    # Only the latest export of a session is kept
+    for old_file in os.listdir(directory):
+        os.remove(os.path.join(directory, old_file))
+    file_name = f"{uuid.uuid4().hex}.{export_format}"
+    try:
+        rows = export.export_file(
+            df, export_format, os.path.join(directory, file_name),
+            progress=lambda done, total: progress(5 + int(90 * done / max(total, 1)), f"wrote {done:,} rows"),
+        )
+    except (OSError, ValueError, TypeError) as e:
+        progress(100, "failed")
+        return html.Div(f"Error exporting the data: {e}")
+    progress(100, "done")
+    _, extension = export.EXPORT_FORMATS[export_format]
+    return html.Div([f"Exported {rows:,} rows: ",
+                     html.A("updated_data" + extension, href=f"/export/file/{file_name}")])
+
+# Save the latest table to Postgres; COPY streams the rows, so large tables save in seconds
+@app.callback(
+    Output("save-db-status", "children"),
+    Input("save-db-button", "n_clicks"),
+    [State("save-table-name", "value"),
+     State("save-mode", "value"),
+     State("session-key", "data")],
+    background=True,
+    progress=JOB_PROGRESS,
+    cancel=[Input("cancel-job-button", "n_clicks")],
+    running=job_running("save-db-button"),
+    prevent_initial_call=True,
+)
+def save_to_database(set_progress, n_clicks, table_name, save_mode, session_key):
+    sid = job_session(session_key)
+    if not sid or not n_clicks:
+        return dash.no_update
+    df = get_latest_table(sid)
+    if df is None:
+        return html.Div("Load a table first.")
+    progress = JobProgress(set_progress, "Save to Database")
+    progress(5, "copying rows")
+    try:
+        report = db_save.save_table(
+            df, (table_name or "").strip(), DB_CONFIG, mode=save_mode or "upsert",
+            progress=lambda sent, total: progress(5 + int(85 * sent / max(total, 1)), f"copied {sent:,} rows"),
+        )
+    except Exception as e:
+        progress(100, "failed")
+        return html.Div(f"Error saving to the database: {e}")
+    progress(100, "done")
+    summary = f"Saved {report['rows']:,} rows to {report['table']} in {report['seconds']:.1f}s ({report['rows_per_second']:,.0f} rows/s)"
+    if report["mode"] == "upsert":
+        summary += (f": {report['inserted']:,} inserted, {report['updated']:,} updated, "
+                    f"{report['unchanged']:,} unchanged, {report['skipped']:,} skipped")
+    return html.Div(summary + ".")
 
 # Callback to delete uploaded files when the app is closed or refreshed
 @app.callback(
@@ -599,7 +1453,17 @@ def delete_uploaded_files(style):
                     os.unlink(file_path)
             except Exception as e:
                 print(f"Error deleting file {file_path}: {e}")
+        parse_cache.clear()
     return None
 
+def warm_up():
+    """ Do the setup Dash leaves to the first request: checking the layout and callbacks, listing assets
+
+    gunicorn.conf.py runs this in the master when the app is preloaded, so
+    the workers forked from it start with it done and share its memory.
+    """
+    with server.app_context():
+        app._setup_server()
+
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
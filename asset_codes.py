@@ -0,0 +1,101 @@
+""" Asset codes: parsing, vectorized formatting and collision-free allocation from Postgres
+
+A code is a prefix followed by a zero-padded number, e.g. "ABC001".  The
+allocator keeps the next free number of every prefix in a counter table and
+reserves a whole range of numbers with one statement, so users numbering
+the same prefix at the same time never get the same codes.
+"""
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+import db
+
+COUNTER_TABLE = "asset_code_counters"
+
+# CREATE TABLE IF NOT EXISTS can still fail when two sessions run it at
+# once, so it waits for a transaction-level advisory lock first
+CREATE_COUNTER_TABLE = f"""
+SELECT pg_advisory_xact_lock(hashtext('{COUNTER_TABLE}'));
+CREATE TABLE IF NOT EXISTS {COUNTER_TABLE} (
+    prefix text PRIMARY KEY,
+    next_number bigint NOT NULL
+)
+"""
+
+# The upsert locks the prefix's row until the transaction commits, so
+# concurrent reservations of one prefix are applied one after another
+RESERVE_RANGE = f"""
+INSERT INTO {COUNTER_TABLE} AS counter (prefix, next_number)
+VALUES (%(prefix)s, %(start)s + %(count)s)
+ON CONFLICT (prefix) DO UPDATE
+    SET next_number = GREATEST(counter.next_number, %(start)s) + %(count)s
+RETURNING next_number - %(count)s
+"""
+
+_CODE_PATTERN = re.compile(r"^(.*?)(\d+)$", re.DOTALL)
+
+
+def parse_code(code):
+    """ Split a code into (prefix, number, width), e.g. "ABC001" -> ("ABC", 1, 3) """
+    match = _CODE_PATTERN.match(str(code or "").strip())
+    if match is None:
+        raise ValueError(f"Asset code {code!r} doesn't end in a number, e.g. ABC001")
+    return match.group(1), int(match.group(2)), len(match.group(2))
+
+
+def format_codes(prefix, first_number, count, width):
+    """ count consecutive codes from first_number, as an object array
+
+    Numbers are zero-padded to width digits and simply grow longer past it,
+    so "ABC999" is followed by "ABC1000".
+    """
+    numbers = pd.Series(np.arange(first_number, first_number + count, dtype=np.int64)).astype(str).str.zfill(width)
+    return (prefix + numbers).to_numpy(dtype=object)
+
+
+class CodeAllocator:
+    """ Hands out ranges of asset code numbers per prefix from a Postgres counter table
+
+    reserve() is a single round trip that returns the first number of the
+    range; the numbers are never handed out again, even when the codes end
+    up unused.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._table_ready = False
+        self._lock = threading.Lock()
+
+    def ensure_table(self):
+        with self._lock:
+            if self._table_ready:
+                return
+            with db.connection(self.config) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(CREATE_COUNTER_TABLE)
+                conn.commit()
+            self._table_ready = True
+
+    def reserve(self, prefix, count, start=1):
+        """ Reserve count numbers for prefix, none below start; returns the first one """
+        if count <= 0:
+            raise ValueError("count must be positive")
+        self.ensure_table()
+        with db.connection(self.config) as conn:
+            with conn.cursor() as cur:
+                cur.execute(RESERVE_RANGE, {"prefix": prefix, "start": int(start), "count": int(count)})
+                first_number = cur.fetchone()[0]
+            conn.commit()
+        return first_number
+
+    def reserve_codes(self, first_code, count):
+        """ Reserve count codes shaped like first_code, e.g. "ABC001"; returns the first code of the range
+
+        The range starts at first_code's number, or at the prefix's next
+        free number when that is higher.
+        """
+        prefix, start, width = parse_code(first_code)
+        return format_codes(prefix, self.reserve(prefix, count, start), 1, width)[0]
@@ -0,0 +1,105 @@
+// Streams files dropped on or selected in the upload box to /upload/<id> in
+// chunks, instead of letting dcc.Upload read the whole file into a base64
+// string. Once the last chunk of every file is stored the server's file
+// references are put into the "uploaded-file-ref" store, which triggers the
+// upload_file callback.
+(function () {
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+    var UPLOAD_BOX_ID = "upload-data";
+
+    // Stable id for a file so an interrupted upload can be resumed
+    function uploadId(file) {
+        var hash = 2166136261;
+        for (var i = 0; i < file.name.length; i++) {
+            hash ^= file.name.charCodeAt(i);
+            hash = Math.imul(hash, 16777619) >>> 0;
+        }
+        return hash.toString(16) + "-" + file.size + "-" + file.lastModified;
+    }
+
+    function setStatus(text) {
+        var status = document.getElementById("output-data-upload");
+        if (status) {
+            status.textContent = text;
+        }
+    }
+
+    async function uploadFile(file) {
+        var url = "/upload/" + uploadId(file);
+        var response = await fetch(url, {credentials: "same-origin"});
+        if (!response.ok) {
+            throw new Error((await response.json()).error || response.statusText);
+        }
+        var offset = (await response.json()).offset;
+
+        while (true) {
+            var end = Math.min(offset + CHUNK_SIZE, file.size);
+            response = await fetch(url + "?filename=" + encodeURIComponent(file.name), {
+                method: "PUT",
+                credentials: "same-origin",
+                headers: {"Content-Range": "bytes " + offset + "-" + (end - 1) + "/" + file.size},
+                body: file.slice(offset, end),
+            });
+            var result = await response.json();
+            if (response.status === 409) {
+                offset = result.offset;  // Server has a different offset, carry on from there
+                continue;
+            }
+            if (!response.ok) {
+                throw new Error(result.error || response.statusText);
+            }
+            if (result.file) {
+                return result;
+            }
+            offset = result.offset;
+            setStatus("Uploading " + file.name + ": " + Math.floor(100 * offset / file.size) + "%");
+        }
+    }
+
+    async function uploadAll(files) {
+        var fileRefs = [];
+        for (var i = 0; i < files.length; i++) {
+            var file = files[i];
+            if (!file.size) {
+                throw new Error("cannot upload an empty file: " + file.name);
+            }
+            setStatus("Uploading " + file.name + " (" + (i + 1) + " of " + files.length + ")...");
+            fileRefs.push(await uploadFile(file));
+        }
+        return fileRefs;
+    }
+
+    function handleFiles(files) {
+        files = Array.prototype.slice.call(files || []);
+        if (!files.length) {
+            return;
+        }
+        uploadAll(files).then(function (fileRefs) {
+            window.dash_clientside.set_props("uploaded-file-ref", {data: fileRefs});
+        }).catch(function (error) {
+            setStatus("Upload failed: " + error.message);
+        });
+    }
+
+    function insideUploadBox(target) {
+        var box = document.getElementById(UPLOAD_BOX_ID);
+        return box && box.contains(target);
+    }
+
+    // Capture phase, so these run before dcc.Upload's own handlers and can stop them
+    window.addEventListener("drop", function (event) {
+        if (insideUploadBox(event.target)) {
+            event.preventDefault();
+            event.stopPropagation();
+            handleFiles(event.dataTransfer.files);
+        }
+    }, true);
+
+    window.addEventListener("change", function (event) {
+        if (event.target.type === "file" && insideUploadBox(event.target)) {
+            event.stopPropagation();
+            handleFiles(event.target.files);
+            event.target.value = "";
+        }
+    }, true);
+})();
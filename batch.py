@@ -0,0 +1,242 @@
+""" Run the table pipeline over a directory of workbooks without the web UI
+
+    python batch.py spec.json registers/ output/ --workers 8
+
+The spec is a JSON object:
+
+    {
+        "sheet": "Sheet1",              # sheet name or index, first sheet by default
+        "header_row": 0,
+        "columns": ["Site", ...],       # columns to load, all by default
+        "steps": [
+            {"op": "extract", "params": {"columns": [...]}},
+            {"op": "sort", "params": {"selected_columns": ["Site"], "order": "asc"}},
+            {"op": "classify", "params": {"updates": [{"Group": "S001", "Classification": "A"}]}},
+            {"op": "asset_codes", "params": {"first_blank_row": "ABC001", "asset_columns": ["Site"]}}
+        ],
+        "export": "xlsx",               # xlsx, csv or parquet
+        "chunk_rows": 100000            # process files a chunk at a time (see chunked.py), whole by default
+    }
+
+Steps run the same functions as the buttons of the app.  Every file is
+processed in its own worker process and the report lists how long each
+file and step took.  With chunk_rows set, files are streamed through the
+steps instead of loaded whole, for registers larger than a worker's
+memory; the report then times the whole run as one "chunked" step.
+
+Blank asset codes are numbered from ranges reserved in the database's
+counter table (see asset_codes.CodeAllocator), like the app does, so a
+batch never hands out codes the app or another batch already has.  The
+database is the one in config.py.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import chunked
+import export
+import readers
+from asset_codes import CodeAllocator
+from pipeline import OPERATIONS
+from schema import normalize_dtypes
+from transforms import blank_codes
+
+
+def load_spec(spec):
+    """ Check a pipeline spec (a dict or the path of a JSON file) and fill in defaults """
+    if isinstance(spec, str):
+        with open(spec) as f:
+            spec = json.load(f)
+    if not isinstance(spec, dict):
+        raise ValueError("The pipeline spec must be a JSON object")
+    spec = {"sheet": None, "header_row": 0, "columns": None, "steps": [], "export": "xlsx", "chunk_rows": None, **spec}
+    for step in spec["steps"]:
+        if step.get("op") not in OPERATIONS:
+            raise ValueError(f"Unknown operation {step.get('op')!r}, expected one of {sorted(OPERATIONS)}")
+        step.setdefault("params", {})
+    if spec["export"] not in export.WRITERS:
+        raise ValueError(f"Unsupported export format: {spec['export']}")
+    if spec["chunk_rows"] is not None and (not isinstance(spec["chunk_rows"], int) or spec["chunk_rows"] < 1):
+        raise ValueError("chunk_rows must be a positive number of rows")
+    return spec
+
+
+def list_workbooks(input_dir):
+    """ The workbooks and CSV files directly inside input_dir, by name """
+    return sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if (readers.is_excel(name) or readers.is_csv(name)) and not name.startswith("~$")
+    )
+
+
+def _timed(timings, name, fn, *args, **kwargs):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = fn(*args, **kwargs)
+    timings.append({
+        "step": name,
+        "seconds": round(time.perf_counter() - wall, 4),
+        "cpu_seconds": round(time.process_time() - cpu, 4),
+    })
+    return result
+
+
+def reserve_codes(allocator, df, params):
+    """ The params of an asset codes step, numbering df's blank codes from a newly reserved range """
+    count = int(blank_codes(df).sum())
+    if not count:
+        return params
+    return {**params, "first_blank_row": allocator.reserve_codes(params["first_blank_row"], count)}
+
+
+def run_file(file_path, spec, output_dir, db_config=None):
+    """ Load one file, apply the spec's steps and export the result; returns its report
+
+    Asset codes are reserved in the database of db_config.  Without one they
+    are numbered from the spec's first code as they are, which is only
+    meant for benchmarks and trials, as the codes can collide with issued ones.
+    """
+    started = time.perf_counter()
+    timings = []
+    report = {"file": os.path.basename(file_path), "steps": timings}
+    allocator = CodeAllocator(db_config) if db_config is not None else None
+    try:
+        extension = export.EXPORT_FORMATS[spec["export"]][1]
+        output_path = os.path.join(output_dir, os.path.splitext(report["file"])[0] + extension)
+        if spec["chunk_rows"]:
+            rows = _timed(timings, "chunked", chunked.run_chunked, file_path, spec, output_path, spec["chunk_rows"],
+                          allocator=allocator)
+        else:
+            df = _timed(timings, "load", readers.read_table, file_path, spec["sheet"], spec["header_row"], spec["columns"])
+            df = _timed(timings, "normalize", normalize_dtypes, df)
+            for step in spec["steps"]:
+                params = step["params"]
+                if step["op"] == "asset_codes" and allocator is not None:
+                    params = _timed(timings, "reserve_codes", reserve_codes, allocator, df, params)
+                df = _timed(timings, step["op"], OPERATIONS[step["op"]], df, **params)
+            _timed(timings, "export", export.WRITERS[spec["export"]], df, output_path)
+            rows = len(df)
+        report.update(status="ok", rows=rows, output=output_path)
+    except Exception as e:
+        report.update(status="error", error=f"{type(e).__name__}: {e}")
+    report["seconds"] = round(time.perf_counter() - started, 4)
+    return report
+
+
+def run_batch(input_dir, spec, output_dir, workers=None, on_report=None, mp_context=None, db_config=None):
+    """ Run spec over every workbook in input_dir on a pool of worker processes
+
+    on_report, when given, is called with each file's report as soon as
+    that file is done.  db_config is the database asset codes are reserved
+    in (see run_file).  Returns the batch report.
+    """
+    spec = load_spec(spec)
+    files = list_workbooks(input_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    reports = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        futures = [pool.submit(run_file, file_path, spec, output_dir, db_config) for file_path in files]
+        for future in as_completed(futures):
+            reports.append(future.result())
+            if on_report is not None:
+                on_report(reports[-1])
+    reports.sort(key=lambda report: report["file"])
+    return {
+        "files": len(files),
+        "succeeded": sum(report["status"] == "ok" for report in reports),
+        "failed": sum(report["status"] != "ok" for report in reports),
+        "seconds": round(time.perf_counter() - started, 4),
+        "reports": reports,
+    }
+
+
+def resolve_dir(root, relative):
+    """ Join a client-supplied directory onto root, refusing paths that leave it """
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, relative))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"{relative!r} is outside the batch directory")
+    return path
+
+
+def worker_count(value):
+    """ The number of worker processes a client asked for, between 1 and the number of CPUs
+
+    None asks for the default, one per CPU.
+    """
+    if value is None:
+        return None
+    # bool is an int too, and int() would quietly round 2.5 or parse "8"
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"workers must be a whole number, not {value!r}")
+    return min(max(value, 1), os.cpu_count() or 1)
+
+
+def write_report(path, value):
+    """ Atomically replace the JSON report at path """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def run_batch_to_file(input_dir, spec, output_dir, report_path, workers=None, db_config=None):
+    """ run_batch, keeping report_path up to date so any web worker can show the progress
+
+    The caller writes the first "running" report, so the batch can be polled
+    as soon as it has been started.
+    """
+    import multiprocessing
+
+    done = []
+
+    def on_report(report):
+        done.append(report)
+        write_report(report_path, {"status": "running", "reports": done})
+
+    try:
+        # Forking a threaded web worker can deadlock, so start fresh processes
+        result = run_batch(input_dir, spec, output_dir, workers, on_report, multiprocessing.get_context("spawn"),
+                           db_config)
+        write_report(report_path, {"status": "done", **result})
+    except Exception as e:
+        write_report(report_path, {"status": "error", "error": str(e), "reports": done})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the table pipeline over a directory of workbooks")
+    parser.add_argument("spec", help="pipeline spec, a JSON file")
+    parser.add_argument("input_dir", help="directory holding the workbooks")
+    parser.add_argument("output_dir", help="directory for the exported results")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--report", help="also write the report as JSON to this file")
+    parser.add_argument("--chunk-rows", type=int, default=None,
+                        help="stream files through the steps this many rows at a time (overrides the spec)")
+    args = parser.parse_args(argv)
+
+    spec = load_spec(args.spec)
+    if args.chunk_rows:
+        spec["chunk_rows"] = args.chunk_rows
+    db_config = None
+    if any(step["op"] == "asset_codes" for step in spec["steps"]):
+        from config import DB_CONFIG as db_config
+
+    def print_report(report):
+        detail = f"{report['rows']} rows" if report["status"] == "ok" else report["error"]
+        steps = ", ".join(f"{timing['step']} {timing['seconds']:.2f}s" for timing in report["steps"])
+        print(f"{report['file']}: {report['status']} in {report['seconds']:.2f}s ({detail}) [{steps}]", flush=True)
+
+    result = run_batch(args.input_dir, spec, args.output_dir, args.workers, on_report=print_report,
+                       db_config=db_config)
+    print(f"{result['succeeded']}/{result['files']} files done in {result['seconds']:.2f}s")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(result, f, indent=2)
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
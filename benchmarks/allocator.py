@@ -0,0 +1,127 @@
+""" Benchmark reserving asset code ranges from Postgres, and check that concurrent ranges never overlap
+
+    python -m benchmarks.allocator --dsn "host=localhost dbname=assets user=app" --codes 1k,10k --workers 8
+
+Every worker thread reserves --calls ranges of each size for one prefix,
+all at the same time; the report gives reservations and codes per second
+and the time to format the codes of one range.  The counter of the
+benchmark prefix is removed afterwards.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from asset_codes import COUNTER_TABLE, CodeAllocator, format_codes
+from benchmarks.run import parse_size
+
+
+def run_size(allocator, prefix, count, calls, workers):
+    """ Reserve calls ranges of count codes on workers threads; returns timings and the ranges """
+    ranges = []
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = threading.Barrier(workers)
+
+    def work(share):
+        start.wait()
+        for _ in range(share):
+            started = time.perf_counter()
+            try:
+                first = allocator.reserve(prefix, count)
+            except Exception as e:
+                with lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+                continue
+            elapsed = time.perf_counter() - started
+            with lock:
+                ranges.append((first, first + count))
+                latencies.append(elapsed)
+
+    shares = [calls // workers + (i < calls % workers) for i in range(workers)]
+    threads = [threading.Thread(target=work, args=(share,)) for share in shares]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    if not ranges:
+        raise RuntimeError(f"Every reservation failed, e.g. {errors[0]}")
+
+    started = time.perf_counter()
+    format_codes(prefix, ranges[0][0], count, 3)
+    format_seconds = time.perf_counter() - started
+
+    return {
+        "codes_per_call": count,
+        "calls": len(ranges),
+        "failed_calls": len(errors),
+        "errors": sorted(set(errors))[:5],
+        "workers": workers,
+        "seconds": round(seconds, 4),
+        "calls_per_second": round(len(ranges) / seconds, 1),
+        "codes_per_second": round(len(ranges) * count / seconds, 1),
+        "median_call_ms": round(1000 * statistics.median(latencies), 3),
+        "max_call_ms": round(1000 * max(latencies), 3),
+        "format_ms": round(1000 * format_seconds, 3),
+    }, ranges
+
+
+def overlaps(ranges):
+    """ Number of ranges that start before the previous one ends """
+    ranges = sorted(ranges)
+    return sum(ranges[i][0] < ranges[i - 1][1] for i in range(1, len(ranges)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the asset code allocator against Postgres")
+    parser.add_argument("--dsn", required=True, help="libpq connection string of a scratch database")
+    parser.add_argument("--codes", default="1k,10k", help="comma separated codes per reservation")
+    parser.add_argument("--calls", type=int, default=200, help="reservations per size")
+    parser.add_argument("--workers", type=int, default=8, help="threads reserving at the same time")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    options = parser.parse_args(argv)
+
+    # One connection per worker thread
+    os.environ["DB_POOL_MAX_SIZE"] = str(options.workers)
+    config = {"dsn": options.dsn}
+    allocator = CodeAllocator(config)
+    prefix = "BENCH-" + uuid.uuid4().hex[:8] + "-"
+    results = []
+    failed = False
+    try:
+        for count in (parse_size(size) for size in options.codes.split(",")):
+            result, ranges = run_size(allocator, prefix, count, options.calls, options.workers)
+            result["overlapping_ranges"] = overlaps(ranges)
+            failed = failed or result["overlapping_ranges"] > 0 or result["failed_calls"] > 0
+            results.append(result)
+            print(f"{count:>9} codes/call  {result['calls_per_second']:9.1f} calls/s  "
+                  f"{result['codes_per_second']:12.0f} codes/s  median {result['median_call_ms']:.2f} ms  "
+                  f"format {result['format_ms']:.2f} ms  overlaps {result['overlapping_ranges']}  "
+                  f"failed {result['failed_calls']}", flush=True)
+            for error in result["errors"]:
+                print(f"  {error}")
+    finally:
+        with db.connection(config) as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"DELETE FROM {COUNTER_TABLE} WHERE prefix = %s", (prefix,))
+            conn.commit()
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+""" Compare the peak memory of a batch run in memory and a chunk at a time
+
+    python -m benchmarks.chunked --rows 1M,5M --chunk-rows 100000
+
+For every size a synthetic register is written as CSV and the full
+pipeline (extract, sort, classify, asset codes, CSV export) is run on it
+twice, each time in a fresh process: once with the whole table in memory
+and once with --chunk-rows.  The report gives the wall time and the peak
+resident memory of each process.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch
+from benchmarks.run import parse_size
+from benchmarks.synthetic import make_register
+
+
+def pipeline(register):
+    """ The batch spec of the benchmark """
+    sites = register["Site"].dropna().unique()[:1000]
+    return {
+        "steps": [
+            {"op": "extract", "params": {"columns": ["Site", "Group.1", "Description", "Asset Code", "Quantity",
+                                                    "Group Lead?"]}},
+            {"op": "sort", "params": {"selected_columns": ["Site", "Description"], "order": "asc"}},
+            {"op": "classify", "params": {"updates": [{"Group": site, "Classification": "Benchmark"}
+                                                      for site in sites]}},
+            {"op": "asset_codes", "params": {"first_blank_row": "BEN0000001", "asset_columns": ["Site"]}},
+        ],
+        "export": "csv",
+    }
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process """
+    # ru_maxrss carries over from the parent through exec, the kernel's high-water mark doesn't
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # In kilobytes on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def _run(file_path, spec, output_dir, results):
+    started = time.perf_counter()
+    report = batch.run_file(file_path, spec, output_dir)
+    results.put({
+        "status": report["status"],
+        "error": report.get("error"),
+        "seconds": round(time.perf_counter() - started, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    })
+
+
+def measure(file_path, spec, output_dir):
+    """ Run one file in a new process; returns its time and peak resident memory """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run, args=(file_path, spec, output_dir, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare in-memory and chunked batch runs")
+    parser.add_argument("--rows", default="1M", help="comma separated register sizes")
+    parser.add_argument("--chunk-rows", type=int, default=100_000, help="rows per chunk of the chunked run")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    options = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in (parse_size(size) for size in options.rows.split(",")):
+            register = make_register(rows)
+            file_path = os.path.join(directory, f"register_{rows}.csv")
+            register.to_csv(file_path, index=False)
+            spec = batch.load_spec(pipeline(register))
+            del register
+
+            for mode, chunk_rows in [("memory", None), ("chunked", options.chunk_rows)]:
+                result = measure(file_path, dict(spec, chunk_rows=chunk_rows), directory)
+                result.update(rows=rows, mode=mode, chunk_rows=chunk_rows)
+                results.append(result)
+                print(f"{rows:>9} rows  {mode:<8} {result['seconds']:8.2f} s  "
+                      f"peak {result['peak_rss_mb']:8.1f} MB  {result['status']}", flush=True)
+                if result["error"]:
+                    print(f"  {result['error']}")
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+""" Benchmark saving registers to Postgres with COPY
+
+    python -m benchmarks.db_save --dsn "host=localhost dbname=assets user=app" --rows 100k,1M
+
+For every size a synthetic register is saved with replace, and upserted
+on "Asset Code" three times: into a new table, with every row changed, and
+with every row unchanged.  The report gives rows per second and how much of the
+time the COPY itself took.  The benchmark tables are dropped afterwards.
+"""
+import argparse
+import json
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from benchmarks.run import parse_size
+from benchmarks.synthetic import make_register
+from db_save import SAVE_SCHEMA, save_table
+from schema import normalize_dtypes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark saving tables to Postgres")
+    parser.add_argument("--dsn", required=True, help="libpq connection string of a scratch database")
+    parser.add_argument("--rows", default="100k,1M", help="comma separated register sizes")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    options = parser.parse_args(argv)
+
+    config = {"dsn": options.dsn}
+    results = []
+    tables = []
+    try:
+        for rows in (parse_size(size) for size in options.rows.split(",")):
+            df = normalize_dtypes(make_register(rows, blank_code_ratio=0.0))
+            copied, keyed = ("bench_save_" + uuid.uuid4().hex[:8] for _ in range(2))
+            tables += [copied, keyed]
+            # replace is a plain COPY; an upsert into a new table creates it with the key
+            runs = [
+                ("replace", copied, df),
+                ("upsert", keyed, df),
+                ("upsert", keyed, df.assign(Quantity=df["Quantity"] + 1)),
+                ("upsert", keyed, df.assign(Quantity=df["Quantity"] + 1)),
+            ]
+            for mode, table, frame in runs:
+                report = save_table(frame, table, config, mode=mode)
+                results.append(report)
+                counts = "" if mode == "replace" else (
+                    f"  inserted {report['inserted']}  updated {report['updated']}  unchanged {report['unchanged']}")
+                print(f"{rows:>9} rows  {mode:<8} {report['rows_per_second']:11.0f} rows/s  "
+                      f"{report['seconds']:7.2f} s  copy {report['copy_seconds']:6.2f} s{counts}", flush=True)
+    finally:
+        with db.connection(config) as conn:
+            with conn.cursor() as cur:
+                for table in tables:
+                    cur.execute(f"DROP TABLE IF EXISTS {SAVE_SCHEMA}.{table}")
+            conn.commit()
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+""" Time and memory-profile every step of the app on synthetic asset registers
+
+    python -m benchmarks.run --sizes 10k,100k,1M
+    python -m benchmarks.run --sizes 100k --compare benchmark_results/baseline.json
+
+Each step is run --repeat times for timing and once more under tracemalloc
+for its peak allocation (numpy and pandas report their buffers to it, Arrow
+does not).  Results are written as JSON to --output, and --compare prints
+the change against an earlier results file.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import consolidate
+import export
+import readers
+from schema import normalize_dtypes
+from table_view import page_records
+from transforms import extract_columns, sort_with_subtotals, classify_sites, assign_asset_codes
+from benchmarks.synthetic import make_register, write_register, write_sheets
+
+RESULTS_DIRECTORY = "benchmark_results"
+
+# "export" is measured once per export format, as "export_<format>"
+STEPS = ["parse", "consolidate", "normalize", "extract", "sort", "classify", "asset_codes", "serialize_page",
+         "serialize_full", "export"]
+
+# Steps whose cost grows with the whole table being sent to the browser; skipped above this size
+SERIALIZE_FULL_MAX_ROWS = 1_000_000
+
+
+def parse_size(text):
+    """ "10k" -> 10000, "5M" -> 5000000 """
+    text = text.strip().lower()
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+def measure(fn, repeat):
+    """ Wall and CPU seconds of repeat runs of fn, then the peak allocation of one traced run """
+    wall, cpu = [], []
+    result = None
+    for _ in range(repeat):
+        started_wall, started_cpu = time.perf_counter(), time.process_time()
+        result = fn()
+        wall.append(time.perf_counter() - started_wall)
+        cpu.append(time.process_time() - started_cpu)
+        del result
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "wall_s": [round(seconds, 6) for seconds in wall],
+        "wall_median_s": round(statistics.median(wall), 6),
+        "cpu_median_s": round(statistics.median(cpu), 6),
+        "peak_alloc_bytes": peak,
+    }, result
+
+
+def step_functions(df, source_path, sheet_paths, workdir, options):
+    """ Step name -> function running the core logic of that step on df """
+    key_columns = ["Site", "Description"]
+    sites = df["Site"].unique()
+    updates = [{"Group": site, "Classification": f"C{i % 7}"}
+               for i, site in enumerate(sites[:max(1, int(len(sites) * options.classify_share))])]
+
+    def serialize(records):
+        from plotly.io.json import to_json_plotly
+
+        return len(to_json_plotly(records))
+
+    def exporter(export_format):
+        def write():
+            path = os.path.join(workdir, "export" + export.EXPORT_FORMATS[export_format][1])
+            export.WRITERS[export_format](df, path)
+            return {"file_bytes": os.path.getsize(path)}
+        return write
+
+    functions = {
+        "parse": lambda: readers.read_table(source_path),
+        # Every sheet is parsed again, as nothing is cached; the peak leaves out the parser processes
+        "consolidate": lambda: consolidate.consolidate(sheet_paths, workers=options.load_workers)[0],
+        "normalize": lambda: normalize_dtypes(df),
+        "extract": lambda: extract_columns(df, ["Site", "Description", "Asset Code", "Quantity"]),
+        "sort": lambda: sort_with_subtotals(df, key_columns, "asc"),
+        "classify": lambda: classify_sites(df, updates),
+        "asset_codes": lambda: assign_asset_codes(df, options.first_blank_row, key_columns),
+        "serialize_page": lambda: serialize(page_records(df, 0, 30)[0]),
+        "serialize_full": lambda: serialize(df.to_dict("records")),
+    }
+    for export_format in options.export_formats:
+        functions["export_" + export_format] = exporter(export_format)
+    return functions
+
+
+def describe_result(result):
+    if isinstance(result, pd.DataFrame):
+        return {"rows_out": len(result), "columns_out": len(result.columns)}
+    if isinstance(result, int):
+        return {"payload_bytes": result}
+    if isinstance(result, dict):
+        return result
+    return {}
+
+
+def run(options):
+    results = []
+    for rows in options.sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            started = time.perf_counter()
+            df = make_register(
+                rows,
+                sites=options.sites,
+                classifications=options.classifications,
+                blank_code_ratio=options.blank_code_ratio,
+                blank_group_ratio=options.blank_group_ratio,
+                text_quantity_ratio=options.text_quantity_ratio,
+                seed=options.seed,
+            )
+            source_path = None
+            if "parse" in options.steps:
+                source_path = write_register(df, os.path.join(workdir, "register.xlsx"))
+            sheet_paths = None
+            if "consolidate" in options.steps:
+                sheet_paths = write_sheets(df, os.path.join(workdir, "sheets.xlsx"), options.consolidate_sheets)
+            print(f"{rows} rows generated in {time.perf_counter() - started:.1f}s", flush=True)
+
+            functions = step_functions(df, source_path, sheet_paths, workdir, options)
+            steps = []
+            for step in options.steps:
+                if step == "export":
+                    steps.extend("export_" + export_format for export_format in options.export_formats)
+                elif step != "serialize_full" or rows <= SERIALIZE_FULL_MAX_ROWS:
+                    steps.append(step)
+            for step in steps:
+                measured, result = measure(functions[step], options.repeat)
+                entry = {"rows": rows, "step": step, **measured, **describe_result(result)}
+                if step == "parse":
+                    entry["source_format"] = os.path.splitext(source_path)[1][1:]
+                elif step == "consolidate":
+                    entry["source_format"] = os.path.splitext(sheet_paths[0])[1][1:]
+                    entry["sheets"] = options.consolidate_sheets
+                del result
+                results.append(entry)
+                print(f"  {step:<15} {entry['wall_median_s']:9.3f}s  peak {entry['peak_alloc_bytes'] / 2**20:9.1f} MiB",
+                      flush=True)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__}
+    try:
+        import pyarrow
+
+        versions["pyarrow"] = pyarrow.__version__
+    except ImportError:
+        pass
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "calamine": readers.calamine_available(),
+        **versions,
+    }
+
+
+def compare(results, baseline_path, threshold):
+    """ Print each step's change against a baseline run; returns the regressions """
+    with open(baseline_path) as f:
+        baseline = {(entry["rows"], entry["step"]): entry for entry in json.load(f)["results"]}
+    regressions = []
+    print(f"\nAgainst {baseline_path}:")
+    for entry in results:
+        before = baseline.get((entry["rows"], entry["step"]))
+        if before is None:
+            continue
+        ratio = entry["wall_median_s"] / before["wall_median_s"] if before["wall_median_s"] else float("inf")
+        memory_ratio = (entry["peak_alloc_bytes"] / before["peak_alloc_bytes"]
+                        if before["peak_alloc_bytes"] else float("inf"))
+        flag = "  REGRESSION" if ratio > 1 + threshold else ""
+        print(f"  {entry['rows']:>9} {entry['step']:<15} time x{ratio:6.2f}  memory x{memory_ratio:6.2f}{flag}")
+        if flag:
+            regressions.append({"rows": entry["rows"], "step": entry["step"], "ratio": round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app's steps on synthetic asset registers")
+    parser.add_argument("--sizes", default="10k,100k", help="comma separated row counts, e.g. 10k,1M,5M")
+    parser.add_argument("--steps", default=",".join(STEPS), help=f"comma separated, from {','.join(STEPS)}")
+    parser.add_argument("--sites", type=int, default=1000, help="distinct Site values (group cardinality)")
+    parser.add_argument("--classifications", type=int, default=20, help="distinct Group.1 values")
+    parser.add_argument("--blank-code-ratio", type=float, default=0.1, help="share of blank Asset Codes")
+    parser.add_argument("--blank-group-ratio", type=float, default=0.2, help="share of blank Group.1 values")
+    parser.add_argument("--text-quantity-ratio", type=float, default=0.0, help="share of text Quantity values")
+    parser.add_argument("--classify-share", type=float, default=0.1, help="share of sites given a classification")
+    parser.add_argument("--first-blank-row", default="ABC001", help="first code given to blank Asset Codes")
+    parser.add_argument("--consolidate-sheets", type=int, default=4, help="sheets the register is split over")
+    parser.add_argument("--load-workers", type=int, default=None,
+                        help="processes consolidate parses the sheets on (default: one per CPU)")
+    parser.add_argument("--export-formats", default="xlsx,csv,parquet")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per step")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help=f"results file (default: {RESULTS_DIRECTORY}/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with 1 on a regression")
+    options = parser.parse_args(argv)
+
+    options.sizes = [parse_size(size) for size in options.sizes.split(",")]
+    options.steps = [step.strip() for step in options.steps.split(",")]
+    unknown = [step for step in options.steps if step not in STEPS]
+    if unknown:
+        parser.error(f"unknown steps: {unknown}")
+    options.export_formats = [fmt.strip() for fmt in options.export_formats.split(",")]
+    unknown = [fmt for fmt in options.export_formats if fmt not in export.WRITERS]
+    if unknown:
+        parser.error(f"unknown export formats: {unknown}")
+
+    results = run(options)
+    parameters = {key: value for key, value in vars(options).items()
+                  if key not in ("output", "compare", "fail_on_regression")}
+    report = {"environment": environment(), "parameters": parameters, "results": results}
+    if options.compare:
+        report["regressions"] = compare(results, options.compare, options.threshold)
+
+    output = options.output or os.path.join(RESULTS_DIRECTORY, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    return 1 if options.fail_on_regression and report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
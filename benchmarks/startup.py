@@ -0,0 +1,164 @@
+""" Measure how long the app takes to start and how much memory each gunicorn worker needs
+
+    python -m benchmarks.startup --workers 4 --output benchmark_results/startup.json
+
+First the app is imported --repeat times in a fresh interpreter, for the
+import time and the memory of one process.  Then gunicorn is started with
+--workers workers, once with the app preloaded in the master and once
+without.  Each run reports the time until the first page was served and
+until every worker was ready, and the resident (RSS) and proportional
+(PSS) memory of the master and of each worker.  PSS counts pages shared
+after the fork only in part, so the PSS total is what the server uses.
+
+config.py has to be importable, as for the app itself.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from metrics import process_memory
+
+IMPORT_APP = """
+import json, time
+started = time.perf_counter()
+import app
+seconds = time.perf_counter() - started
+from metrics import process_memory
+print(json.dumps({"seconds": seconds, "rss": process_memory()["rss"]}))
+"""
+
+WORKER_READY = re.compile(r"Worker (\d+) ready in ([\d.]+)s")
+
+MB = 2 ** 20
+
+
+def child_environment():
+    """ The environment of the processes started, with the repository importable """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT] + [path for path in env.get("PYTHONPATH", "").split(os.pathsep) if path])
+    return env
+
+
+def measure_import(repeat, directory):
+    """ Median time to import the app in a fresh interpreter, and the resident memory afterwards """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_APP], cwd=directory, env=child_environment(),
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "import_seconds": round(statistics.median(run["seconds"] for run in runs), 3),
+        "import_rss_mb": round(statistics.median(run["rss"] for run in runs) / MB, 1),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def first_response(url, timeout):
+    """ Seconds until url answers with 200, polling it """
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except OSError:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError(f"{url} did not answer within {timeout}s")
+
+
+def measure_server(workers, preload, directory, timeout=120):
+    """ Start gunicorn, wait for every worker to be ready and measure its processes """
+    port = free_port()
+    env = child_environment()
+    env["GUNICORN_PRELOAD"] = "1" if preload else "0"
+    command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+               "--workers", str(workers), "--bind", f"127.0.0.1:{port}", "app:server"]
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=directory, env=env, stderr=subprocess.PIPE, text=True)
+
+    # Workers log "Worker <pid> ready in <seconds>s" from gunicorn.conf.py
+    ready = {}
+    all_ready = threading.Event()
+
+    def read_log():
+        for line in server.stderr:
+            match = WORKER_READY.search(line)
+            if match:
+                ready[int(match.group(1))] = (float(match.group(2)), time.perf_counter() - started)
+                if len(ready) >= workers:
+                    all_ready.set()
+
+    threading.Thread(target=read_log, daemon=True).start()
+    try:
+        first_page = first_response(f"http://127.0.0.1:{port}/", timeout)
+        if not all_ready.wait(timeout):
+            raise TimeoutError(f"Only {len(ready)} of {workers} workers got ready within {timeout}s")
+        master = process_memory(server.pid)
+        worker_memory = {pid: process_memory(pid) for pid in ready}
+    finally:
+        server.terminate()
+        server.wait()
+
+    worker_memory = {pid: memory for pid, memory in worker_memory.items() if memory is not None}
+    total_pss = master["pss"] + sum(memory["pss"] for memory in worker_memory.values())
+    return {
+        "preload": preload,
+        "workers": workers,
+        "first_response_seconds": round(first_page, 3),
+        "all_workers_ready_seconds": round(max(at for _, at in ready.values()), 3),
+        "worker_start_seconds": sorted(round(seconds, 3) for seconds, _ in ready.values()),
+        "master_rss_mb": round(master["rss"] / MB, 1),
+        "worker_rss_mb": sorted(round(memory["rss"] / MB, 1) for memory in worker_memory.values()),
+        "worker_pss_mb": sorted(round(memory["pss"] / MB, 1) for memory in worker_memory.values()),
+        "worker_shared_mb": sorted(round(memory["shared"] / MB, 1) for memory in worker_memory.values()),
+        "total_pss_mb": round(total_pss / MB, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure app start-up time and memory per gunicorn worker")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--repeat", type=int, default=3, help="imports of the app to time")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    options = parser.parse_args(argv)
+
+    # The app creates its upload, table and cache directories in the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        results = measure_import(options.repeat, directory)
+        print(f"import app  {results['import_seconds']:6.2f} s  RSS {results['import_rss_mb']:7.1f} MB", flush=True)
+        results["servers"] = []
+        for preload in (True, False):
+            result = measure_server(options.workers, preload, directory)
+            results["servers"].append(result)
+            print(f"preload {'on ' if preload else 'off'}  first page {result['first_response_seconds']:6.2f} s  "
+                  f"all ready {result['all_workers_ready_seconds']:6.2f} s  "
+                  f"worker PSS {statistics.median(result['worker_pss_mb']):7.1f} MB  "
+                  f"RSS {statistics.median(result['worker_rss_mb']):7.1f} MB  "
+                  f"total PSS {result['total_pss_mb']:7.1f} MB", flush=True)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+""" Synthetic asset registers shaped like the sheets the app is used on """
+import numpy as np
+import pandas as pd
+
+# Excel sheets stop at 1,048,576 rows (including the header)
+EXCEL_MAX_ROWS = 1_048_575
+
+DESCRIPTIONS = ["Desk", "Chair", "PC", "Monitor", "Printer", "Lamp", "Cabinet", "Shelf", "Phone", "Projector"]
+
+
+def make_register(
+    rows,
+    sites=1000,
+    classifications=20,
+    descriptions=len(DESCRIPTIONS),
+    blank_code_ratio=0.1,
+    blank_group_ratio=0.2,
+    text_quantity_ratio=0.0,
+    code_prefix="ABC",
+    seed=0,
+):
+    """ An asset register of the given number of rows
+
+    sites is the number of distinct "Site" values (the group cardinality),
+    classifications the number of distinct "Group.1" values.  A
+    blank_code_ratio share of "Asset Code" is "", a blank_group_ratio share of
+    "Group.1" is blank and a text_quantity_ratio share of "Quantity" is text,
+    which makes the sort keep the column as text.
+    """
+    rng = np.random.default_rng(seed)
+    site_names = np.array([f"S{i:05d}" for i in range(sites)], dtype=object)
+    group_names = np.array([f"G{i:03d}" for i in range(classifications)], dtype=object)
+    description_names = np.array(
+        [DESCRIPTIONS[i % len(DESCRIPTIONS)] + (f" {i // len(DESCRIPTIONS)}" if i >= len(DESCRIPTIONS) else "")
+         for i in range(descriptions)],
+        dtype=object,
+    )
+
+    group = group_names[rng.integers(0, classifications, rows)]
+    group[rng.random(rows) < blank_group_ratio] = None
+
+    codes = code_prefix + pd.Series(np.arange(rows)).astype(str).str.zfill(7)
+    codes = codes.to_numpy(dtype=object)
+    codes[rng.random(rows) < blank_code_ratio] = ""
+
+    quantity = rng.integers(1, 10, rows)
+    if text_quantity_ratio:
+        quantity = quantity.astype(object)
+        quantity[rng.random(rows) < text_quantity_ratio] = "N/A"
+
+    return pd.DataFrame({
+        "Site": site_names[rng.integers(0, sites, rows)],
+        "Group.1": group,
+        "Description": description_names[rng.integers(0, descriptions, rows)],
+        "Asset Code": codes,
+        "Quantity": quantity,
+        "Group Lead?": "",
+    })
+
+
+def write_register(df, path):
+    """ Save a register as a workbook, or as CSV when it is too long for one sheet; returns the path """
+    import export
+
+    if path.lower().endswith(".xlsx") and len(df) > EXCEL_MAX_ROWS:
+        path = path[:-len(".xlsx")] + ".csv"
+    if path.lower().endswith(".csv"):
+        return export.write_csv(df, path)
+    return export.write_xlsx(df, path)
+
+
+def write_sheets(df, path, sheets):
+    """ Save a register split over sheets sheets of one workbook, "Part 1", "Part 2", ...; returns [path]
+
+    When a part is too long for a sheet, the parts are saved as CSV files
+    next to path instead, and their paths are returned.
+    """
+    import export
+
+    parts = np.array_split(np.arange(len(df)), sheets)
+    if max(len(part) for part in parts) > EXCEL_MAX_ROWS:
+        base = path[:-len(".xlsx")] if path.lower().endswith(".xlsx") else path
+        return [export.write_csv(df.iloc[part], f"{base}-{number}.csv") for number, part in enumerate(parts, 1)]
+    with pd.ExcelWriter(path) as writer:
+        for number, part in enumerate(parts, 1):
+            df.iloc[part].to_excel(writer, sheet_name=f"Part {number}", index=False)
+    return [path]
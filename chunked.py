@@ -0,0 +1,413 @@
+""" Run the table pipeline over registers too large for memory, a chunk of rows at a time
+
+The table is read from disk in chunks of at most chunk_rows rows and every
+step passes chunks on to the next, so memory depends on the chunk size, not
+on the size of the table:
+
+- extract and classify work on each chunk by itself;
+- sort is an external merge sort: each chunk is sorted into a run on disk,
+  the runs are merged a block at a time, and the total rows are added as
+  the groups stream past;
+- asset_codes takes two passes, one numbering the blank codes and finding
+  each group's lead code, one filling in "Group Lead?".  The lead codes are
+  the one thing kept per group of the whole table.
+
+Chunks waiting for a later pass are spilled to a temporary directory as
+pickles, which keep every column as it is, mixed text and numbers included.
+The results are the rows the in-memory steps produce.
+"""
+import bisect
+import itertools
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import export
+import readers
+from asset_codes import format_codes, parse_code
+from transforms import extract_columns, classify_sites, assign_asset_codes, blank_codes, to_numeric_if_possible
+
+# Rows read, transformed and written at a time
+CHUNK_ROWS = 100_000
+
+# Sorted runs merged at once; more runs are merged in several passes
+MERGE_FAN_IN = 32
+
+# Smallest block of a run read back at a time during the merge
+MIN_BLOCK_ROWS = 1_000
+
+# Columns the sort adds to its runs: a comparison key per sort column, and the row's position in the input
+SORT_KEY_COLUMN = "__sort_key_{}"
+ROW_NUMBER_COLUMN = "__row_number"
+
+
+class SpillFile:
+    """ DataFrames appended to a temporary file, read back once in the same order """
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(suffix=".spill", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self.rows = 0
+
+    def append(self, df):
+        pickle.dump(df, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.rows += len(df)
+
+    def read(self):
+        """ Yield the frames in the order they were appended; the file is deleted afterwards """
+        self._file.close()
+        try:
+            with open(self.path, "rb") as f:
+                while True:
+                    try:
+                        yield pickle.load(f)
+                    except EOFError:
+                        return
+        finally:
+            os.remove(self.path)
+
+
+def extract_chunks(chunks, workdir, chunk_rows, columns):
+    """ extract_columns, chunk by chunk """
+    for chunk in chunks:
+        yield extract_columns(chunk, columns)
+
+
+def classify_chunks(chunks, workdir, chunk_rows, updates):
+    """ classify_sites, chunk by chunk; a site's rows get the same classification in every chunk """
+    for chunk in chunks:
+        yield classify_sites(chunk, updates)
+
+
+def _is_number(column, order):
+    """ Whether sort_with_subtotals compares a chunk's column as numbers """
+    if order != "none":
+        column = to_numeric_if_possible(column)
+    return pd.api.types.is_numeric_dtype(column.dtype)
+
+
+def _write_run(rows, workdir, block_rows):
+    run = SpillFile(workdir)
+    for start in range(0, len(rows), block_rows):
+        run.append(rows.iloc[start:start + block_rows])
+    return run
+
+
+def _sorted_run(chunk, selected_columns, numbers, row_numbers, workdir, block_rows):
+    """ Sort a chunk on its comparison keys into a run, leaving out rows with a blank key
+
+    A key column is compared as numbers when numbers says so for it, and
+    as text otherwise; the row number breaks ties, which keeps the sort
+    stable across runs.
+    """
+    keys = {}
+    for i, column in enumerate(selected_columns):
+        if numbers[column]:
+            keys[SORT_KEY_COLUMN.format(i)] = pd.to_numeric(chunk[column]).astype(np.float64)
+        else:
+            keys[SORT_KEY_COLUMN.format(i)] = chunk[column].astype(str).astype(object)
+    keep = chunk[selected_columns].notna().all(axis=1).to_numpy()
+    rows = chunk.assign(**keys, **{ROW_NUMBER_COLUMN: row_numbers})[keep]
+    rows = rows.sort_values(list(keys) + [ROW_NUMBER_COLUMN], ignore_index=True)
+    return _write_run(rows, workdir, block_rows)
+
+
+class _RunReader:
+    """ The block of a sorted run being merged, indexable by row for bisect """
+
+    def __init__(self, run, key_columns):
+        self._blocks = run.read()
+        self._key_columns = key_columns
+        self.next_block()
+
+    def next_block(self):
+        """ Load the next block; returns False at the end of the run """
+        self.block = next(self._blocks, None)
+        self.position = 0
+        if self.block is None:
+            return False
+        self._keys = [self.block[column].to_numpy() for column in self._key_columns]
+        return True
+
+    def __len__(self):
+        return len(self.block)
+
+    def __getitem__(self, i):
+        return tuple(keys[i] for keys in self._keys)
+
+
+def _merge_runs(runs, key_columns):
+    """ Yield the rows of runs sorted on key_columns in key order, a block at a time
+
+    Each round passes on the rows up to the smallest last key of the loaded
+    blocks, as no row still on disk can come before those.  The keys end in
+    the row number, so no two rows compare equal.
+    """
+    readers_ = [reader for reader in (_RunReader(run, key_columns) for run in runs) if reader.block is not None]
+    while readers_:
+        cutoff = min(reader[len(reader) - 1] for reader in readers_)
+        pieces = []
+        for reader in readers_:
+            end = bisect.bisect_right(reader, cutoff, lo=reader.position)
+            if end > reader.position:
+                pieces.append(reader.block.iloc[reader.position:end])
+                reader.position = end
+        if len(pieces) == 1:
+            yield pieces[0].reset_index(drop=True)
+        else:
+            yield pd.concat(pieces, ignore_index=True).sort_values(key_columns, ignore_index=True)
+        readers_ = [reader for reader in readers_ if reader.position < len(reader) or reader.next_block()]
+
+
+def _merge_all(runs, key_columns, workdir, block_rows):
+    """ Merge runs in passes of MERGE_FAN_IN until one merge is left, and yield its blocks """
+    while len(runs) > MERGE_FAN_IN:
+        merged = []
+        for start in range(0, len(runs), MERGE_FAN_IN):
+            group = runs[start:start + MERGE_FAN_IN]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            run = SpillFile(workdir)
+            for block in _merge_runs(group, key_columns):
+                for offset in range(0, len(block), block_rows):
+                    run.append(block.iloc[offset:offset + block_rows])
+            merged.append(run)
+        runs = merged
+    return _merge_runs(runs, key_columns)
+
+
+def _group_key(keys, i):
+    return tuple(values[i] for values in keys)
+
+
+def _total_rows(first_rows, totals):
+    """ Total rows of groups: a copy of each group's first row with its total quantity and no asset code """
+    summaries = pd.concat(first_rows, ignore_index=True) if len(first_rows) > 1 else first_rows[0].copy()
+    summaries["Quantity"] = totals
+    if "Asset Code" in summaries.columns:
+        summaries["Asset Code"] = ""
+    return summaries
+
+
+def _add_subtotals(blocks, key_columns):
+    """ Add sort_with_subtotals' total rows to blocks of rows sorted on key_columns
+
+    Groups can span blocks.  The rows of a group are passed on once it is
+    known to have more than one row, with "Quantity" converted to numbers,
+    and its total row once the group ends; only the group's first row and
+    running total are carried over to the next block.  A group's first row
+    is held back until the row after it shows whether it is alone.
+    """
+    held = None     # a group's only row so far, not passed on yet
+    running = None  # (key, first row, total so far) of a multi-row group whose rows were passed on
+    for block in blocks:
+        if not len(block):
+            continue
+        if held is not None:
+            block = pd.concat([held, block], ignore_index=True)
+            held = None
+        keys = [block[column].to_numpy() for column in key_columns]
+        starts = np.zeros(len(block), dtype=bool)
+        starts[0] = True
+        for values in keys:
+            starts[1:] |= values[1:] != values[:-1]
+        group_ids = np.cumsum(starts) - 1
+        firsts = np.flatnonzero(starts)
+        last = len(firsts) - 1
+
+        pieces = []
+        previous, running = running, None
+        if previous is not None and _group_key(keys, 0) != previous[0]:
+            # The running group ended with the previous block
+            pieces.append(_total_rows([previous[1]], [previous[2]]))
+            previous = None
+
+        multi = np.bincount(group_ids) > 1
+        multi[0] |= previous is not None
+        if not multi[last]:
+            held = block.iloc[firsts[last]:]
+            block, group_ids = block.iloc[:firsts[last]], group_ids[:firsts[last]]
+
+        in_multi = multi[group_ids]
+        totals = {}
+        if in_multi.any():
+            quantity = pd.to_numeric(block["Quantity"], errors="coerce")
+            if not in_multi.all():
+                quantity = quantity.where(in_multi, block["Quantity"])
+            block = block.copy(deep=False)
+            block["Quantity"] = quantity
+            totals = quantity[in_multi].groupby(group_ids[in_multi]).sum().to_dict()
+            if previous is not None:
+                totals[0] += previous[2]
+
+        def first_row(group):
+            if group == 0 and previous is not None:
+                return previous[1]
+            return block.iloc[firsts[group]:firsts[group] + 1]
+
+        if multi[last]:
+            running = (_group_key(keys, firsts[last]), first_row(last), totals[last])
+        closed = np.flatnonzero(multi[:last])
+        if len(closed):
+            summaries = _total_rows([first_row(group) for group in closed], [totals[group] for group in closed])
+            # Each total row goes right after the rows of its group
+            all_ids = np.concatenate([group_ids, closed])
+            is_summary = np.concatenate([np.zeros(len(group_ids), dtype=bool), np.ones(len(closed), dtype=bool)])
+            block = pd.concat([block, summaries], ignore_index=True).iloc[np.lexsort((is_summary, all_ids))]
+        pieces.append(block)
+        pieces = [piece for piece in pieces if len(piece)]
+        if pieces:
+            yield pd.concat(pieces, ignore_index=True) if len(pieces) > 1 else pieces[0]
+
+    if held is not None:
+        yield held
+    if running is not None:
+        yield _total_rows([running[1]], [running[2]])
+
+
+def sort_chunks(chunks, workdir, chunk_rows, selected_columns, order):
+    """ sort_with_subtotals as an external merge sort
+
+    Whether a key column is compared as numbers depends on all of its
+    values, so each chunk is sorted into a run as it arrives with what the
+    chunks so far say, and the few runs sorted on a column that later turns
+    out to hold text are sorted again before the merge.
+    """
+    if not selected_columns:
+        yield from chunks
+        return
+
+    block_rows = max(MIN_BLOCK_ROWS, chunk_rows // MERGE_FAN_IN)
+    numbers = {column: True for column in selected_columns}
+    runs = []
+    start = 0
+    for chunk in chunks:
+        chunk = chunk.reset_index(drop=True)
+        for column in selected_columns:
+            numbers[column] = numbers[column] and _is_number(chunk[column], order)
+        row_numbers = np.arange(start, start + len(chunk), dtype=np.int64)
+        start += len(chunk)
+        runs.append((_sorted_run(chunk, selected_columns, numbers, row_numbers, workdir, block_rows), dict(numbers)))
+
+    resorted = []
+    for run, run_numbers in runs:
+        if run_numbers != numbers:
+            blocks = list(run.read())
+            if not blocks:
+                continue  # Every row of the chunk had a blank key
+            rows = pd.concat(blocks, ignore_index=True)
+            row_numbers = rows.pop(ROW_NUMBER_COLUMN).to_numpy()
+            rows = rows.drop(columns=[SORT_KEY_COLUMN.format(j) for j in range(len(selected_columns))])
+            run = _sorted_run(rows, selected_columns, numbers, row_numbers, workdir, block_rows)
+        resorted.append(run)
+
+    key_columns = [SORT_KEY_COLUMN.format(i) for i in range(len(selected_columns))]
+    blocks = _merge_all(resorted, key_columns + [ROW_NUMBER_COLUMN], workdir, block_rows)
+
+    def converted(blocks):
+        for block in blocks:
+            for column in selected_columns:
+                if numbers[column]:
+                    block[column] = pd.to_numeric(block[column])
+            yield block
+
+    for block in _add_subtotals(converted(blocks), key_columns):
+        yield block.drop(columns=key_columns + [ROW_NUMBER_COLUMN]).reset_index(drop=True)
+
+
+def _find_leads(chunk, prefix, asset_columns, leads):
+    """ Add the first code starting with prefix of every group in chunk that has none in leads yet """
+    codes = chunk["Asset Code"]
+    try:
+        matches = codes.str.startswith(prefix, na=False)
+    except AttributeError:
+        return  # No text codes in this chunk
+    firsts = codes.where(matches).groupby([chunk[column] for column in asset_columns], sort=False, observed=True).first()
+    for key, code in firsts.dropna().items():
+        leads.setdefault(key, code)
+
+
+def _with_leads(chunk, asset_columns, lead_keys, lead_codes):
+    """ Set "Group Lead?" of the rows of chunk whose group has a lead code """
+    if len(asset_columns) == 1:
+        keys = pd.Index(chunk[asset_columns[0]])
+    else:
+        keys = pd.MultiIndex.from_frame(chunk[asset_columns])
+    positions = lead_keys.get_indexer(keys)
+    has_lead = positions >= 0
+    if "Group Lead?" in chunk.columns:
+        group_lead = chunk["Group Lead?"].to_numpy(dtype=object, copy=True)
+    else:
+        group_lead = np.full(len(chunk), np.nan, dtype=object)
+    group_lead[has_lead] = lead_codes[positions[has_lead]]
+    chunk = chunk.copy(deep=False)
+    chunk["Group Lead?"] = group_lead
+    return chunk
+
+
+def asset_code_chunks(chunks, workdir, chunk_rows, first_blank_row, asset_columns, allocator=None):
+    """ assign_asset_codes in two passes over the chunks
+
+    The first pass numbers the blank codes on from chunk to chunk and keeps
+    the first code starting with the prefix of every group; the second
+    writes those lead codes to "Group Lead?".  With an allocator (an
+    asset_codes.CodeAllocator), every chunk's blanks are numbered from a
+    range reserved for them, as the number of blanks is only known chunk by
+    chunk; the ranges follow on from each other unless someone else
+    reserved codes of the prefix in between.
+    """
+    prefix, number, width = parse_code(first_blank_row)
+    spilled = SpillFile(workdir) if asset_columns else None
+    leads = {}
+    for chunk in chunks:
+        blanks = int(blank_codes(chunk).sum())
+        if blanks and allocator is not None:
+            number = parse_code(allocator.reserve_codes(format_codes(prefix, number, 1, width)[0], blanks))[1]
+        chunk = assign_asset_codes(chunk, format_codes(prefix, number, 1, width)[0], [])
+        number += blanks
+        if spilled is None:
+            yield chunk
+            continue
+        _find_leads(chunk, prefix, asset_columns, leads)
+        spilled.append(chunk)
+
+    if spilled is not None:
+        lead_keys = pd.Index(list(leads))
+        lead_codes = np.array(list(leads.values()), dtype=object)
+        for chunk in spilled.read():
+            yield _with_leads(chunk, asset_columns, lead_keys, lead_codes) if leads else chunk
+
+
+# Operation -> function (chunks, workdir, chunk_rows, **params) yielding the chunks of its result
+CHUNK_OPERATIONS = {
+    "extract": extract_chunks,
+    "sort": sort_chunks,
+    "classify": classify_chunks,
+    "asset_codes": asset_code_chunks,
+}
+
+
+def run_chunked(file_path, spec, output_path, chunk_rows=CHUNK_ROWS, workdir=None, allocator=None):
+    """ Apply a batch spec (see batch.py) to a file a chunk at a time; returns the number of rows exported
+
+    The export is written as the chunks come out of the last step.
+    Temporary files go to a directory in workdir (the system's temporary
+    directory by default) that is removed afterwards.  allocator reserves
+    the asset codes handed out, see asset_code_chunks.
+    """
+    writer = export.CHUNK_WRITERS[spec["export"]]
+    with tempfile.TemporaryDirectory(prefix="chunked-", dir=workdir) as spill_dir:
+        chunks = readers.iter_table(file_path, spec["sheet"], spec["header_row"], spec["columns"], chunk_rows)
+        for step in spec["steps"]:
+            params = step["params"]
+            if step["op"] == "asset_codes":
+                params = {**params, "allocator": allocator}
+            chunks = CHUNK_OPERATIONS[step["op"]](chunks, spill_dir, chunk_rows, **params)
+        first = next(chunks, None)
+        if first is None:
+            return writer([], output_path, spec["columns"] or [])
+        return writer(itertools.chain([first], chunks), output_path, first.columns)
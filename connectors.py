@@ -0,0 +1,419 @@
+""" Import files straight from Google Drive, Dropbox, a server directory or an HTTP server
+
+Every source is a connector with the same three calls: list a folder, stat
+a file and read a byte range of it.  fetch() downloads a file with several
+ranged reads at once, straight into the upload directory, so it never
+passes through the browser.  A DownloadCache remembers which version of a
+remote file was imported; importing it again only fetches it when its ETag
+(or modified time and size) changed.
+
+The Google Drive and Dropbox connectors call their REST APIs with an
+access token.  Their API URLs can be pointed elsewhere, and LocalConnector
+and HttpConnector work on a plain directory or web server, so imports can
+be tried without either service.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import uploads
+
+# Bytes fetched per ranged read, and ranged reads running at once per file
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = int(os.environ.get("CONNECTOR_DOWNLOAD_WORKERS", 4))
+
+# Bytes copied from a response to the file at a time
+COPY_SIZE = 256 * 1024
+
+# Seconds to wait for a connection or the next bytes of a response
+TIMEOUT = 60
+
+GOOGLE_DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+GOOGLE_FOLDER = "application/vnd.google-apps.folder"
+GOOGLE_SHEET = "application/vnd.google-apps.spreadsheet"
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+DROPBOX_API_URL = "https://api.dropboxapi.com/2"
+DROPBOX_CONTENT_URL = "https://content.dropboxapi.com/2"
+
+# Links of a directory listing page, as served by nginx, Apache or python -m http.server
+_LISTING_LINK = re.compile(r'href="([^"?#]+)"', re.IGNORECASE)
+
+
+class ConnectorError(Exception):
+    """ Raised when a source can't be reached or refuses a request """
+
+
+def remote_file(path, name, folder=False, size=None, modified=None, etag=None, ranges=True):
+    """ What list and stat return about a file: ranges says whether it can be read in ranges """
+    return {"path": path, "name": name, "folder": folder, "size": size, "modified": modified,
+            "etag": etag, "ranges": ranges}
+
+
+def _open(url, headers=None, method="GET", data=None):
+    """ Send a request; HTTP and connection errors become ConnectorError """
+    request = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
+    try:
+        return urllib.request.urlopen(request, timeout=TIMEOUT)
+    except urllib.error.HTTPError as e:
+        detail = e.read(500).decode("utf-8", "replace").strip()
+        raise ConnectorError(f"{method} {url} failed with {e.code} {e.reason}: {detail}") from e
+    except urllib.error.URLError as e:
+        raise ConnectorError(f"Could not reach {url}: {e.reason}") from e
+
+
+def _range_header(start, end):
+    """ The Range header asking for bytes start:end, none for a whole file """
+    if end is None:
+        return {"Range": f"bytes={start}-"} if start else {}
+    return {"Range": f"bytes={start}-{end - 1}"}
+
+
+def _read_response(response, start, end):
+    """ Yield the bytes start:end of a response to a ranged request, a piece at a time """
+    with response:
+        if response.status != 206 and start:
+            raise ConnectorError("The server ignored the byte range requested")
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            piece = response.read(COPY_SIZE if remaining is None else min(COPY_SIZE, remaining))
+            if not piece:
+                break
+            if remaining is not None:
+                remaining -= len(piece)
+            yield piece
+
+
+class LocalConnector:
+    """ Files in a directory on the server, e.g. a mounted share """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _full_path(self, path):
+        full_path = os.path.abspath(os.path.join(self.root, path.lstrip("/")))
+        if os.path.commonpath([self.root, full_path]) != self.root:
+            raise ConnectorError(f"{path} is outside of {self.root}")
+        return full_path
+
+    def _info(self, path, full_path):
+        st = os.stat(full_path)
+        folder = os.path.isdir(full_path)
+        return remote_file(path, os.path.basename(full_path), folder,
+                           size=None if folder else st.st_size,
+                           modified=st.st_mtime_ns, etag=f"{st.st_mtime_ns:x}-{st.st_size:x}")
+
+    def list(self, folder=""):
+        full_path = self._full_path(folder)
+        try:
+            names = sorted(os.listdir(full_path))
+        except OSError as e:
+            raise ConnectorError(f"Can't list {folder or '/'}: {e}") from e
+        return [self._info(os.path.join(folder, name), os.path.join(full_path, name)) for name in names]
+
+    def stat(self, path):
+        try:
+            return self._info(path, self._full_path(path))
+        except OSError as e:
+            raise ConnectorError(f"Can't stat {path}: {e}") from e
+
+    def read_range(self, path, start, end=None):
+        """ Yield the bytes start:end of a file (to its end when end is None) """
+        with open(self._full_path(path), "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                piece = f.read(COPY_SIZE if remaining is None else min(COPY_SIZE, remaining))
+                if not piece:
+                    break
+                if remaining is not None:
+                    remaining -= len(piece)
+                yield piece
+
+
+class HttpConnector:
+    """ Files on a web server, listed from its directory index pages """
+
+    def __init__(self, base_url, headers=None):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.headers = headers or {}
+
+    def _url(self, path):
+        return urllib.parse.urljoin(self.base_url, urllib.parse.quote(path.lstrip("/")))
+
+    def list(self, folder=""):
+        folder = folder.strip("/") + "/" if folder.strip("/") else ""
+        with _open(self._url(folder), self.headers) as response:
+            page = response.read().decode("utf-8", "replace")
+        files = []
+        for link in _LISTING_LINK.findall(page):
+            name = urllib.parse.unquote(link)
+            # Only entries of this folder, not parent, sorting or absolute links
+            if "/" in name.rstrip("/") or name.startswith((".", "/")) or ":" in name:
+                continue
+            is_folder = name.endswith("/")
+            files.append(remote_file(folder + name, name.rstrip("/"), is_folder))
+        return files
+
+    def stat(self, path):
+        with _open(self._url(path), self.headers, method="HEAD") as response:
+            headers = response.headers
+            # Servers redirect folders to their index page, at the URL with a trailing slash
+            folder = response.url.endswith("/")
+        length = headers.get("Content-Length")
+        return remote_file(
+            path, os.path.basename(path.rstrip("/")), folder,
+            size=None if folder or not length else int(length),
+            modified=headers.get("Last-Modified"),
+            etag=headers.get("ETag"),
+            ranges=headers.get("Accept-Ranges", "").lower() == "bytes",
+        )
+
+    def read_range(self, path, start, end=None):
+        headers = {**self.headers, **_range_header(start, end)}
+        yield from _read_response(_open(self._url(path), headers), start, end)
+
+
+class GoogleDriveConnector:
+    """ Files in Google Drive, by file id; folders are listed by id too, "root" being My Drive
+
+    Google Sheets are exported as workbooks, which can only be downloaded
+    whole.
+    """
+
+    FIELDS = "id,name,size,modifiedTime,md5Checksum,mimeType"
+
+    def __init__(self, token, api_url=GOOGLE_DRIVE_API_URL):
+        self.api_url = api_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def _get(self, path, params):
+        url = f"{self.api_url}/{path}?{urllib.parse.urlencode(params)}"
+        with _open(url, self.headers) as response:
+            return json.load(response)
+
+    def _info(self, item):
+        folder = item["mimeType"] == GOOGLE_FOLDER
+        if item["mimeType"] == GOOGLE_SHEET:
+            return remote_file(item["id"], item["name"] + ".xlsx", modified=item.get("modifiedTime"),
+                               etag=item.get("modifiedTime"), ranges=False)
+        return remote_file(item["id"], item["name"], folder,
+                           size=int(item["size"]) if "size" in item else None,
+                           modified=item.get("modifiedTime"),
+                           etag=item.get("md5Checksum") or item.get("modifiedTime"))
+
+    def list(self, folder="root"):
+        params = {
+            "q": f"'{folder or 'root'}' in parents and trashed = false",
+            "fields": f"nextPageToken,files({self.FIELDS})",
+            "pageSize": 1000,
+            "orderBy": "folder,name",
+        }
+        files = []
+        while True:
+            page = self._get("files", params)
+            files += [self._info(item) for item in page.get("files", [])
+                      if not item["mimeType"].startswith("application/vnd.google-apps.")
+                      or item["mimeType"] in (GOOGLE_FOLDER, GOOGLE_SHEET)]
+            if not page.get("nextPageToken"):
+                return files
+            params["pageToken"] = page["nextPageToken"]
+
+    def stat(self, path):
+        return self._info(self._get(f"files/{urllib.parse.quote(path)}", {"fields": self.FIELDS}))
+
+    def read_range(self, path, start, end=None):
+        file_id = urllib.parse.quote(path)
+        if start == 0 and end is None and not self.stat(path)["ranges"]:
+            # A Google Sheet, which has no bytes of its own until it is exported
+            url = f"{self.api_url}/files/{file_id}/export?{urllib.parse.urlencode({'mimeType': XLSX_MIMETYPE})}"
+            yield from _read_response(_open(url, self.headers), 0, None)
+            return
+        headers = {**self.headers, **_range_header(start, end)}
+        yield from _read_response(_open(f"{self.api_url}/files/{file_id}?alt=media", headers), start, end)
+
+
+class DropboxConnector:
+    """ Files in Dropbox, by path; "" is the root folder """
+
+    def __init__(self, token, api_url=DROPBOX_API_URL, content_url=DROPBOX_CONTENT_URL):
+        self.api_url = api_url.rstrip("/")
+        self.content_url = content_url.rstrip("/")
+        self.token = token
+
+    def _call(self, endpoint, arguments):
+        headers = {"Authorization": f"Bearer {self.token}", "Content-Type": "application/json"}
+        with _open(f"{self.api_url}/{endpoint}", headers, "POST", json.dumps(arguments).encode()) as response:
+            return json.load(response)
+
+    @staticmethod
+    def _info(entry):
+        folder = entry[".tag"] == "folder"
+        return remote_file(entry["path_display"], entry["name"], folder, size=entry.get("size"),
+                           modified=entry.get("server_modified"), etag=entry.get("content_hash") or entry.get("rev"))
+
+    def list(self, folder=""):
+        page = self._call("files/list_folder", {"path": folder})
+        entries = page["entries"]
+        while page.get("has_more"):
+            page = self._call("files/list_folder/continue", {"cursor": page["cursor"]})
+            entries += page["entries"]
+        entries = [entry for entry in entries if entry[".tag"] in ("file", "folder")]
+        return [self._info(entry) for entry in sorted(entries, key=lambda e: (e[".tag"] != "folder", e["name"].lower()))]
+
+    def stat(self, path):
+        return self._info(self._call("files/get_metadata", {"path": path}))
+
+    def read_range(self, path, start, end=None):
+        # Download takes its argument in a header and no body
+        headers = {"Authorization": f"Bearer {self.token}", "Dropbox-API-Arg": json.dumps({"path": path}),
+                   **_range_header(start, end)}
+        yield from _read_response(_open(f"{self.content_url}/files/download", headers, "POST"), start, end)
+
+
+def connector_from_env(source):
+    """ The connector for a file source of the upload form, or None when it isn't configured
+
+    google and dropbox need GOOGLE_DRIVE_TOKEN and DROPBOX_TOKEN, server
+    needs CONNECTOR_LOCAL_ROOT and http needs CONNECTOR_HTTP_URL.
+    """
+    env = os.environ
+    if source == "google" and env.get("GOOGLE_DRIVE_TOKEN"):
+        return GoogleDriveConnector(env["GOOGLE_DRIVE_TOKEN"], env.get("GOOGLE_DRIVE_API_URL", GOOGLE_DRIVE_API_URL))
+    if source == "dropbox" and env.get("DROPBOX_TOKEN"):
+        return DropboxConnector(env["DROPBOX_TOKEN"], env.get("DROPBOX_API_URL", DROPBOX_API_URL),
+                                env.get("DROPBOX_CONTENT_URL", DROPBOX_CONTENT_URL))
+    if source == "server" and env.get("CONNECTOR_LOCAL_ROOT"):
+        return LocalConnector(env["CONNECTOR_LOCAL_ROOT"])
+    if source == "http" and env.get("CONNECTOR_HTTP_URL"):
+        return HttpConnector(env["CONNECTOR_HTTP_URL"])
+    return None
+
+
+class DownloadCache:
+    """ Which version of each remote file was imported and where it was stored
+
+    One small JSON file per remote file, so every worker sees the same
+    entries.  An entry only counts while the stored file still exists and
+    the remote file's ETag, modified time and size are unchanged.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, source, path):
+        key = json.dumps([source, path])
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def get(self, source, info, upload_directory):
+        """ The stored file reference of the remote file described by info, or None when it must be fetched """
+        try:
+            with open(self._entry_path(source, info["path"])) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        current = entry is not None and all(entry.get(key) == info[key] for key in ("etag", "modified", "size")) \
+            and os.path.isfile(os.path.join(upload_directory, entry["file"]))
+        with self._lock:
+            if current:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry if current else None
+
+    def put(self, source, info, file_ref):
+        entry = {key: info[key] for key in ("path", "etag", "modified", "size")}
+        entry.update(source=source, **{key: file_ref[key] for key in ("file", "filename", "digest")})
+        entry_path = self._entry_path(source, info["path"])
+        temp_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(temp_path, entry_path)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def _copy_range(connector, path, part_path, start, end, on_bytes):
+    with open(part_path, "r+b") as f:
+        f.seek(start)
+        for piece in connector.read_range(path, start, end):
+            f.write(piece)
+            on_bytes(len(piece))
+        written = f.tell() - start
+    if end is not None and written != end - start:
+        raise ConnectorError(f"Got {written} of the {end - start} bytes from {start} of {path}")
+    return written
+
+
+def fetch(connector, source, path, directory, cache=None, workers=DOWNLOAD_WORKERS,
+          chunk_size=DOWNLOAD_CHUNK_SIZE, progress=None):
+    """ Download a remote file into directory like an upload; returns its file reference
+
+    The reference has the keys of an upload's (file, filename, digest,
+    duplicate) and cached, which is True when the file was already there.
+    Files that can be read in ranges are fetched chunk_size bytes at a time
+    on workers threads.  progress, when given, is called with (bytes
+    fetched, size or None) as bytes arrive.
+    """
+    info = connector.stat(path)
+    if info["folder"]:
+        raise ConnectorError(f"{info['name']} is a folder")
+    if cache is not None:
+        entry = cache.get(source, info, directory)
+        if entry is not None:
+            return {"file": entry["file"], "filename": entry["filename"], "digest": entry["digest"],
+                    "duplicate": True, "cached": True}
+
+    size = info["size"]
+    fetched = [0]
+    lock = threading.Lock()
+
+    def on_bytes(count):
+        with lock:
+            fetched[0] += count
+            done = fetched[0]
+        if progress is not None:
+            progress(done, size)
+
+    part_path = os.path.join(directory, f"import-{uuid.uuid4().hex}.part")
+    try:
+        with open(part_path, "wb") as f:
+            if size:
+                f.truncate(size)
+        if size and info["ranges"] and size > chunk_size:
+            ranges = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                futures = [pool.submit(_copy_range, connector, path, part_path, start, end, on_bytes)
+                           for start, end in ranges]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # Don't start the ranges still waiting once one has failed
+                    for future in futures:
+                        future.cancel()
+                    raise
+        else:
+            _copy_range(connector, path, part_path, 0, size, on_bytes)
+        stored_path, digest, duplicate = uploads.finish_upload(directory, part_path, info["name"])
+    except BaseException:
+        uploads.discard(part_path)
+        raise
+
+    file_ref = {"file": os.path.basename(stored_path), "filename": info["name"], "digest": digest,
+                "duplicate": duplicate, "cached": False}
+    if cache is not None:
+        cache.put(source, info, file_ref)
+    return file_ref
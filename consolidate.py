@@ -0,0 +1,184 @@
+""" Load many sheets of many workbooks into one table
+
+Registers are often split into a sheet per site and across several
+workbooks.  consolidate() picks sheets from every file with a rule, parses
+them concurrently on a pool of worker processes, lines their columns up by
+header and tags every row with the file and sheet it came from.
+"""
+import fnmatch
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import readers
+from schema import normalize_dtypes
+
+SOURCE_FILE_COLUMN = "Source File"
+SOURCE_SHEET_COLUMN = "Source Sheet"
+
+# How sheets are picked from each workbook: every sheet, names matching a
+# glob pattern such as "Site *" (several separated by commas), or a list of names
+SHEET_RULES = ("all", "pattern", "list")
+
+
+def select_sheets(sheet_names, rule="all", selection=None):
+    """ The sheets of one workbook picked by a sheet rule, in workbook order """
+    if rule == "all":
+        return list(sheet_names)
+    if rule == "pattern":
+        patterns = [pattern.strip() for pattern in (selection or "").split(",") if pattern.strip()]
+        return [name for name in sheet_names if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+    if rule == "list":
+        if isinstance(selection, str):
+            selection = [selection]
+        wanted = set(selection or [])
+        return [name for name in sheet_names if name in wanted]
+    raise ValueError(f"Unknown sheet rule {rule!r}, expected one of {SHEET_RULES}")
+
+
+def plan_sheets(files, rule="all", selection=None, sheet_names=None):
+    """ The (file, sheet) pairs to load, and reports for the files that give none
+
+    sheet_names maps a file to its sheets when they are already known;
+    other workbooks are opened to list them.  CSV files have a single
+    unnamed sheet, None, which every rule picks.
+    """
+    tasks = []
+    reports = []
+    for file_path in files:
+        if readers.is_csv(file_path):
+            tasks.append((file_path, None))
+            continue
+        try:
+            names = (sheet_names or {}).get(file_path)
+            if names is None:
+                names = readers.list_sheets(file_path)
+        except Exception as e:
+            reports.append(_sheet_report(file_path, None, "error", error=f"{type(e).__name__}: {e}"))
+            continue
+        selected = select_sheets(names, rule, selection)
+        if not selected:
+            reports.append(_sheet_report(file_path, None, "skipped", error="No sheet matches the selection"))
+        tasks.extend((file_path, name) for name in selected)
+    return tasks, reports
+
+
+def _sheet_report(file_path, sheet_name, status, **fields):
+    return {"file": os.path.basename(file_path), "sheet": sheet_name, "status": status, **fields}
+
+
+def read_sheet(file_path, sheet_name, header_row=0, columns=None):
+    """ Parse one sheet in a worker process; returns the table, or None, and its report """
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        df = normalize_dtypes(readers.read_table(file_path, sheet_name, header_row, columns))
+    except Exception as e:
+        df = None
+        report = _sheet_report(file_path, sheet_name, "error", error=f"{type(e).__name__}: {e}")
+    else:
+        report = _sheet_report(file_path, sheet_name, "ok", rows=len(df), columns=len(df.columns))
+    report["seconds"] = round(time.perf_counter() - wall, 4)
+    report["cpu_seconds"] = round(time.process_time() - cpu, 4)
+    return df, report
+
+
+def _tag_sources(frames, tasks, display_names):
+    """ Categorical Source File and Source Sheet columns for frames stacked in task order """
+    lengths = [len(frame) for frame in frames]
+    files = list(dict.fromkeys(display_names.get(path, os.path.basename(path)) for path, _ in tasks))
+    sheets = list(dict.fromkeys(sheet or "" for _, sheet in tasks))
+    file_codes = [files.index(display_names.get(path, os.path.basename(path))) for path, _ in tasks]
+    sheet_codes = [sheets.index(sheet or "") for _, sheet in tasks]
+    return (
+        pd.Categorical.from_codes(np.repeat(file_codes, lengths), categories=files),
+        pd.Categorical.from_codes(np.repeat(sheet_codes, lengths), categories=sheets),
+    )
+
+
+def consolidate(files, rule="all", selection=None, header_row=0, columns=None, sheet_names=None,
+                display_names=None, workers=None, mp_context=None, cache=None, progress=None):
+    """ Load the sheets picked by rule from every file into one DataFrame
+
+    Sheets are parsed on up to workers processes (one per CPU by default);
+    a single sheet is parsed in this process.  cache, a ParseCache, is
+    checked before parsing and filled afterwards.  Columns are matched by
+    header name, so a column missing from a sheet is blank in its rows, and
+    the rows are tagged with SOURCE_FILE_COLUMN (the file's name in
+    display_names, or its base name) and SOURCE_SHEET_COLUMN.  progress,
+    when given, is called with (sheets done, number of sheets).
+
+    Returns the table, or None when no sheet could be loaded, and a report
+    with every sheet's status, size and timings.
+    """
+    started = time.perf_counter()
+    display_names = display_names or {}
+    tasks, reports = plan_sheets(files, rule, selection, sheet_names)
+    frames = {}
+    sheet_reports = {}
+
+    pending = []
+    for task in tasks:
+        df = cache.get(task[0], task[1], header_row, columns) if cache is not None else None
+        if df is None:
+            pending.append(task)
+        else:
+            frames[task] = df
+            sheet_reports[task] = _sheet_report(*task, "ok", rows=len(df), columns=len(df.columns),
+                                                seconds=0.0, cached=True)
+
+    def finish(task, df, report):
+        sheet_reports[task] = report
+        if df is not None:
+            frames[task] = df
+            if cache is not None:
+                cache.put(task[0], task[1], header_row, df, columns)
+        if progress is not None:
+            progress(len(sheet_reports), len(tasks))
+
+    if len(pending) <= 1 or workers == 1:
+        for task in pending:
+            finish(task, *read_sheet(*task, header_row, columns))
+    else:
+        workers = min(workers or os.cpu_count() or 1, len(pending))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+            futures = {pool.submit(read_sheet, *task, header_row, columns): task for task in pending}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    df, report = future.result()
+                except Exception as e:  # The worker died, e.g. out of memory
+                    df, report = None, _sheet_report(*task, "error", error=f"{type(e).__name__}: {e}")
+                finish(task, df, report)
+
+    loaded = [task for task in tasks if task in frames]
+    df = None
+    if loaded:
+        stacked = [frames[task] for task in loaded]
+        df = stacked[0] if len(stacked) == 1 else pd.concat(stacked, ignore_index=True, sort=False)
+        source_file, source_sheet = _tag_sources(stacked, loaded, display_names)
+        df = df.assign(**{SOURCE_FILE_COLUMN: source_file, SOURCE_SHEET_COLUMN: source_sheet})
+        # Sheets' categories differ, so concatenated text columns come back as objects
+        df = normalize_dtypes(df)
+        for task in loaded:
+            missing = [col for col in df.columns
+                       if col not in frames[task].columns and col not in (SOURCE_FILE_COLUMN, SOURCE_SHEET_COLUMN)]
+            if missing:
+                sheet_reports[task]["missing_columns"] = missing
+
+    reports.extend(sheet_reports[task] for task in tasks)
+    shown_names = {os.path.basename(path): name for path, name in display_names.items()}
+    for entry in reports:
+        entry["file"] = shown_names.get(entry["file"], entry["file"])
+    report = {
+        "files": len(files),
+        "sheets": len(tasks),
+        "loaded": len(loaded),
+        "failed": sum(entry["status"] == "error" for entry in reports),
+        "rows": 0 if df is None else len(df),
+        "seconds": round(time.perf_counter() - started, 4),
+        "reports": reports,
+    }
+    return df, report
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Connections idle for longer than this are checked with a round trip before reuse
+HEALTH_CHECK_AFTER = 30.0
+
+
+class PoolTimeout(Exception):
+    """ Raised when no connection frees up within the pool's timeout """
+
+
+def database_errors():
+    """ The exceptions a database call can raise, for an except clause
+
+    psycopg2 is only imported when this is called, which an except clause
+    does once an exception is raised, so importing db stays cheap.
+    """
+    import psycopg2
+
+    return psycopg2.Error, PoolTimeout
+
+
+class ConnectionPool:
+    """ A bounded pool of Postgres connections for one worker process
+
+    getconn() hands out an idle connection, opens a new one while fewer than
+    max_size exist, or waits up to timeout seconds for one to be returned.
+    Connections are checked before reuse and dropped when broken.
+    """
+
+    def __init__(self, config, max_size=5, timeout=10.0, health_check_after=HEALTH_CHECK_AFTER):
+        self.config = config
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self._idle = []  # (connection, time it was returned)
+        self._size = 0
+        self._condition = threading.Condition()
+        self.counters = {
+            "checkouts": 0,
+            "connects": 0,
+            "discarded": 0,
+            "health_checks": 0,
+            "timeouts": 0,
+            "waits": 0,
+        }
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _connect(self):
+        import psycopg2
+
+        conn = psycopg2.connect(**self.config)
+        with self._condition:
+            self.counters["connects"] += 1
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        with self._condition:
+            self.counters["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        self.counters["discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        while True:
+            conn = None
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        raise PoolTimeout(f"No database connection free after {self.timeout}s")
+                    waited = True
+                    self._condition.wait(remaining)
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    self._size += 1
+
+            # Checks and new connections happen outside the lock so other threads aren't held up
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            elif not self._healthy(conn, idle_since):
+                with self._condition:
+                    self._discard(conn)
+                    self._size -= 1
+                    self._condition.notify()
+                continue
+            with self._condition:
+                self._checked_out(started, waited)
+            return conn
+
+    def _checked_out(self, started, waited):
+        waited_for = time.monotonic() - started
+        self.counters["checkouts"] += 1
+        if waited:
+            self.counters["waits"] += 1
+        self.wait_seconds += waited_for
+        self.max_wait_seconds = max(self.max_wait_seconds, waited_for)
+
+    def putconn(self, conn):
+        """ Return a connection, rolling back whatever transaction it was left in """
+        keep = not conn.closed
+        if keep:
+            try:
+                conn.rollback()
+            except Exception:
+                keep = False
+        with self._condition:
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+                self._size -= 1
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            for conn, _ in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._condition:
+            checkouts = self.counters["checkouts"]
+            return {
+                **self.counters,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+                "mean_wait_ms": round(1000 * self.wait_seconds / checkouts, 3) if checkouts else 0.0,
+                "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+            }
+
+
+# The pool of this worker process; forked workers each build their own
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(config):
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                config,
+                max_size=int(os.environ.get("DB_POOL_MAX_SIZE", 5)),
+                timeout=float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@contextmanager
+def connection(config):
+    """ Borrow a pooled connection for the duration of a with block """
+    pool = get_pool(config)
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
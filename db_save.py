@@ -0,0 +1,265 @@
+""" Save tables to Postgres in bulk with COPY
+
+The table is streamed to COPY FROM STDIN as CSV, a chunk of rows at a
+time, so saving doesn't need a second copy of it in memory.  In upsert mode
+the rows are copied into a temporary staging table first and then merged
+into the target on a key column, "Asset Code" by default.  The whole save
+is one transaction.
+
+Tables are saved into their own schema, SAVE_SCHEMA, never next to the
+tables the app runs on, so a save (a replace drops the table first) can't
+touch those.
+"""
+import os
+import re
+import time
+
+import pandas as pd
+
+import db
+from asset_codes import COUNTER_TABLE
+from schema import ARROW_STRING
+
+# Rows converted to CSV per chunk
+SAVE_CHUNK_ROWS = 50_000
+
+# Bytes handed to the server per read of the COPY stream
+COPY_READ_SIZE = 1024 * 1024
+
+# Memory the upsert may hash the staging table in before spilling to disk
+MERGE_WORK_MEM = os.environ.get("DB_SAVE_WORK_MEM", "256MB")
+
+# append adds the rows, replace swaps the whole table for them, upsert
+# inserts new keys and updates the rows of keys that are already there
+SAVE_MODES = ("append", "replace", "upsert")
+UPSERT_KEY = "Asset Code"
+
+# A unique index on just the key column, so the merge matches at most one row per key
+KEY_INDEX = """
+SELECT 1 FROM pg_index i
+JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+WHERE i.indrelid = to_regclass(quote_ident(split_part(%(table)s, '.', 1))
+                               || coalesce('.' || quote_ident(nullif(split_part(%(table)s, '.', 2), '')), ''))
+  AND i.indisunique AND i.indnkeyatts = 1 AND a.attname = %(key)s
+"""
+
+_TABLE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+# The schema saved tables go to, created on the first save
+SAVE_SCHEMA = os.environ.get("DB_SAVE_SCHEMA", "saved_tables")
+
+# Tables the app itself uses, which no saved table may be named after
+APP_TABLES = ("users", COUNTER_TABLE)
+
+# CREATE SCHEMA IF NOT EXISTS can still fail when two sessions run it at once
+CREATE_SCHEMA = """
+SELECT pg_advisory_xact_lock(hashtext('save_schema'));
+CREATE SCHEMA IF NOT EXISTS {}
+"""
+
+
+def sql_type(column):
+    """ The Postgres type a column is stored as """
+    dtype = column.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "bigint"
+    if pd.api.types.is_float_dtype(dtype):
+        return "double precision"
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return "timestamp with time zone"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "timestamp"
+    return "text"
+
+
+def iter_copy_csv(df, chunk_rows=SAVE_CHUNK_ROWS, progress=None):
+    """ Yield df as CSV for COPY, without a header
+
+    Arrow's CSV writer is about ten times faster than DataFrame.to_csv.  It
+    quotes every string and leaves missing values as bare empty fields,
+    which is how COPY's csv format tells an empty string from NULL.
+    """
+    import pyarrow as pa
+    import pyarrow.csv
+
+    options = pyarrow.csv.WriteOptions(include_header=False)
+    # Columns of mixed Python objects don't convert to Arrow as they are
+    mixed = [column for column in df.columns if df[column].dtype == object]
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        if mixed:
+            chunk = chunk.astype({column: ARROW_STRING for column in mixed})
+        sink = pa.BufferOutputStream()
+        pyarrow.csv.write_csv(pa.Table.from_pandas(chunk, preserve_index=False), sink, options)
+        yield sink.getvalue().to_pybytes()
+        if progress is not None:
+            progress(start + len(chunk), len(df))
+
+
+class ChunkStream:
+    """ A read-only file over an iterator of byte strings, for cursor.copy_expert """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b""
+        self._position = 0
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._position >= len(self._chunk):
+                self._chunk = next(self._chunks, b"")
+                self._position = 0
+                if not self._chunk:
+                    break
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._position + size)
+            parts.append(self._chunk[self._position:end])
+            if size > 0:
+                size -= end - self._position
+            self._position = end
+        data = b"".join(parts)
+        self.bytes_read += len(data)
+        return data
+
+
+def saved_table_name(table, schema=SAVE_SCHEMA):
+    """ The schema-qualified name a table is saved under, e.g. "asset_register" -> "saved_tables.asset_register"
+
+    Raises ValueError for names that aren't plain identifiers, that name
+    another schema or that are the name of one of the app's own tables.
+    """
+    if not _TABLE_NAME.match(table or ""):
+        raise ValueError(f"Invalid table name {table!r}, use letters, digits and underscores, e.g. asset_register")
+    table_schema, _, name = table.rpartition(".")
+    if table_schema and table_schema.lower() != schema.lower():
+        raise ValueError(f"Tables can only be saved to the {schema} schema, not to {table_schema}")
+    if name.lower() in APP_TABLES:
+        raise ValueError(f"{name} is a table of the app itself, choose another name")
+    return f"{schema}.{name}"
+
+
+def save_table(df, table, config, mode="upsert", key=UPSERT_KEY, chunk_rows=SAVE_CHUNK_ROWS, progress=None,
+               schema=SAVE_SCHEMA):
+    """ Write df to the Postgres table in schema, creating it when it doesn't exist yet; returns a report
+
+    table is a name like "asset_register", see saved_table_name for the
+    names refused.  Readers see all of the save or none of it.  In upsert mode rows with a
+    blank key are skipped, and of rows sharing a key the last one wins; a new table gets key as its primary
+    key, an existing one needs a unique constraint on it.  progress, when
+    given, is called with (rows sent, number of rows) after each chunk.
+    """
+    from psycopg2 import sql
+
+    if mode not in SAVE_MODES:
+        raise ValueError(f"Unknown save mode {mode!r}, expected one of {SAVE_MODES}")
+    if mode == "upsert" and key not in df.columns:
+        raise ValueError(f"Upserting needs a {key!r} column")
+    if not df.columns.is_unique:
+        raise ValueError("Column names must be unique to be saved")
+
+    started = time.perf_counter()
+    table = saved_table_name(table, schema)
+    target = sql.Identifier(*table.split("."))
+    names = [sql.Identifier(str(name)) for name in df.columns]
+    column_list = sql.SQL(", ").join(names)
+    definitions = [sql.SQL("{} {}").format(name, sql.SQL(sql_type(df[column])))
+                   for name, column in zip(names, df.columns)]
+    if mode == "upsert":
+        definitions.append(sql.SQL("PRIMARY KEY ({})").format(sql.Identifier(key)))
+
+    report = {"table": table, "mode": mode, "rows": len(df), "columns": len(df.columns)}
+    rows = df
+    if mode == "upsert":
+        # Rows with a blank key are skipped, and of rows sharing a key the last one is kept
+        keys = df[key]
+        keep = ~(keys.isna() | (keys == "")).to_numpy()
+        keep[keep] = ~keys[keep].duplicated(keep="last").to_numpy()
+        if not keep.all():
+            rows = df[keep]
+        report["skipped"] = len(df) - len(rows)
+    with db.connection(config) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL(CREATE_SCHEMA).format(sql.Identifier(schema)))
+            if mode == "replace":
+                cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(target))
+            cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(
+                target, sql.SQL(", ").join(definitions)))
+
+            copy_into = target
+            if mode == "upsert":
+                cur.execute(KEY_INDEX, {"table": table, "key": key})
+                if cur.fetchone() is None:
+                    raise ValueError(f"{table} has no unique constraint on {key!r} to upsert on, "
+                                     f"add one or save to a new table")
+                copy_into = sql.Identifier("save_staging")
+                cur.execute(sql.SQL("CREATE TEMPORARY TABLE {} ({}) ON COMMIT DROP").format(
+                    copy_into, sql.SQL(", ").join(definitions[:-1])))
+
+            copy_started = time.perf_counter()
+            stream = ChunkStream(iter_copy_csv(rows, chunk_rows, progress))
+            copy = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(copy_into, column_list)
+            cur.copy_expert(copy.as_string(conn), stream, size=COPY_READ_SIZE)
+            report["copy_seconds"] = round(time.perf_counter() - copy_started, 4)
+            report["bytes"] = stream.bytes_read
+
+            if mode == "upsert":
+                report.update(_merge(cur, target, copy_into, df.columns, key))
+                report["unchanged"] = len(rows) - report["inserted"] - report["updated"]
+            conn.commit()
+
+    seconds = time.perf_counter() - started
+    report["seconds"] = round(seconds, 4)
+    report["rows_per_second"] = round(len(df) / seconds, 1) if seconds else 0.0
+    return report
+
+
+def _merge(cur, target, staging, columns, key):
+    """ Upsert the staging table's rows, one per key, into target; returns the counts of inserted and updated rows
+
+    The merge is an UPDATE of the keys that are already there followed by
+    an INSERT of the rest, both joined on the key.  For large tables that is
+    about twice as fast as INSERT ... ON CONFLICT, which probes the key
+    index row by row.  The target is locked against other writers
+    meanwhile, so no key can be inserted between the two statements.
+    """
+    from psycopg2 import sql
+
+    parts = {
+        "target": target,
+        "staging": staging,
+        "key": sql.Identifier(key),
+        "columns": sql.SQL(", ").join(sql.Identifier(str(name)) for name in columns),
+        "staged_columns": sql.SQL(", ").join(sql.SQL("s.{}").format(sql.Identifier(str(name))) for name in columns),
+    }
+    cur.execute("SET LOCAL work_mem = %s", (MERGE_WORK_MEM,))
+    cur.execute(sql.SQL("LOCK TABLE {target} IN SHARE ROW EXCLUSIVE MODE").format(**parts))
+
+    # Temporary tables are never analyzed automatically, and without
+    # statistics the planner joins them by nested loops
+    cur.execute(sql.SQL("ANALYZE {staging}").format(**parts))
+
+    values = [sql.Identifier(str(name)) for name in columns if name != key]
+    updated = 0
+    if values:
+        # Rows whose values are all the same aren't rewritten, which keeps saving a table again cheap
+        cur.execute(sql.SQL("""
+            UPDATE {target} AS t SET ({values}) = ROW({staged_values})
+            FROM {staging} AS s
+            WHERE t.{key} = s.{key} AND ({target_values}) IS DISTINCT FROM ({staged_values})
+        """).format(
+            values=sql.SQL(", ").join(values),
+            staged_values=sql.SQL(", ").join(sql.SQL("s.{}").format(name) for name in values),
+            target_values=sql.SQL(", ").join(sql.SQL("t.{}").format(name) for name in values),
+            **parts,
+        ))
+        updated = cur.rowcount
+    cur.execute(sql.SQL("""
+        INSERT INTO {target} ({columns})
+        SELECT {staged_columns} FROM {staging} AS s
+        WHERE NOT EXISTS (SELECT 1 FROM {target} AS t WHERE t.{key} = s.{key})
+    """).format(**parts))
+    inserted = cur.rowcount
+    return {"inserted": inserted, "updated": updated}
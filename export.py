@@ -0,0 +1,246 @@
+import importlib.util
+import os
+
+import pandas as pd
+
+# Rows converted and written per batch, which bounds the memory an export needs
+EXPORT_CHUNK_ROWS = 50_000
+
+# Excel sheets stop at 1,048,576 rows (including the header)
+EXCEL_MAX_ROWS = 1_048_575
+
+# Export format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", ".xlsx"),
+    "csv": ("text/csv", ".csv"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+
+
+def _chunks(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+def _cell_rows(chunk):
+    """ Rows of a chunk as tuples of plain values, with blanks as None """
+    values = chunk.astype(object)
+    return values.where(chunk.notna(), None).itertuples(index=False, name=None)
+
+
+def iter_csv(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    """ Yield the CSV encoding of df in pieces, for a streamed response """
+    yield df.iloc[:0].to_csv(index=False).encode()
+    for chunk in _chunks(df, chunk_rows):
+        yield chunk.to_csv(header=False, index=False).encode()
+
+
+def write_csv(df, path):
+    """ Write df to a CSV file in batches """
+    with open(path, "wb") as f:
+        for piece in iter_csv(df):
+            f.write(piece)
+    return path
+
+
+def write_csv_chunks(chunks, path, columns):
+    """ Write a table arriving in chunks to a CSV file; returns the number of rows written """
+    rows = 0
+    with open(path, "wb") as f:
+        f.write(pd.DataFrame(columns=columns).to_csv(index=False).encode())
+        for chunk in chunks:
+            f.write(chunk.to_csv(header=False, index=False).encode())
+            rows += len(chunk)
+    return rows
+
+
+def write_xlsx(df, path, sheet_name="Sheet1"):
+    """ Write df to a workbook without holding the whole sheet in memory """
+    write_xlsx_chunks(_chunks(df), path, df.columns, sheet_name)
+    return path
+
+
+def write_xlsx_chunks(chunks, path, columns, sheet_name="Sheet1"):
+    """ Write a table arriving in chunks to a workbook; returns the number of rows written
+
+    Uses XlsxWriter in constant-memory mode when it is installed, otherwise
+    openpyxl's write-only mode.  Rows that don't fit on one sheet continue
+    on the next, "Sheet1 (2)" and so on, each starting with the header.
+    """
+    header = [str(col) for col in columns]
+    rows = (row for chunk in chunks for row in _cell_rows(chunk))
+    written = 0
+
+    if importlib.util.find_spec("xlsxwriter") is not None:
+        import xlsxwriter
+
+        workbook = xlsxwriter.Workbook(path, {
+            "constant_memory": True,
+            "nan_inf_to_errors": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        })
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, header)
+        for row in rows:
+            sheet_row = written % EXCEL_MAX_ROWS
+            if written and not sheet_row:
+                worksheet = workbook.add_worksheet(f"{sheet_name} ({written // EXCEL_MAX_ROWS + 1})")
+                worksheet.write_row(0, 0, header)
+            worksheet.write_row(sheet_row + 1, 0, row)
+            written += 1
+        workbook.close()
+        return written
+
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet_name)
+    worksheet.append(header)
+    for row in rows:
+        if written and not written % EXCEL_MAX_ROWS:
+            worksheet = workbook.create_sheet(f"{sheet_name} ({written // EXCEL_MAX_ROWS + 1})")
+            worksheet.append(header)
+        worksheet.append(row)
+        written += 1
+    workbook.save(path)
+    return written
+
+
+def parquet_safe(df):
+    """ Turn mixed-type text/number columns into text so Arrow can store them """
+    df = df.copy(deep=False)
+    df.columns = [str(col) for col in df.columns]
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) in ("mixed", "mixed-integer"):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def write_parquet(df, path):
+    """ Write df to a Parquet file one row group at a time """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = parquet_safe(df)
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in _chunks(df):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    return path
+
+
+def _plain_arrow(chunk):
+    """ A chunk as an Arrow table of plain types: categoricals decoded, all text as string """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(parquet_safe(chunk), preserve_index=False).replace_schema_metadata(None)
+    fields = []
+    for field in table.schema:
+        arrow_type = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+        fields.append(pa.field(field.name, pa.string() if pa.types.is_large_string(arrow_type) else arrow_type))
+    return table.cast(pa.schema(fields))
+
+
+def _wider_type(current, new):
+    """ A type that holds the values of both: integers widen to floats, anything else mixed to text """
+    import pyarrow as pa
+
+    if current == new or pa.types.is_null(new):
+        return current
+    if pa.types.is_null(current):
+        return new
+    if pa.types.is_integer(current) and pa.types.is_integer(new):
+        return pa.int64()
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (current, new)):
+        return pa.float64()
+    return pa.string()
+
+
+def write_parquet_chunks(chunks, path, columns):
+    """ Write a table arriving in chunks to a Parquet file, a row group per chunk; returns the number of rows written
+
+    Column types come from the chunks seen so far.  A chunk that doesn't fit
+    them, e.g. text in a column that held numbers, starts a new part with
+    wider types, and the parts are merged into one file at the end.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parts = []
+    schema = None
+    writer = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            table = _plain_arrow(chunk)
+            wider = table.schema if schema is None else pa.schema(
+                [pa.field(field.name, _wider_type(field.type, new)) for field, new in zip(schema, table.schema.types)])
+            if schema is None or not wider.equals(schema):
+                if writer is not None:
+                    writer.close()
+                parts.append(f"{path}.part{len(parts)}")
+                schema = wider
+                writer = pq.ParquetWriter(parts[-1], schema)
+            writer.write_table(table.cast(schema))
+            rows += len(chunk)
+        if writer is not None:
+            writer.close()
+            writer = None
+
+        if not parts:
+            pq.write_table(pa.table({str(col): pa.array([], pa.null()) for col in columns}), path)
+        elif len(parts) == 1:
+            os.replace(parts[0], path)
+        else:
+            # Rewrite the parts with the types of the last one, which hold every value
+            with pq.ParquetWriter(path, schema) as merged:
+                for part in parts:
+                    part_file = pq.ParquetFile(part)
+                    for index in range(part_file.num_row_groups):
+                        merged.write_table(part_file.read_row_group(index).cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+    return rows
+
+
+# Export format -> function writing a frame to a file in that format
+WRITERS = {
+    "xlsx": write_xlsx,
+    "csv": write_csv,
+    "parquet": write_parquet,
+}
+
+# Export format -> function (chunks, path, columns) writing a table that arrives in chunks
+CHUNK_WRITERS = {
+    "xlsx": write_xlsx_chunks,
+    "csv": write_csv_chunks,
+    "parquet": write_parquet_chunks,
+}
+
+
+def export_file(df, export_format, path, progress=None):
+    """ Write df to path in export_format batch by batch; returns the number of rows written
+
+    progress, when given, is called with (rows written, total rows) after
+    every batch.  The file only appears at path once it is complete.
+    """
+    def chunks():
+        done = 0
+        for chunk in _chunks(df):
+            yield chunk
+            done += len(chunk)
+            if progress is not None:
+                progress(done, len(df))
+
+    temp_path = f"{path}.tmp"
+    try:
+        rows = CHUNK_WRITERS[export_format](chunks(), temp_path, df.columns)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return rows
@@ -0,0 +1,56 @@
+""" Gunicorn settings, read from the working directory by the Procfile's gunicorn
+
+The app is preloaded by default: the master imports it and does the first
+request's setup once, then forks the workers, which start in milliseconds
+and share the master's memory for modules, layout and callbacks.  Set
+GUNICORN_PRELOAD=0 to have every worker import the app itself instead, e.g.
+to reload code with a HUP signal.
+
+Every worker records how long it took from being forked to being ready
+and its memory then, in the app_worker_* metrics and the log.
+"""
+import gc
+import os
+import time
+
+import metrics
+
+# When the server started, before the app was imported
+STARTED = time.perf_counter()
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def when_ready(server):
+    """ In the master, once it listens and before it forks the workers """
+    if preload_app:
+        import app
+
+        app.warm_up()
+        # Objects that live as long as the app are kept out of the collector's
+        # sweeps, which would otherwise write to, and so copy, their shared pages
+        gc.freeze()
+    memory = metrics.process_memory()
+    server.log.info("Ready in %.2fs, master RSS %.0f MB (preload %s)",
+                    time.perf_counter() - STARTED, memory["rss"] / 2 ** 20, "on" if preload_app else "off")
+
+
+def post_fork(server, worker):
+    """ In each worker, right after it was forked """
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    """ In each worker, after it loaded the app and before it serves requests """
+    import app
+
+    if not preload_app:
+        app.warm_up()
+    seconds = time.perf_counter() - worker.forked_at
+    memory = metrics.process_memory()
+    metrics.registry.observe("app_worker_start_seconds", seconds)
+    metrics.registry.observe("app_worker_memory_bytes", memory["rss"], kind="rss")
+    if memory["pss"] is not None:
+        metrics.registry.observe("app_worker_memory_bytes", memory["pss"], kind="pss")
+    metrics.registry.flush()
+    worker.log.info("Worker %s ready in %.2fs, RSS %.0f MB", worker.pid, seconds, memory["rss"] / 2 ** 20)
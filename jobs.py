@@ -0,0 +1,54 @@
+import uuid
+
+from dash.dependencies import Output
+
+# Where job arguments, progress and results are kept, so any worker can poll a job
+JOB_CACHE_DIRECTORY = "job_cache"
+
+# Progress of the running job: the progress bar's value and max, and a status line
+JOB_PROGRESS = [
+    Output("job-progress", "value"),
+    Output("job-progress", "max"),
+    Output("job-status", "children"),
+]
+
+
+def make_background_manager(directory=JOB_CACHE_DIRECTORY, expire=3600):
+    """ Run background callbacks in separate processes, with their state in a disk cache """
+    import diskcache
+    from dash import DiskcacheManager
+
+    return DiskcacheManager(diskcache.Cache(directory), expire=expire)
+
+
+def job_running(button_id, pipeline_step=False):
+    """ Outputs to toggle while a job started by button_id runs
+
+    A pipeline step holds the session's lock, so undo and redo are disabled until it is done.
+    """
+    running = [
+        (Output(button_id, "disabled"), True, False),
+        (Output("cancel-job-button", "style"), {"display": "inline"}, {"display": "none"}),
+        (Output("job-progress", "style"), {"display": "inline"}, {"display": "none"}),
+    ]
+    if pipeline_step:
+        running += [(Output("undo-button", "disabled"), True, False), (Output("redo-button", "disabled"), True, False)]
+    return running
+
+
+class JobProgress:
+    """ Reports the progress of one background job, tagged with its job id """
+
+    def __init__(self, set_progress, title):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.title = title
+        self.set_progress = set_progress
+
+    def __call__(self, percent, step):
+        self.set_progress((percent, 100, f"Job {self.job_id} - {self.title}: {step} ({percent}%)"))
+
+    def steps(self, start=10, end=80):
+        """ A callback for OperationLog.run that spreads its steps between start and end percent """
+        def report(number, total, operation):
+            self(start + (end - start) * number // total, f"running {operation} ({number + 1}/{total})")
+        return report
@@ -0,0 +1,298 @@
+""" Timing, memory and size histograms for callbacks and routes, in the Prometheus text format
+
+Callbacks run in web workers and in background job processes, so every
+process keeps its own counts and writes them to METRICS_DIRECTORY after each
+observation; /metrics adds up the files of all processes.
+"""
+import contextvars
+import cProfile
+import fcntl
+import functools
+import glob
+import json
+import math
+import os
+import random
+import resource
+import threading
+import time
+import uuid
+
+METRICS_DIRECTORY = "metrics"
+
+# Requests sending this header with the value of PROFILE_TOKEN are run under
+# cProfile; a PROFILE_SAMPLE_RATE share of all requests is profiled too, and
+# their profile kept when they take at least PROFILE_MIN_SECONDS
+PROFILE_DIRECTORY = "profiles"
+PROFILE_HEADER = "X-Profile"
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KiB to 1 GiB
+COUNT_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# Metric -> (help text, buckets)
+HISTOGRAMS = {
+    "app_callback_seconds": ("Wall time of Dash callbacks", SECONDS_BUCKETS),
+    "app_callback_cpu_seconds": ("CPU time of Dash callbacks", SECONDS_BUCKETS),
+    "app_callback_peak_memory_delta_bytes": ("How much a callback raised its process's peak RSS", BYTES_BUCKETS),
+    "app_callback_input_rows": ("Rows of the largest table a callback read", COUNT_BUCKETS),
+    "app_worker_start_seconds": ("Time from a web worker being forked to it being ready", SECONDS_BUCKETS),
+    "app_worker_memory_bytes": ("Memory of a web worker once it is ready, resident and proportional (PSS)",
+                                BYTES_BUCKETS),
+    "app_callback_input_columns": ("Columns of the largest table a callback read", (1, 5, 10, 20, 50, 100, 500)),
+    "app_request_seconds": ("Wall time of HTTP requests", SECONDS_BUCKETS),
+    "app_request_cpu_seconds": ("CPU time of HTTP requests", SECONDS_BUCKETS),
+    "app_response_bytes": ("Size of HTTP responses", BYTES_BUCKETS),
+}
+
+# The table sizes seen by the callback running in this context
+_current = contextvars.ContextVar("metrics_current", default=None)
+
+
+class Registry:
+    """ Histogram counts of one process, written through to its own file """
+
+    def __init__(self, directory=METRICS_DIRECTORY):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._values = {}
+
+    def observe(self, metric, value, **labels):
+        buckets = HISTOGRAMS[metric][1]
+        key = metric + json.dumps(sorted(labels.items()))
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked job process starts from its parent's counts; only count its own
+                self._pid = os.getpid()
+                self._values = {}
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def flush(self):
+        """ Write this process's counts for /metrics to pick up """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._write()
+
+    def _write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self._pid}.json")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._values, f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """ Counts of every process, folding those of processes that have exited into one file """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "merge.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged_path = os.path.join(self.directory, "exited.json")
+            exited = _read(merged_path)
+            totals = dict(exited)
+            folded = []
+            for path in glob.glob(os.path.join(self.directory, "[0-9]*.json")):
+                values = _read(path)
+                _add(totals, values)
+                if not _alive(int(os.path.basename(path)[:-len(".json")])):
+                    _add(exited, values)
+                    folded.append(path)
+            if folded:
+                tmp_path = f"{merged_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(exited, f)
+                os.replace(tmp_path, merged_path)
+                for path in folded:
+                    os.remove(path)
+        return totals
+
+    def render(self):
+        """ All histograms in the Prometheus text exposition format """
+        totals = self.collect()
+        lines = []
+        for metric, (help_text, buckets) in HISTOGRAMS.items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for key in sorted(k for k in totals if k.startswith(metric + "[")):
+                labels = json.loads(key[len(metric):])
+                counts = totals[key]
+                for bound, count in zip(buckets, counts):
+                    lines.append(f"{metric}_bucket{_labels(labels, le=_number(bound))} {count}")
+                lines.append(f"{metric}_bucket{_labels(labels, le='+Inf')} {counts[-1]}")
+                lines.append(f"{metric}_sum{_labels(labels)} {_number(counts[-2])}")
+                lines.append(f"{metric}_count{_labels(labels)} {counts[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _add(totals, values):
+    for key, counts in values.items():
+        if key in totals and len(totals[key]) == len(counts):
+            totals[key] = [a + b for a, b in zip(totals[key], counts)]
+        else:
+            totals[key] = list(counts)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not math.isinf(value) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+registry = Registry()
+
+
+def note_frame(df):
+    """ Record the size of a table read by the callback that is running, if any """
+    current = _current.get()
+    if current is not None and df is not None:
+        current["rows"] = max(current["rows"], len(df))
+        current["columns"] = max(current["columns"], len(df.columns))
+
+
+def process_memory(pid="self"):
+    """ Resident (rss), proportional (pss, shared pages split between the processes sharing them)
+    and shared bytes of a process, from /proc on Linux; elsewhere just the peak resident size """
+    sizes = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    sizes[name] = int(value.split()[0]) * 1024
+    except OSError:
+        if pid != "self":
+            return None
+        return {"rss": _peak_rss_bytes(), "pss": None, "shared": None}
+    return {
+        "rss": sizes["Rss"],
+        "pss": sizes.get("Pss"),
+        "shared": sizes.get("Shared_Clean", 0) + sizes.get("Shared_Dirty", 0),
+    }
+
+
+def _peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+def timed_callback(fn):
+    """ Wrap a callback so every call records its times, memory and the tables it read """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        current = {"rows": 0, "columns": 0}
+        token = _current.set(current)
+        wall, cpu, peak = time.perf_counter(), time.process_time(), _peak_rss_bytes()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+            name = fn.__name__
+            registry.observe("app_callback_seconds", time.perf_counter() - wall, callback=name)
+            registry.observe("app_callback_cpu_seconds", time.process_time() - cpu, callback=name)
+            registry.observe("app_callback_peak_memory_delta_bytes", _peak_rss_bytes() - peak, callback=name)
+            if current["rows"] or current["columns"]:
+                registry.observe("app_callback_input_rows", current["rows"], callback=name)
+                registry.observe("app_callback_input_columns", current["columns"], callback=name)
+            registry.flush()
+    return wrapper
+
+
+def instrument_callbacks(app):
+    """ Make app.callback wrap every callback registered from now on with timed_callback """
+    register = app.callback
+
+    @functools.wraps(register)
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+        return lambda fn: decorator(timed_callback(fn))
+
+    app.callback = callback
+
+
+def instrument_server(server, app=None, profile_directory=PROFILE_DIRECTORY):
+    """ Record the time and response size of every request to server, and profile some of them
+
+    With the Dash app given, callback requests are labelled with the name of
+    the callback they ran.
+    """
+    from flask import g, request
+
+    profile_token = os.environ.get("PROFILE_TOKEN")
+    sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+    min_seconds = float(os.environ.get("PROFILE_MIN_SECONDS", 1.0))
+
+    @server.before_request
+    def start_request():
+        g.metrics_started = (time.perf_counter(), time.process_time())
+        requested = bool(profile_token) and request.headers.get(PROFILE_HEADER) == profile_token
+        if requested or (sample_rate and random.random() < sample_rate):
+            g.profile = (cProfile.Profile(), requested)
+            g.profile[0].enable()
+
+    @server.after_request
+    def finish_request(response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started[0]
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        labels = {"route": route, "method": request.method}
+        if route.endswith("_dash-update-component"):
+            output = (request.get_json(silent=True) or {}).get("output", "")
+            callback = app.callback_map.get(output, {}).get("callback") if app is not None else None
+            labels["callback"] = getattr(callback, "__name__", output)
+        registry.observe("app_request_seconds", seconds, **labels)
+        registry.observe("app_request_cpu_seconds", time.process_time() - started[1], **labels)
+        size = response.calculate_content_length()
+        if size is not None:
+            registry.observe("app_response_bytes", size, **labels)
+        registry.flush()
+
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile[0].disable()
+            if profile[1] or seconds >= min_seconds:
+                os.makedirs(profile_directory, exist_ok=True)
+                name = f"{time.strftime('%Y%m%d-%H%M%S')}-{route.strip('/').replace('/', '_') or 'index'}-{uuid.uuid4().hex[:8]}.prof"
+                profile[0].dump_stats(os.path.join(profile_directory, name))
+                response.headers["X-Profile-Dump"] = name
+        return response
+
+    @server.teardown_request
+    def stop_profile(exc):
+        # after_request is skipped when a request fails; don't leave the profiler running
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile[0].disable()
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+
+from table_store import read_frame, write_frame
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """ SHA-256 of a file, read in chunks so memory use stays constant """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """ Parsed workbooks kept on disk, keyed by file content, sheet, header row and columns
+
+    Re-loading the same upload with the same sheet and header row reads the
+    stored Arrow file instead of running the Excel parser again.  The total
+    size on disk is bounded by max_bytes; the least recently used entries
+    are removed first.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._digests = {}  # (path, mtime, size) -> content hash
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, file_path):
+        """ Content hash of file_path, remembered while the file is unchanged """
+        st = os.stat(file_path)
+        key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(file_path)
+            with self._lock:
+                self._digests[key] = digest
+        return digest
+
+    def remember_digest(self, file_path, digest):
+        """ Record a hash that was already computed elsewhere, e.g. while the file was uploaded """
+        st = os.stat(file_path)
+        with self._lock:
+            self._digests[(os.path.abspath(file_path), st.st_mtime_ns, st.st_size)] = digest
+
+    def _base_path(self, file_path, sheet_name, header_row, columns):
+        key = json.dumps([self.digest(file_path), sheet_name, header_row, columns])
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, file_path, sheet_name, header_row, columns=None):
+        """ Return the cached DataFrame, or None when it has not been parsed yet """
+        base_path = self._base_path(file_path, sheet_name, header_row, columns)
+        for path in (base_path + ".arrow", base_path + ".pkl"):
+            try:
+                df = read_frame(path)
+            except FileNotFoundError:
+                continue
+            os.utime(path)  # Mark as recently used for eviction
+            with self._lock:
+                self.hits += 1
+            return df
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, file_path, sheet_name, header_row, df, columns=None):
+        """ Store a parsed DataFrame and evict old entries over the size budget """
+        write_frame(df, self._base_path(file_path, sheet_name, header_row, columns))
+        self._evict()
+        return df
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        """ Remove every cached workbook """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue  # Still being written by another worker
+            try:
+                os.remove(entry.path)
+            except (FileNotFoundError, IsADirectoryError):
+                pass
+        with self._lock:
+            self._digests.clear()
+
+    def stats(self):
+        """ Hit/miss/eviction counters """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,71 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 600_000
+
+# Successful checks remembered by this worker, so repeat logins skip the slow hash
+VERIFY_CACHE_SIZE = 1024
+
+# Cache entries are keyed by an HMAC under a per-process key, so neither
+# passwords nor anything that can be brute forced offline is kept in memory
+_cache_key = os.urandom(32)
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+
+def hash_password(password, iterations=ITERATIONS):
+    """ Hash a password for storage as "pbkdf2_sha256$<iterations>$<salt>$<hash>" """
+    salt = os.urandom(16)
+    return f"{ALGORITHM}${iterations}${_b64(salt)}${_b64(_pbkdf2(password, salt, iterations))}"
+
+
+# Checked against when a user doesn't exist, so the response takes as long as for a real one
+_DUMMY_HASH = f"{ALGORITHM}${ITERATIONS}${_b64(bytes(16))}$"
+
+
+def needs_rehash(stored):
+    """ Whether a stored password is plaintext or hashed with outdated settings """
+    parts = stored.split("$")
+    return len(parts) != 4 or parts[0] != ALGORITHM or parts[1] != str(ITERATIONS)
+
+
+def _check(password, stored):
+    parts = stored.split("$")
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        # Plaintext left over from before passwords were hashed
+        return hmac.compare_digest(stored.encode(), password.encode())
+    _, iterations, salt, expected = parts
+    actual = _pbkdf2(password, base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(_b64(actual), expected)
+
+
+def verify_password(password, stored):
+    """ Check a password against its stored hash, at full cost only the first time it succeeds """
+    if stored is None:
+        _check(password, _DUMMY_HASH)
+        return False
+    key = hmac.new(_cache_key, f"{stored}\0{password}".encode(), hashlib.sha256).digest()
+    with _verified_lock:
+        if key in _verified:
+            _verified.move_to_end(key)
+            return True
+    if not _check(password, stored):
+        return False
+    with _verified_lock:
+        _verified[key] = True
+        while len(_verified) > VERIFY_CACHE_SIZE:
+            _verified.popitem(last=False)
+    return True
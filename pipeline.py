@@ -0,0 +1,251 @@
+import hashlib
+import json
+
+from transforms import extract_columns, sort_with_subtotals, classify_sites, assign_asset_codes, changed_cells
+
+# Operation -> function applied to the previous step's table with the operation's parameters
+OPERATIONS = {
+    "extract": extract_columns,
+    "sort": sort_with_subtotals,
+    "classify": classify_sites,
+    "asset_codes": assign_asset_codes,
+}
+
+# Operation -> the DataTable that shows its result
+OPERATION_TABLES = {
+    "load": "data-table",
+    "extract": "copied-data-table",
+    "sort": "sorted-data-table",
+    "classify": "updated-group-table",
+    "asset_codes": "asset-data-table",
+}
+
+# Operation -> the columns it rewrites, leaving every row where it was; two
+# results of such an operation on the same table can be compared cell by cell
+IN_PLACE_COLUMNS = {
+    "classify": ["Group.1"],
+    "asset_codes": ["Asset Code", "Group Lead?"],
+}
+
+# How many earlier versions of the pipeline can be restored with undo
+UNDO_LIMIT = 20
+
+
+class StepError(Exception):
+    """ A step that can't be computed from its input table, e.g. a column it uses is gone
+
+    step is the step that failed.  When it was a later step being replayed,
+    the new version was kept up to the step before it and result is the
+    table of the operation that was run; otherwise nothing was changed and
+    result is None.
+    """
+
+    def __init__(self, step, error, result=None):
+        super().__init__(f"{step['op']}: {error}")
+        self.step = step
+        self.error = error
+        self.result = result
+
+
+def snapshot_name(parent, operation, params):
+    """ Name of the table an operation produces from its parent; equal inputs give equal names """
+    key = json.dumps([parent, operation, params], sort_keys=True, default=str)
+    return "snap-" + hashlib.sha256(key.encode()).hexdigest()[:24]
+
+
+class OperationLog:
+    """ The steps applied to a session's table, kept as a history of pipeline versions
+
+    A version is the ordered list of steps ({"op", "params", "table"}) from
+    the loaded table to the current one; every step's result is an immutable
+    snapshot in the table store, named after its parent, operation and
+    parameters.  Running a step that is already in the pipeline changes its
+    parameters and replays only the steps from it onward, reusing any
+    snapshot that already exists.  Undo and redo just move the current
+    position in the history.
+
+    prepare maps an operation to a function (session id, input table,
+    params) -> the params to compute it with.  It is only called when the step is
+    computed, not when its snapshot is reused, e.g. to reserve the asset
+    codes the step hands out.
+    """
+
+    def __init__(self, store, prepare=None):
+        self.store = store
+        self.prepare = prepare or {}
+
+    def _history(self, session_id):
+        state = self.store.get_state(session_id)
+        return state.get("history", []), state.get("position", -1)
+
+    def steps(self, session_id):
+        """ Steps of the current version, oldest first """
+        history, position = self._history(session_id)
+        return history[position] if 0 <= position < len(history) else []
+
+    def latest(self, session_id):
+        """ The table produced by the last step, or None """
+        steps = self.steps(session_id)
+        return self.store.get(session_id, steps[-1]["table"]) if steps else None
+
+    def step(self, session_id, table_id):
+        """ The step whose result is shown in the DataTable table_id, or None """
+        for step in self.steps(session_id):
+            if OPERATION_TABLES[step["op"]] == table_id:
+                return step
+        return None
+
+    def table(self, session_id, table_id):
+        """ The table a step currently shows in the DataTable table_id, or None """
+        step = self.step(session_id, table_id)
+        return self.store.get(session_id, step["table"]) if step else None
+
+    def changes(self, session_id, operation, earlier_table):
+        """ The cells in which operation's current result differs from earlier_table
+
+        earlier_table is the snapshot of an earlier result of the same
+        operation, e.g. the one on screen.  Only operations in
+        IN_PLACE_COLUMNS that ran on the same parent table both times can be
+        compared.  Returns {column: row positions}, or None when the tables
+        can't be compared.
+        """
+        columns = IN_PLACE_COLUMNS.get(operation)
+        steps = self.steps(session_id)
+        index = next((i for i, step in enumerate(steps) if step["op"] == operation), None)
+        if columns is None or not index:
+            return None
+        if steps[index]["table"] == earlier_table:
+            return {}
+        history, _ = self._history(session_id)
+        parents = {
+            version[i]["table"]: version[i - 1]["table"]
+            for version in history for i in range(1, len(version)) if version[i]["op"] == operation
+        }
+        if parents.get(earlier_table) != steps[index - 1]["table"]:
+            return None
+        before = self.store.get(session_id, earlier_table)
+        after = self.store.get(session_id, steps[index]["table"])
+        if before is None or after is None:
+            return None
+        return changed_cells(before, after, columns)
+
+    def load(self, session_id, df, params):
+        """ Start a new pipeline from a freshly loaded table """
+        name = snapshot_name(None, "load", params)
+        with self.store.session_lock(session_id):
+            self.store.put(session_id, name, df)
+            self._push(session_id, [{"op": "load", "params": params, "table": name}])
+        return df
+
+    def run(self, session_id, operation, params, progress=None):
+        """ Apply an operation and return its result
+
+        A new operation is added to the end of the pipeline.  When the
+        operation is already in it, its parameters are replaced (queued
+        classifications are added to the earlier ones instead) and the
+        steps after it are recomputed.  progress, when given, is called
+        with (step number, number of steps, operation) before each step
+        that has to be computed.
+
+        Raises StepError when the operation can't be applied, leaving the
+        pipeline as it was.  When a later step no longer applies to the new
+        table, e.g. a sort by a column that is no longer extracted, the
+        replay stops there: the new version keeps the steps before it and
+        StepError is raised with the operation's result.
+
+        The session's lock is held from reading the pipeline to storing the
+        new version, so steps started at the same time, e.g. from two
+        tabs, run one after the other instead of losing one of them.
+        """
+        with self.store.session_lock(session_id):
+            return self._run(session_id, operation, params, progress)
+
+    def _run(self, session_id, operation, params, progress):
+        steps = self.steps(session_id)
+        if not steps:
+            raise ValueError("Load a table first")
+        steps = list(steps)
+        for index, step in enumerate(steps):
+            if step["op"] == operation:
+                if operation == "classify":
+                    params = {"updates": step["params"]["updates"] + params["updates"]}
+                steps[index] = {"op": operation, "params": params}
+                break
+        else:
+            index = len(steps)
+            steps.append({"op": operation, "params": params})
+
+        df = self.store.get(session_id, steps[index - 1]["table"])
+        result = None
+        for number, step in enumerate(steps[index:], start=index):
+            parent = steps[number - 1]["table"]
+            name = snapshot_name(parent, step["op"], step["params"])
+            # Steps whose parent and parameters are unchanged are looked up, not recomputed
+            cached = self.store.get(session_id, name)
+            if cached is not None:
+                df = cached
+            else:
+                if progress is not None:
+                    progress(number - index, len(steps) - index, step["op"])
+                try:
+                    applied = step["params"]
+                    if step["op"] in self.prepare:
+                        applied = self.prepare[step["op"]](session_id, df, applied)
+                    df = OPERATIONS[step["op"]](df, **applied)
+                except (KeyError, ValueError) as e:
+                    if number == index:
+                        raise StepError(step, e) from e
+                    # The steps from this one on are dropped from the new version
+                    self._push(session_id, steps[:number])
+                    raise StepError(step, e, result) from e
+                self.store.put(session_id, name, df)
+            steps[number] = {"op": step["op"], "params": step["params"], "table": name}
+            if number == index:
+                result = df
+        self._push(session_id, steps)
+        return result
+
+    def _push(self, session_id, steps):
+        history, position = self._history(session_id)
+        # A new version drops the versions that were undone
+        history = history[:position + 1] + [steps]
+        history = history[-(UNDO_LIMIT + 1):]
+        self.store.update_state(session_id, history=history, position=len(history) - 1)
+        self._prune(session_id, history)
+
+    def _prune(self, session_id, history):
+        """ Delete snapshots no version refers to any more; only called with the session's lock held """
+        used = {step["table"] for steps in history for step in steps}
+        for name in self.store.names(session_id):
+            if name.startswith("snap-") and name not in used:
+                self.store.delete(session_id, name)
+
+    def undo(self, session_id):
+        """ Go back to the previous version; returns whether there was one
+
+        Raises SessionBusy instead of waiting while a step is running, as
+        undo is called from the web worker itself.
+        """
+        with self.store.session_lock(session_id, blocking=False):
+            history, position = self._history(session_id)
+            if position <= 0:
+                return False
+            self.store.update_state(session_id, position=position - 1)
+        return True
+
+    def redo(self, session_id):
+        """ Go forward to the version that was undone last; returns whether there was one, like undo """
+        with self.store.session_lock(session_id, blocking=False):
+            history, position = self._history(session_id)
+            if position >= len(history) - 1:
+                return False
+            self.store.update_state(session_id, position=position + 1)
+        return True
+
+    def describe(self, session_id):
+        """ One line per step of the current version, for display """
+        lines = []
+        for step in self.steps(session_id):
+            params = json.dumps(step["params"], default=str)
+            lines.append(f"{step['op']}: {params if len(params) <= 120 else params[:117] + '...'}")
+        return lines
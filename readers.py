@@ -0,0 +1,199 @@
+import csv
+import importlib.util
+import itertools
+
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+# Rows per chunk when reading CSV files
+CSV_CHUNK_ROWS = 100_000
+
+# Error values openpyxl hands back as strings; pandas reads them as NaN
+EXCEL_ERRORS = {"#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A", "#GETTING_DATA"}
+
+
+def calamine_available():
+    """ Whether the (much faster) Rust calamine engine is installed """
+    return importlib.util.find_spec("python_calamine") is not None
+
+
+def is_csv(file_path):
+    return file_path.lower().endswith(".csv")
+
+
+def is_excel(file_path):
+    return file_path.lower().endswith((".xls", ".xlsx", ".xlsm"))
+
+
+def _convert_cell(value):
+    """ Convert a cell value the way pandas' openpyxl reader does """
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in EXCEL_ERRORS:
+        return float("nan")
+    return value
+
+
+def _open_sheet(file_path, sheet_name):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    if sheet_name is None or isinstance(sheet_name, int):
+        sheet = workbook.worksheets[sheet_name or 0]
+    else:
+        sheet = workbook[sheet_name]
+    return workbook, sheet
+
+
+def _excel_rows(file_path, sheet_name, limit=None):
+    """ Yield converted rows of a sheet, streaming it in openpyxl read-only mode """
+    if file_path.lower().endswith(".xls"):
+        # openpyxl can't read the old binary format; let pandas pick its engine
+        df = pd.read_excel(file_path, sheet_name=sheet_name or 0, header=None, nrows=limit)
+        for row in df.itertuples(index=False):
+            yield ["" if pd.isna(value) else value for value in row]
+        return
+
+    workbook, sheet = _open_sheet(file_path, sheet_name)
+    try:
+        for row in sheet.iter_rows(max_row=limit, values_only=True):
+            row = [_convert_cell(value) for value in row]
+            while row and row[-1] == "":
+                row.pop()
+            yield row
+    finally:
+        workbook.close()
+
+
+def list_sheets(file_path):
+    """ Sheet names of a workbook, read without parsing any cells """
+    if is_csv(file_path):
+        return []
+    if calamine_available():
+        from python_calamine import CalamineWorkbook
+
+        return CalamineWorkbook.from_path(file_path).sheet_names
+    if file_path.lower().endswith(".xls"):
+        return pd.ExcelFile(file_path).sheet_names
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, keep_links=False)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def header_candidates(file_path, sheet_name=None, n_rows=10):
+    """ First rows of a sheet, so the user can tell which one holds the headers """
+    if is_csv(file_path):
+        with open(file_path, newline="") as f:
+            return [row for row in itertools.islice(csv.reader(f), n_rows)]
+    return list(_excel_rows(file_path, sheet_name, limit=n_rows))
+
+
+def _column_names(header):
+    """ Column names pandas would give a header row, e.g. "Group", "Group.1", "Unnamed: 4" """
+    return list(TextParser([header], header=0).read().columns)
+
+
+def read_columns(file_path, sheet_name=None, header_row=0):
+    """ Column names of a sheet without reading its data """
+    if header_row is None:
+        return []
+    if is_csv(file_path):
+        return list(pd.read_csv(file_path, nrows=0).columns)
+    rows = list(_excel_rows(file_path, sheet_name, limit=header_row + 1))
+    if len(rows) <= header_row:
+        return []
+    return _column_names(rows[header_row])
+
+
+def _read_csv(file_path, columns):
+    chunks = pd.read_csv(file_path, usecols=columns or None, chunksize=CSV_CHUNK_ROWS)
+    df = pd.concat(chunks, ignore_index=True)
+    if columns:
+        df = df[columns]
+    return df
+
+
+def _read_excel_projected(file_path, sheet_name, header_row, columns):
+    """ Stream a sheet and only keep the requested columns """
+    chunks = list(_excel_chunks(file_path, sheet_name, header_row, columns, chunk_rows=None))
+    return chunks[0] if chunks else pd.DataFrame(columns=columns)
+
+
+def _excel_chunks(file_path, sheet_name, header_row, columns, chunk_rows):
+    rows = _excel_rows(file_path, sheet_name)
+    for _ in range(header_row):
+        next(rows, None)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError(f"Header row {header_row} is past the end of the sheet")
+
+    names = _column_names(header)
+    columns = columns or names
+    missing = [col for col in columns if col not in names]
+    if missing:
+        raise KeyError(f"Columns not found in sheet: {missing}")
+    positions = [names.index(col) for col in columns]
+
+    data = []
+    blank_rows = 0
+    for row in rows:
+        if not row:
+            # pandas keeps blank rows inside the data but drops trailing ones
+            blank_rows += 1
+            continue
+        data.extend([[""] * len(positions)] * blank_rows)
+        blank_rows = 0
+        data.append([row[i] if i < len(row) else "" for i in positions])
+        if chunk_rows and len(data) >= chunk_rows:
+            yield TextParser(data, header=None, names=columns, skip_blank_lines=False).read()
+            data = []
+    if data:
+        yield TextParser(data, header=None, names=columns, skip_blank_lines=False).read()
+
+
+def iter_table(file_path, sheet_name=None, header_row=0, columns=None, chunk_rows=CSV_CHUNK_ROWS):
+    """ Read a CSV file or one sheet of a workbook as DataFrames of at most chunk_rows rows
+
+    Only one chunk is held at a time, so tables larger than memory can be
+    processed.  Workbooks are streamed through openpyxl in read-only mode
+    (old .xls files are read whole).  Column types are inferred per chunk,
+    like read_csv's chunksize.
+    """
+    if is_csv(file_path):
+        for chunk in pd.read_csv(file_path, usecols=columns or None, chunksize=chunk_rows):
+            yield chunk[columns] if columns else chunk
+        return
+    if not is_excel(file_path):
+        raise ValueError(f"Unsupported file format: {file_path}")
+    yield from _excel_chunks(file_path, sheet_name, header_row or 0, columns, chunk_rows)
+
+
+def read_table(file_path, sheet_name=None, header_row=0, columns=None):
+    """ Read a CSV file or one sheet of a workbook into a DataFrame
+
+    When columns is given only those columns are materialized.  Workbooks are
+    read with calamine when it is installed, otherwise streamed through
+    openpyxl in read-only mode.
+    """
+    if is_csv(file_path):
+        return _read_csv(file_path, columns)
+    if not is_excel(file_path):
+        raise ValueError(f"Unsupported file format: {file_path}")
+    if sheet_name is None:
+        sheet_name = 0  # First sheet, rather than a dict of every sheet
+
+    if calamine_available():
+        df = pd.read_excel(file_path, sheet_name=sheet_name, header=header_row,
+                           usecols=columns or None, engine="calamine")
+        return df[columns] if columns else df
+    if columns and header_row is not None and not file_path.lower().endswith(".xls"):
+        return _read_excel_projected(file_path, sheet_name, header_row, columns)
+    df = pd.read_excel(file_path, sheet_name=sheet_name, header=header_row)
+    return df[columns] if columns else df
@@ -0,0 +1,90 @@
+import pandas as pd
+
+# Text columns with at most this share of distinct values become categoricals
+CATEGORY_MAX_RATIO = 0.5
+
+# Arrow-backed strings that compare and go missing like object columns (NaN, plain bools)
+ARROW_STRING = pd.StringDtype("pyarrow_numpy")
+
+
+def _downcast(column):
+    if pd.api.types.is_integer_dtype(column.dtype) and not isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+        return pd.to_numeric(column, downcast="integer")
+    return column
+
+
+def _column_kind(column):
+    """ How a column is stored after normalize_dtypes, and the column to store """
+    if pd.api.types.is_bool_dtype(column.dtype):
+        return "boolean", column
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        column = _downcast(column)
+        return ("integer" if pd.api.types.is_integer_dtype(column.dtype) else "float"), column
+    if column.dtype != object:
+        return str(column.dtype), column
+
+    inferred = pd.api.types.infer_dtype(column, skipna=True)
+    if inferred in ("integer", "floating", "mixed-integer-float"):
+        # Numbers held as Python objects, e.g. next to blanks read as NaN
+        return _column_kind(pd.to_numeric(column))
+    if inferred != "string":
+        return "object", column  # Mixed text and numbers, dates, ...
+
+    if pd.to_numeric(column, errors="coerce").notna().sum() == column.notna().sum():
+        # Numbers stored as text, like "001"; the sort converts them, so keep them as they are
+        return "numeric_text", column
+    distinct = column.nunique(dropna=True)
+    if distinct <= CATEGORY_MAX_RATIO * column.notna().sum():
+        return "category", column.astype("category")
+    return "string", column.astype(ARROW_STRING)
+
+
+def normalize_dtypes(df):
+    """ Store df's columns compactly: low-cardinality text as categoricals, other text as Arrow strings,
+    integers in the smallest type that holds them
+
+    Numbers found in object columns are converted once here, so later steps
+    don't have to.  The kind chosen for every column is recorded in
+    df.attrs["schema"], so the sort knows which object columns hold numbers
+    without looking at them again; steps that replace a column forget its
+    kind with forget_kinds.
+    """
+    if not df.columns.is_unique:
+        return df
+    columns = {}
+    schema = {}
+    for name in df.columns:
+        schema[name], columns[name] = _column_kind(df[name])
+    result = pd.DataFrame(columns, index=df.index)
+    result.attrs = {**df.attrs, "schema": schema}
+    return result
+
+
+def recorded_kind(df, name):
+    """ The kind normalize_dtypes recorded for a column of df, or None """
+    return df.attrs.get("schema", {}).get(name)
+
+
+def forget_kinds(df, names):
+    """ Drop the recorded kinds of columns a step replaced, so they are inferred again """
+    schema = df.attrs.get("schema")
+    if schema and any(name in schema for name in names):
+        df.attrs = {**df.attrs, "schema": {name: kind for name, kind in schema.items() if name not in names}}
+    return df
+
+
+def needs_numeric_conversion(column, kind=None):
+    """ Whether pd.to_numeric could turn a column into numbers
+
+    Numeric columns already are numbers, and normalize_dtypes only makes
+    categoricals and Arrow strings of text that isn't numbers.  kind is the
+    column's recorded kind, when there is one: of the object columns, only
+    "numeric_text" ones hold nothing but numbers.
+    """
+    if pd.api.types.is_numeric_dtype(column.dtype) or pd.api.types.is_bool_dtype(column.dtype):
+        return False
+    if isinstance(column.dtype, (pd.CategoricalDtype, pd.StringDtype)):
+        return False
+    if kind in ("object", "numeric_text"):
+        return kind == "numeric_text"
+    return True
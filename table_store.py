@@ -0,0 +1,247 @@
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+import metrics
+
+# Session ids end up in file paths, so only accept the uuid4().hex ids we hand out
+SESSION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class SessionBusy(Exception):
+    """ The session's lock is held by someone else, e.g. a running pipeline step """
+
+
+def write_frame(df, base_path):
+    """ Atomically write df next to base_path and return the path written
+
+    Frames are stored as uncompressed Arrow IPC files so they can be
+    memory-mapped on read.  Mixed-type object columns (e.g. numbers and ""
+    in one column) can't be expressed in Arrow, so those frames are kept as
+    pickles instead.
+    """
+    arrow_path, pickle_path = base_path + ".arrow", base_path + ".pkl"
+    tmp_path = f"{base_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        path, stale_path = arrow_path, pickle_path
+        _write_arrow(df, tmp_path)
+    except (ValueError, TypeError):
+        path, stale_path = pickle_path, arrow_path
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+    if os.path.exists(stale_path):
+        os.remove(stale_path)
+    return path
+
+
+def _write_arrow(df, path):
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    if not all(isinstance(col, str) for col in df.columns):
+        raise TypeError("Arrow files need string column names")
+    table = pa.Table.from_pandas(df, preserve_index=None)
+    feather.write_feather(table, path, compression="uncompressed")
+
+
+def read_frame(path):
+    """ Read a frame written by write_frame """
+    if path.endswith(".arrow"):
+        import pyarrow.feather as feather
+
+        from schema import ARROW_STRING
+
+        table = feather.read_table(path, memory_map=True)
+        # Arrow string columns stay Arrow arrays over the mapped file instead of
+        # becoming Python objects; object columns of text stay object columns
+        metadata = (table.schema.pandas_metadata or {}).get("columns", [])
+        string_columns = [column["name"] for column in metadata
+                          if column.get("numpy_type") == "string" and column["name"] in table.column_names]
+        if not string_columns:
+            return table.to_pandas()
+        df = table.drop_columns(string_columns).to_pandas()
+        for name in string_columns:
+            position = table.column_names.index(name)
+            df.insert(position, name, pd.Series(ARROW_STRING.__from_arrow__(table.column(name)), index=df.index))
+        return df
+    return pd.read_pickle(path)
+
+
+class TableStore:
+    """ Session-keyed DataFrame store shared by all workers on this machine
+
+    Every table is written through to an uncompressed Arrow IPC file so any
+    worker process can memory-map it without re-parsing the upload.  The
+    frames a worker has touched recently are also kept in memory under an
+    LRU with a byte budget; a cached frame is only reused while its file on
+    disk is unchanged, so writes from other workers are always picked up.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._frames = OrderedDict()  # (session_id, name) -> (file version, df, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+    def _session_dir(self, session_id):
+        if not SESSION_ID_PATTERN.match(session_id or ""):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        return os.path.join(self.directory, session_id)
+
+    def _base_path(self, session_id, name):
+        return os.path.join(self._session_dir(session_id), name)
+
+    def _paths(self, session_id, name):
+        base = self._base_path(session_id, name)
+        return base + ".arrow", base + ".pkl"
+
+    def _version(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _cache(self, key, version, df):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if nbytes > self.max_bytes:
+                return
+            self._frames[key] = (version, df, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self._frames.popitem(last=False)
+                self._bytes -= evicted_bytes
+                self.evictions += 1
+
+    def _forget(self, key):
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+
+    def put(self, session_id, name, df):
+        """ Store df under (session_id, name), replacing any previous table """
+        os.makedirs(self._session_dir(session_id), exist_ok=True)
+        path = write_frame(df, self._base_path(session_id, name))
+        with self._lock:
+            self.writes += 1
+        self._cache((session_id, name), self._version(path), df)
+        return df
+
+    def get(self, session_id, name):
+        """ Return the table stored under (session_id, name), or None """
+        key = (session_id, name)
+        for path in self._paths(session_id, name):
+            version = self._version(path)
+            if version is not None:
+                break
+        else:
+            self._forget(key)
+            return None
+
+        with self._lock:
+            cached = self._frames.get(key)
+            if cached is not None and cached[0] == version:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                metrics.note_frame(cached[1])
+                return cached[1]
+            self.misses += 1
+
+        df = read_frame(path)
+        self._cache(key, version, df)
+        metrics.note_frame(df)
+        return df
+
+    def delete(self, session_id, name):
+        """ Remove one table """
+        self._forget((session_id, name))
+        for path in self._paths(session_id, name):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def names(self, session_id):
+        """ Names of the tables stored for a session """
+        try:
+            files = os.listdir(self._session_dir(session_id))
+        except FileNotFoundError:
+            return set()
+        return {name.rsplit(".", 1)[0] for name in files if name.endswith((".arrow", ".pkl"))}
+
+    def get_state(self, session_id):
+        """ Small JSON-serializable values kept for a session, e.g. the uploaded file """
+        try:
+            with open(os.path.join(self._session_dir(session_id), "state.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def update_state(self, session_id, **values):
+        """ Set some session values, visible to every worker and background job """
+        session_dir = self._session_dir(session_id)
+        os.makedirs(session_dir, exist_ok=True)
+        with open(os.path.join(session_dir, "state.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.get_state(session_id)
+            state.update(values)
+            tmp_path = os.path.join(session_dir, f"state.{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, os.path.join(session_dir, "state.json"))
+        return state
+
+    @contextlib.contextmanager
+    def session_lock(self, session_id, blocking=True):
+        """ Hold a session's lock, shared by every worker and background job on this machine
+
+        For changes that read and write several tables and state values, like
+        a pipeline step; update_state takes a lock of its own, so it can be
+        called while this one is held.  Without blocking, SessionBusy is
+        raised instead of waiting when the lock is held.
+        """
+        session_dir = self._session_dir(session_id)
+        os.makedirs(session_dir, exist_ok=True)
+        with open(os.path.join(session_dir, "session.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise SessionBusy(session_id) from None
+            yield
+
+    def clear_session(self, session_id):
+        """ Remove every table stored for a session """
+        with self._lock:
+            for key in [key for key in self._frames if key[0] == session_id]:
+                self._bytes -= self._frames.pop(key)[2]
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def stats(self):
+        """ Hit/miss/eviction counters and current memory use """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "writes": self.writes,
+                "cached_tables": len(self._frames),
+                "cached_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
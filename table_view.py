@@ -0,0 +1,128 @@
+import math
+
+import pandas as pd
+
+# Operators understood in a DataTable filter_query, longest first so that
+# ">=" is not mistaken for ">"
+FILTER_OPERATORS = [
+    ["ge ", ">="],
+    ["le ", "<="],
+    ["lt ", "<"],
+    ["gt ", ">"],
+    ["ne ", "!="],
+    ["eq ", "="],
+    ["contains "],
+    ["datestartswith "],
+]
+
+
+def split_filter_part(filter_part):
+    """ Split one filter expression into (column, operator, value) """
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find("{") + 1: name_part.rfind("}")]
+
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ""
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', "`"):
+                    value = value_part[1:-1].replace("\\" + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                # Word operators need spaces after them in the filter string,
+                # but we don't want these later
+                return name, operator_type[0].strip(), value
+
+    return None, None, None
+
+
+def filter_frame(df, filter_query):
+    """ Apply a DataTable filter_query to a DataFrame """
+    if not filter_query:
+        return df
+
+    mask = pd.Series(True, index=df.index)
+    for filter_part in filter_query.split(" && "):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+
+        column = df[col_name]
+        if operator in ("eq", "ne", "lt", "le", "gt", "ge"):
+            if isinstance(filter_value, float) and not pd.api.types.is_numeric_dtype(column):
+                column = pd.to_numeric(column, errors="coerce")
+            elif isinstance(column.dtype, pd.CategoricalDtype) and operator not in ("eq", "ne"):
+                column = column.astype(object)  # Unordered categories only compare for equality
+            if operator == "eq":
+                mask &= column == filter_value
+            elif operator == "ne":
+                mask &= column != filter_value
+            elif operator == "lt":
+                mask &= column < filter_value
+            elif operator == "le":
+                mask &= column <= filter_value
+            elif operator == "gt":
+                mask &= column > filter_value
+            else:
+                mask &= column >= filter_value
+        elif operator == "contains":
+            mask &= column.astype(str).str.contains(str(filter_value), case=False, regex=False)
+        elif operator == "datestartswith":
+            mask &= column.astype(str).str.startswith(str(filter_value))
+
+    return df[mask.fillna(False).astype(bool)]
+
+
+def _as_text(column):
+    """ Sort key comparing the values of a text column as text, blanks staying blank """
+    if column.dtype == object:
+        return column.map(str, na_action="ignore")
+    return column
+
+
+def sort_frame(df, sort_by):
+    """ Apply a DataTable sort_by list to a DataFrame
+
+    Columns mixing numbers and text, like a "Quantity" with "N/A" in it,
+    can't be compared as they are, so they are sorted as text instead.
+    """
+    sort_by = [col for col in (sort_by or []) if col["column_id"] in df.columns]
+    if not sort_by:
+        return df
+    columns = [col["column_id"] for col in sort_by]
+    ascending = [col["direction"] == "asc" for col in sort_by]
+    try:
+        return df.sort_values(columns, ascending=ascending, kind="mergesort")
+    except TypeError:
+        return df.sort_values(columns, ascending=ascending, kind="mergesort", key=_as_text)
+
+
+def view_columns(sort_by=None, filter_query=None):
+    """ Columns that decide which rows a sorted and filtered view shows """
+    columns = {col["column_id"] for col in sort_by or []}
+    for filter_part in (filter_query or "").split(" && "):
+        name = split_filter_part(filter_part)[0]
+        if name:
+            columns.add(name)
+    return columns
+
+
+def page_rows(df, page_current, page_size, sort_by=None, filter_query=None):
+    """ Return the rows of one page, keeping df's index, and the page count after sorting and filtering """
+    page_current = page_current or 0
+    page_size = page_size or 10
+
+    view = sort_frame(filter_frame(df, filter_query), sort_by)
+    page_count = max(1, math.ceil(len(view) / page_size))
+    return view.iloc[page_current * page_size: (page_current + 1) * page_size], page_count
+
+
+def page_records(df, page_current, page_size, sort_by=None, filter_query=None):
+    """ Return the records of one page and the page count after sorting and filtering """
+    page, page_count = page_rows(df, page_current, page_size, sort_by, filter_query)
+    return page.to_dict("records"), page_count
@@ -0,0 +1,84 @@
+""" The chunked pipeline against the in-memory one it stands in for
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch
+from chunked import CHUNK_OPERATIONS
+from pipeline import OPERATIONS
+
+STEPS = [
+    {"op": "extract", "params": {"columns": ["Site", "Building", "Level", "Description", "Asset Code", "Quantity"]}},
+    {"op": "sort", "params": {"selected_columns": ["Site", "Level"], "order": "desc"}},
+    {"op": "classify", "params": {"updates": [{"Group": "North", "Classification": "N"},
+                                              {"Group": "West", "Classification": "W"}]}},
+    {"op": "asset_codes", "params": {"first_blank_row": "ABC098", "asset_columns": ["Site", "Building"]}},
+]
+
+
+def random_register(rng, rows):
+    """ A register with blank and existing codes, text quantities, blank keys and repeated groups """
+    existing = [f"{prefix}{number:03d}" for prefix, number in
+                zip(rng.choice(["ABC", "XYZ"], rows), rng.integers(0, 1000, rows))]
+    return pd.DataFrame({
+        "Site": rng.choice(np.array(["North", "South", "East", "West", None], dtype=object), rows),
+        "Building": rng.choice(["B1", "B2", "B3"], rows),
+        "Level": rng.integers(0, 4, rows),
+        "Description": rng.choice(["Pump", "Fan", "Valve", "Chiller"], rows),
+        "Group.1": "",
+        "Asset Code": np.where(rng.random(rows) < 0.3, "", existing).astype(object),
+        "Quantity": rng.choice(np.array([1, 2, 5.5, "N/A", "", None], dtype=object), rows),
+    })
+
+
+def run_whole(df, steps):
+    for step in steps:
+        df = OPERATIONS[step["op"]](df, **step["params"])
+    return df.reset_index(drop=True)
+
+
+def run_in_chunks(df, steps, chunk_rows, workdir):
+    chunks = (df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows))
+    for step in steps:
+        chunks = CHUNK_OPERATIONS[step["op"]](chunks, workdir, chunk_rows, **step["params"])
+    return pd.concat(list(chunks), ignore_index=True)
+
+
+@pytest.mark.filterwarnings("ignore::FutureWarning")
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("chunk_rows", [1, 7, 50])
+@pytest.mark.parametrize("steps", [STEPS, STEPS[1:2], STEPS[3:], [STEPS[1], STEPS[3]]],
+                         ids=["all", "sort", "asset_codes", "sort_asset_codes"])
+def test_chunks_match_whole_table(tmp_path, seed, chunk_rows, steps):
+    rng = np.random.default_rng(seed)
+    df = random_register(rng, int(rng.integers(20, 120)))
+    expected = run_whole(df, steps)
+    actual = run_in_chunks(df, steps, chunk_rows, str(tmp_path))
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual.astype(object), expected.astype(object), check_dtype=False)
+
+
+@pytest.mark.filterwarnings("ignore::FutureWarning")
+@pytest.mark.parametrize("export_format", ["csv", "xlsx"])
+def test_chunked_batch_file_matches_whole(tmp_path, export_format):
+    rng = np.random.default_rng(0)
+    source = tmp_path / "register.csv"
+    random_register(rng, 300).to_csv(source, index=False)
+    outputs = {}
+    for chunk_rows in (None, 16):
+        output_dir = tmp_path / f"out-{chunk_rows}"
+        output_dir.mkdir()
+        spec = batch.load_spec({"steps": STEPS, "export": export_format, "chunk_rows": chunk_rows})
+        report = batch.run_file(str(source), spec, str(output_dir))
+        assert report["status"] == "ok", report.get("error")
+        read = pd.read_csv if export_format == "csv" else pd.read_excel
+        outputs[chunk_rows] = read(report["output"], dtype=str, keep_default_na=False)
+    pd.testing.assert_frame_equal(outputs[16], outputs[None])
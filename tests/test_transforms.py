@@ -0,0 +1,151 @@
+""" The vectorized transforms against the row-by-row loops they replaced
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transforms import assign_asset_codes, sort_with_subtotals
+
+
+def baseline_asset_codes(df, first_blank_row, asset_columns):
+    """ The update_asset_codes callback before it was vectorized, as it was """
+    df = df.copy()
+    base_code = first_blank_row[:-3]
+    start_number = int(first_blank_row[-3:])
+    blank_rows = df[df["Asset Code"] == ""].index
+
+    if not blank_rows.empty:
+        for i, idx in enumerate(blank_rows):
+            df.loc[idx, "Asset Code"] = f"{base_code}{str(start_number + i).zfill(3)}"
+
+    grouped = df.groupby(asset_columns)
+    for group_key, group in grouped:
+        if group['Asset Code'].str.startswith(base_code).any():
+            asset_code_value = group.loc[group['Asset Code'].str.startswith(base_code), 'Asset Code'].iloc[0]
+            condition = df.apply(lambda row: all(row[col] == key for col, key in zip(asset_columns, group_key)), axis=1)
+            df.loc[condition, 'Group Lead?'] = asset_code_value
+    return df
+
+
+def random_register(rng, rows, lead_column=False):
+    """ A register with blank and existing codes, text quantities and repeated keys """
+    existing = [f"{prefix}{number:03d}" for prefix, number in
+                zip(rng.choice(["ABC", "XYZ", "AB"], rows), rng.integers(0, 1000, rows))]
+    df = pd.DataFrame({
+        "Site": rng.choice(["North", "South", "East", "West", None], rows),
+        "Building": rng.choice(["B1", "B2", "B3"], rows),
+        "Level": rng.integers(0, 3, rows),
+        "Description": rng.choice(["Pump", "Fan", "Valve", "Chiller"], rows),
+        "Asset Code": np.where(rng.random(rows) < 0.4, "", existing).astype(object),
+        "Quantity": rng.choice(np.array([1, 2, 5.5, "N/A", "", None], dtype=object), rows),
+    })
+    if lead_column:
+        df["Group Lead?"] = rng.choice(np.array(["OLD001", None], dtype=object), rows)
+    return df
+
+
+def assert_same_result(df, first_blank_row, asset_columns):
+    expected = baseline_asset_codes(df, first_blank_row, asset_columns)
+    actual = assign_asset_codes(df, first_blank_row, asset_columns)
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual.astype(object), expected.astype(object), check_dtype=False)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("asset_columns", [
+    ["Site"],
+    ["Description"],
+    ["Site", "Building"],
+    ["Site", "Building", "Level"],
+    ["Quantity", "Description"],
+])
+def test_matches_row_by_row_loop(seed, asset_columns):
+    rng = np.random.default_rng(seed)
+    df = random_register(rng, int(rng.integers(1, 80)), lead_column=bool(seed % 2))
+    first_blank_row = f"{rng.choice(['ABC', 'XYZ', 'QQ'])}{int(rng.integers(0, 500)):03d}"
+    assert_same_result(df, first_blank_row, asset_columns)
+
+
+def test_no_blank_codes():
+    df = pd.DataFrame({"Site": ["A", "A", "B"], "Asset Code": ["ABC001", "XYZ002", "XYZ003"]})
+    assert_same_result(df, "ABC010", ["Site"])
+
+
+def test_all_blank_codes():
+    df = pd.DataFrame({"Site": ["A", "B", "A", "C"], "Asset Code": [""] * 4})
+    assert_same_result(df, "ABC998", ["Site"])
+
+
+def test_no_group_has_the_prefix():
+    df = pd.DataFrame({"Site": ["A", "B"], "Asset Code": ["XYZ001", "XYZ002"], "Group Lead?": [None, "OLD"]})
+    assert_same_result(df, "ABC001", ["Site"])
+
+
+def test_input_is_left_unchanged():
+    rng = np.random.default_rng(0)
+    df = random_register(rng, 50)
+    before = df.copy()
+    assign_asset_codes(df, "ABC001", ["Site"])
+    pd.testing.assert_frame_equal(df, before)
+
+
+def baseline_sort(df, selected_columns, order):
+    """ The sort_data callback before it was vectorized
+
+    The only change is a stable sort: the old quicksort left rows with
+    equal keys in no particular order, which can't be compared.
+    """
+    df = df.copy()
+
+    if selected_columns and order != "none":
+        df[selected_columns] = df[selected_columns].apply(pd.to_numeric, errors="ignore")
+        df = df.sort_values(by=selected_columns, ascending=(order == "asc"), kind="stable")
+
+    grouped = df.groupby(selected_columns)
+    new_rows = []
+    for group_key, group in grouped:
+        new_rows.append(group)
+        if any(group.duplicated(subset=selected_columns)):
+            empty_row = {col: "" for col in df.columns}
+            group["Quantity"] = pd.to_numeric(group["Quantity"], errors="coerce")
+            empty_row["Quantity"] = group["Quantity"].sum()
+            new_row = pd.DataFrame([empty_row])
+            for col in group.columns:
+                if col not in ["Asset Code", "Quantity"]:
+                    new_row[col] = group.iloc[0][col]
+            new_rows.append(new_row)
+    return pd.concat(new_rows).reset_index(drop=True)
+
+
+@pytest.mark.filterwarnings("ignore::FutureWarning", "ignore::pandas.errors.SettingWithCopyWarning")
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("order", ["asc", "desc", "none"])
+@pytest.mark.parametrize("selected_columns", [
+    ["Site"],
+    ["Description"],
+    ["Level"],
+    ["Site", "Building"],
+    ["Building", "Level", "Description"],
+])
+def test_sort_matches_row_by_row_loop(seed, order, selected_columns):
+    rng = np.random.default_rng(seed)
+    df = random_register(rng, int(rng.integers(1, 80)))
+    df["Level"] = rng.choice(np.array(["001", "002", "010"], dtype=object), len(df))
+    expected = baseline_sort(df, selected_columns, order)
+    actual = sort_with_subtotals(df, selected_columns, order)
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual.astype(object), expected.astype(object), check_dtype=False)
+
+
+@pytest.mark.filterwarnings("ignore::FutureWarning", "ignore::pandas.errors.SettingWithCopyWarning")
+def test_sort_single_rows_keep_text_quantities():
+    df = pd.DataFrame({"Site": ["A", "B", "B"], "Quantity": ["N/A", 2, "3"], "Asset Code": ["X1", "X2", "X3"]})
+    pd.testing.assert_frame_equal(sort_with_subtotals(df, ["Site"], "asc").astype(object),
+                                  baseline_sort(df, ["Site"], "asc").astype(object), check_dtype=False)
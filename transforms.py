@@ -0,0 +1,205 @@
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from asset_codes import parse_code, format_codes
+from schema import forget_kinds, needs_numeric_conversion, recorded_kind
+
+# Site index of frames classified recently: id(df) -> (distinct sites, row codes)
+_site_indexes = {}
+
+
+def to_numeric_if_possible(column, kind=None):
+    """ Convert a column to numbers, leaving it unchanged when any value isn't one
+
+    kind is the column's kind recorded by normalize_dtypes, if known.
+    """
+    if not needs_numeric_conversion(column, kind):
+        return column
+    try:
+        return pd.to_numeric(column)
+    except (ValueError, TypeError):
+        return column
+
+
+def extract_columns(df, columns):
+    """ The selected columns of df, sharing their data with it """
+    return df[columns]
+
+
+def sort_with_subtotals(df, selected_columns, order):
+    """ Sort df and add a "Quantity" total row after every group of rows sharing the selected columns
+
+    Groups come out in ascending key order with their rows in sorted order,
+    rows with equal keys keeping their original order;
+    rows whose key contains a blank are left out.  A group of more than one
+    row gets its "Quantity" converted to numbers and is followed by a copy of
+    its first row with a blank "Asset Code" and the group's total quantity.
+    """
+    df = df.copy(deep=False)  # Columns are replaced, never written into, so they can be shared
+    if selected_columns and order != "none":
+        for column in selected_columns:
+            df[column] = to_numeric_if_possible(df[column], recorded_kind(df, column))
+        forget_kinds(df, selected_columns)
+        df = df.sort_values(by=selected_columns, ascending=(order == "asc"), kind="stable")
+    if not selected_columns:
+        return df.reset_index(drop=True)
+
+    # One pass to number the groups in key order; blank keys get no number
+    group_ids = df.groupby(selected_columns, sort=True, observed=True).ngroup()
+    keep = group_ids.notna().to_numpy()
+    rows = df[keep]
+    group_ids = group_ids[keep].to_numpy(dtype=np.int64)
+
+    sizes = np.bincount(group_ids) if len(group_ids) else np.array([], dtype=int)
+    in_multi_row_group = sizes[group_ids] > 1
+    has_summary = in_multi_row_group & ~pd.Series(group_ids).duplicated().to_numpy()
+    summary_ids = group_ids[has_summary]
+    summaries = rows.iloc[:0]
+
+    if len(summary_ids):
+        rows = forget_kinds(rows.copy(), ["Quantity"])
+        quantity = pd.to_numeric(rows["Quantity"], errors="coerce")
+        if not in_multi_row_group.all():
+            quantity = quantity.where(in_multi_row_group, rows["Quantity"])
+        rows["Quantity"] = quantity
+
+        totals = quantity[in_multi_row_group].groupby(group_ids[in_multi_row_group]).sum()
+        summaries = rows[has_summary].copy()
+        summaries["Quantity"] = totals.loc[summary_ids].to_numpy()
+        if "Asset Code" in summaries.columns:
+            summaries["Asset Code"] = ""
+
+    # Interleave: each summary row goes right after the rows of its group
+    all_ids = np.concatenate([group_ids, summary_ids])
+    is_summary = np.concatenate([np.zeros(len(group_ids), dtype=bool), np.ones(len(summary_ids), dtype=bool)])
+    positions = np.lexsort((is_summary, all_ids))
+    return pd.concat([rows, summaries]).iloc[positions].reset_index(drop=True)
+
+
+def blank_codes(df):
+    """ Mask of the rows assign_asset_codes gives a new code """
+    return (df["Asset Code"] == "").to_numpy()
+
+
+def assign_asset_codes(df, first_blank_row, asset_columns):
+    """ Fill blank asset codes and record each group's lead code in "Group Lead?"
+
+    first_blank_row is the code for the first blank row, e.g. "ABC001"; the
+    blanks are numbered on from it in row order, keeping at least as many
+    digits.  Every group of rows sharing the asset columns whose codes
+    include one starting with the prefix ("ABC") gets the first such code as
+    its "Group Lead?".  Only those two columns are rebuilt; the others are
+    shared with df.
+    """
+    df = df.copy(deep=False)
+    base_code, start_number, width = parse_code(first_blank_row)
+
+    blank = blank_codes(df)
+    if blank.any():
+        codes = df["Asset Code"].to_numpy(dtype=object, copy=True)
+        codes[blank] = format_codes(base_code, start_number, int(blank.sum()), width)
+        df["Asset Code"] = codes
+        forget_kinds(df, ["Asset Code"])
+
+    if not asset_columns:
+        return df
+
+    # One keyed pass: number the groups, then broadcast each group's first matching code
+    group_ids = df.groupby(asset_columns, sort=False, observed=True).ngroup()
+    codes = df["Asset Code"]
+    try:
+        matches = codes.str.startswith(base_code, na=False)
+    except AttributeError:
+        return df  # No text codes at all, so nothing can match
+    lead = codes.where(matches).groupby(group_ids).transform("first")
+    has_lead = lead.notna().to_numpy()
+    if has_lead.any():
+        if "Group Lead?" in df.columns:
+            group_lead = df["Group Lead?"].to_numpy(dtype=object, copy=True)
+        else:
+            group_lead = np.full(len(df), np.nan, dtype=object)
+        group_lead[has_lead] = lead[has_lead].to_numpy()
+        df["Group Lead?"] = group_lead
+        forget_kinds(df, ["Group Lead?"])
+    return df
+
+
+def _remember_site_index(df, index):
+    key = id(df)
+    _site_indexes[key] = index
+    weakref.finalize(df, _site_indexes.pop, key, None)
+
+
+def site_index(df):
+    """ Distinct values of "Site" and each row's position among them, computed once per frame """
+    site = df["Site"]
+    if isinstance(site.dtype, pd.CategoricalDtype):
+        return site.cat.categories, site.cat.codes.to_numpy()
+    index = _site_indexes.get(id(df))
+    if index is None:
+        codes, categories = pd.factorize(site)  # Blank sites get code -1
+        index = (categories, codes)
+        _remember_site_index(df, index)
+    return index
+
+
+def classify_sites(df, updates):
+    """ Apply queued {"Group": site, "Classification": value} updates to "Group.1" in one pass
+
+    Later updates for the same site win, as if they were applied one after
+    another.  Blank "Group.1" values are filled with "".
+    """
+    mapping = {}
+    for update in updates:
+        mapping[update["Group"]] = update["Classification"]
+
+    categories, codes = site_index(df)
+    # Look every queued site up once among the distinct sites, then
+    # broadcast to the rows through their codes; the extra last slot is
+    # where blank sites (code -1) land
+    positions = categories.get_indexer(pd.Index(list(mapping), dtype=object))
+    found = positions >= 0
+    classification = np.empty(len(categories) + 1, dtype=object)
+    classification[positions[found]] = np.array(list(mapping.values()), dtype=object)[found]
+    assigned = np.zeros(len(categories) + 1, dtype=bool)
+    assigned[positions[found]] = True
+
+    if "Group.1" in df.columns:
+        group = df["Group.1"].to_numpy(dtype=object, copy=True)
+    else:
+        group = np.full(len(df), np.nan, dtype=object)
+    rows = assigned[codes]
+    group[rows] = classification[codes[rows]]
+
+    df = df.copy(deep=False)  # Only "Group.1" changes, the other columns are shared
+    df["Group.1"] = pd.Series(group, index=df.index).fillna("")
+    forget_kinds(df, ["Group.1"])
+    _remember_site_index(df, (categories, codes))
+    return df
+
+
+def changed_cells(before, after, columns):
+    """ Positions of the rows whose value in each of columns differs between two versions of a table
+
+    The versions must hold the same rows in the same order, like two runs
+    of classify_sites or assign_asset_codes on one table.  Returns
+    {column: row positions} for the columns with changes, or None when the
+    tables can't be compared (different lengths, or a column only one of
+    them has).  Two blanks (None, NaN) are equal.
+    """
+    if len(before) != len(after):
+        return None
+    changes = {}
+    for column in columns:
+        if (column in before.columns) != (column in after.columns):
+            return None
+        if column not in after.columns:
+            continue
+        old = before[column].to_numpy(dtype=object)
+        new = after[column].to_numpy(dtype=object)
+        differs = (old != new) & ~(pd.isna(old) & pd.isna(new))
+        if differs.any():
+            changes[column] = np.flatnonzero(differs)
+    return changes
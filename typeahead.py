@@ -0,0 +1,167 @@
+import bisect
+import glob
+import hashlib
+import json
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Options sent per keystroke
+TYPEAHEAD_LIMIT = 50
+
+# Values are found by the n-grams of their text up to this length
+GRAM_LENGTH = 3
+
+# Bounds every prefix in bisect, as no text sorts after it
+_LAST_CHARACTER = chr(0x10FFFF)
+
+
+def options(values):
+    """ Dropdown options for values """
+    return [{"label": str(value), "value": value} for value in values]
+
+
+class ValueIndex:
+    """ The distinct values of a column, searchable as the user types
+
+    Values that start with the query come first, then values that contain
+    it elsewhere, each in the order they first appear in the column;
+    matching ignores case.  Prefixes are found by bisecting the sorted
+    values and substrings from a posting list per n-gram, so a search
+    only looks at the values it returns and at most one posting list.
+    """
+
+    def __init__(self, values):
+        self.values = pd.Series(values, dtype=object).dropna().drop_duplicates().tolist()
+        self._keys = [str(value).casefold() for value in self.values]
+        self._sorted = np.array(sorted(range(len(self._keys)), key=self._keys.__getitem__), dtype=np.int64)
+        self._sorted_keys = [self._keys[i] for i in self._sorted]
+
+        postings = {}
+        for i, key in enumerate(self._keys):
+            grams = {key[start:start + length]
+                     for length in range(1, GRAM_LENGTH + 1) for start in range(len(key) - length + 1)}
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        # Values were numbered in order, so every posting list is in that order too
+        self._postings = {gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()}
+
+    def __len__(self):
+        return len(self.values)
+
+    def _prefix_ids(self, query, limit):
+        low = bisect.bisect_left(self._sorted_keys, query)
+        high = bisect.bisect_left(self._sorted_keys, query + _LAST_CHARACTER, lo=low)
+        ids = self._sorted[low:high]
+        if len(ids) > limit:
+            ids = np.partition(ids, limit - 1)[:limit]
+        return np.sort(ids)
+
+    def _substring_ids(self, query, limit):
+        """ First ids of values containing query, but not at the start """
+        if len(query) <= GRAM_LENGTH:
+            candidates = self._postings.get(query)
+        else:
+            # Every match holds all n-grams of the query, so the shortest list has them all
+            grams = {query[start:start + GRAM_LENGTH] for start in range(len(query) - GRAM_LENGTH + 1)}
+            lists = [self._postings.get(gram) for gram in grams]
+            candidates = None if any(ids is None for ids in lists) else min(lists, key=len)
+        found = []
+        if candidates is None:
+            return found
+        for i in candidates:
+            key = self._keys[i]
+            if not key.startswith(query) and query in key:
+                found.append(i)
+                if len(found) == limit:
+                    break
+        return found
+
+    def search(self, query, limit=TYPEAHEAD_LIMIT):
+        """ Up to limit values matching query, all values when query is empty """
+        query = (query or "").casefold()
+        if not query:
+            return self.values[:limit]
+        ids = self._prefix_ids(query, limit).tolist()
+        if len(ids) < limit:
+            ids += self._substring_ids(query, limit - len(ids))
+        return [self.values[i] for i in ids]
+
+
+class IndexCache:
+    """ ValueIndex objects keyed by (session id, ...), kept on disk for every worker
+
+    Building an index takes about a second per 50,000 values, so it is
+    built once, e.g. by the job that loads the table, and pickled; other
+    workers read the file.  The most recently used max_entries indexes are
+    also kept in memory.
+    """
+
+    def __init__(self, directory, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        digest = hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()[:32]
+        return os.path.join(self.directory, f"{key[0]}-{digest}.pkl")
+
+    def _remember(self, key, index):
+        with self._lock:
+            self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+
+    def get(self, key, values):
+        """ The index stored under key, built from values() when there is none yet """
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                self.hits += 1
+                return index
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            index = None
+        if index is not None:
+            with self._lock:
+                self.disk_hits += 1
+            self._remember(key, index)
+            return index
+
+        with self._lock:
+            self.misses += 1
+        index = ValueIndex(values())
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self._remember(key, index)
+        return index
+
+    def clear_session(self, session_id):
+        """ Drop the indexes of a session """
+        with self._lock:
+            for key in [key for key in self._indexes if key[0] == session_id]:
+                del self._indexes[key]
+        for path in glob.glob(os.path.join(self.directory, f"{session_id}-*.pkl")):
+            os.remove(path)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._indexes), "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses}
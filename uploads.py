@@ -0,0 +1,115 @@
+import glob
+import hashlib
+import os
+import re
+import threading
+
+from werkzeug.utils import secure_filename
+
+# Upload ids are chosen by the browser, so only allow safe file name characters
+UPLOAD_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+CONTENT_RANGE_PATTERN = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+CHUNK_SIZE = 64 * 1024
+
+# Running SHA-256 of each partial upload in this worker: part path -> (offset, hasher)
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class OffsetMismatch(Exception):
+    """ Raised when a chunk does not start where the partial upload ends """
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at byte {offset}")
+        self.offset = offset
+
+
+def valid_upload_id(upload_id):
+    return bool(UPLOAD_ID_PATTERN.match(upload_id))
+
+
+def parse_content_range(header):
+    """ Return (start, end, total) from a Content-Range header, or None """
+    match = CONTENT_RANGE_PATTERN.match(header or "")
+    if not match:
+        return None
+    start, end, total = (int(group) for group in match.groups())
+    if end < start or end >= total:
+        return None
+    return start, end, total
+
+
+def partial_path(directory, session_id, upload_id):
+    return os.path.join(directory, f"{session_id}-{upload_id}.part")
+
+
+def partial_offset(part_path):
+    """ Number of bytes received so far for a partial upload """
+    try:
+        return os.path.getsize(part_path)
+    except FileNotFoundError:
+        return 0
+
+
+def _hasher_at(part_path, offset):
+    """ Return the running hash of the first offset bytes of a partial upload """
+    with _hashers_lock:
+        state = _hashers.get(part_path)
+    if state is not None and state[0] == offset:
+        return state[1]
+    # The earlier chunks went to another worker (or this one restarted), so
+    # hash what is already on disk before continuing
+    hasher = hashlib.sha256()
+    if offset:
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+    return hasher
+
+
+def write_chunk(part_path, start, stream):
+    """ Append a chunk read from stream to a partial upload and return the new offset """
+    offset = partial_offset(part_path)
+    if start != offset:
+        raise OffsetMismatch(offset)
+
+    hasher = _hasher_at(part_path, offset)
+    with open(part_path, "ab") as f:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+            f.write(chunk)
+            offset += len(chunk)
+    with _hashers_lock:
+        _hashers[part_path] = (offset, hasher)
+    return offset
+
+
+def finish_upload(directory, part_path, filename):
+    """ Move a complete upload into place, returns (stored path, digest, duplicate)
+
+    Files are stored as "<sha256>_<filename>".  When a file with the same
+    content is already stored, the new copy is dropped and the existing file
+    is returned instead.
+    """
+    digest = _hasher_at(part_path, partial_offset(part_path)).hexdigest()
+    with _hashers_lock:
+        _hashers.pop(part_path, None)
+
+    existing = [path for path in glob.glob(os.path.join(directory, f"{digest}_*"))
+                if not path.endswith(".part")]
+    if existing:
+        os.remove(part_path)
+        return existing[0], digest, True
+
+    name = secure_filename(filename) or "upload"
+    stored_path = os.path.join(directory, f"{digest}_{name}")
+    os.replace(part_path, stored_path)
+    return stored_path, digest, False
+
+
+def discard(part_path):
+    """ Drop a partial upload """
+    with _hashers_lock:
+        _hashers.pop(part_path, None)
+    if os.path.exists(part_path):
+        os.remove(part_path)